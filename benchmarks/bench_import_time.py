@@ -0,0 +1,140 @@
+"""
+Benchmark of the import time of squab and of the CLI.
+
+Each target is imported in a fresh interpreter with `python -X importtime`, several times, and the median of the
+cumulative import time is reported together with the slowest modules it imports. The results can be saved with
+`--output` and compared with a previous run with `--baseline`, failing if a target got slower than `--tolerance`.
+
+Usage:
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --repeat 10 --output import_time.json
+    python benchmarks/bench_import_time.py --baseline import_time.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name of the target -> statement run in a fresh interpreter
+TARGETS = {
+    'squab': 'import squab',
+    'squab.DatasetInput': 'from squab import DatasetInput',
+    'squab.models': 'from squab.models import create_default_gpt4o',
+    'AttachmentGenerator': 'from squab.generate_datasets.generators.ambiguity_generators import AttachmentGenerator',
+    'ScopeGenerator': 'from squab.generate_datasets.generators.ambiguity_generators import ScopeGenerator',
+    'ColumnAmbiguityGenerator':
+        'from squab.generate_datasets.generators.ambiguity_generators import ColumnAmbiguityGenerator',
+    'ColumnUnanswerableGenerator':
+        'from squab.generate_datasets.generators.unanswerable_generators import ColumnUnanswerableGenerator',
+    'CalculationUnanswerableGenerator':
+        'from squab.generate_datasets.generators.unanswerable_generators import CalculationUnanswerableGenerator',
+    'OutOfScopeGenerator': 'from squab.generate_datasets.generators.unanswerable_generators import OutOfScopeGenerator',
+    'BaseEvaluator': 'from squab import BaseEvaluator',
+    'cli': 'import main_generate_datasets',
+}
+
+
+def parse_importtime(stderr: str) -> tuple[float, dict[str, float]]:
+    """
+    Parses the output of `-X importtime`.
+
+    Returns:
+        tuple[float, dict[str, float]]: The total import time in seconds (the sum of the cumulative time of the
+            top-level imports) and the cumulative import time of each module.
+    """
+    total = 0.0
+    module2time = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        module2time[module.strip()] = int(cumulative) / 1e6
+        # the nested imports are indented under the module importing them
+        if not module.startswith('  '):
+            total += int(cumulative) / 1e6
+    return total, module2time
+
+
+def bench_target(statement: str, repeat: int) -> tuple[list[float], list[float], dict[str, float]]:
+    """
+    Runs `statement` `repeat` times, each in a new interpreter.
+
+    Returns:
+        tuple[list[float], list[float], dict[str, float]]: The import time and the wall time of each run,
+            and the import time of each module in the last run.
+    """
+    import_times, wall_times = [], []
+    module2time = {}
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [REPO_DIR, os.getenv('PYTHONPATH')]))}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                                 cwd=REPO_DIR, env=env, capture_output=True, text=True)
+        wall_times.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            raise RuntimeError(f'{statement} failed:\n{process.stderr[-2000:]}')
+        import_time, module2time = parse_importtime(process.stderr)
+        import_times.append(import_time)
+    return import_times, wall_times, module2time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import time of squab')
+    parser.add_argument('--targets', nargs='+', choices=list(TARGETS), default=list(TARGETS),
+                        help='the targets to import')
+    parser.add_argument('--repeat', type=int, default=5, help='the number of fresh interpreters for each target')
+    parser.add_argument('--top', type=int, default=5, help='the number of slowest modules shown for each target')
+    parser.add_argument('--output', type=str, default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='with --baseline, fail if a target is slower than the baseline by this fraction')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    for name in args.targets:
+        import_times, wall_times, module2time = bench_target(TARGETS[name], args.repeat)
+        median = statistics.median(import_times)
+        results[name] = {'statement': TARGETS[name],
+                         'median_import_time': median,
+                         'min_import_time': min(import_times),
+                         'median_wall_time': statistics.median(wall_times),
+                         'num_modules': len(module2time)}
+        line = f'{name:<34} import {median * 1000:8.1f} ms   wall {results[name]["median_wall_time"] * 1000:8.1f} ms' \
+               f'   {len(module2time):5d} modules'
+        if name in baseline:
+            delta = median / baseline[name]['median_import_time'] - 1
+            line += f'   {delta:+.0%} vs baseline'
+            if delta > args.tolerance:
+                regressions.append(name)
+        print(line)
+        # the slowest third-party packages, by top-level package
+        package2time = {}
+        for module, seconds in module2time.items():
+            package = module.split('.')[0]
+            if package != 'squab':
+                package2time[package] = max(package2time.get(package, 0.0), seconds)
+        for package, seconds in sorted(package2time.items(), key=lambda item: -item[1])[:args.top]:
+            print(f'    {package:<30} {seconds * 1000:8.1f} ms')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f'Slower than the baseline by more than {args.tolerance:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,43 @@
 import argparse
+import importlib
+import json
 import logging
+import os
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pandas as pd
 import sqlalchemy.exc
 from dotenv import load_dotenv
 from tqdm import tqdm
 
-from squab import DatasetInput
-from squab.generate_datasets.generators.ambiguity_generators import (
-    AttachmentGenerator,
-    ScopeGenerator,
-    ColumnAmbiguityGenerator
-)
-from squab.generate_datasets.generators.unanswerable_generators import ColumnUnanswerableGenerator, \
-    CalculationUnanswerableGenerator, \
-    OutOfScopeGenerator
+from squab import DatasetInput, JsonlSink
+from squab.budget import RunBudget
+from squab.generate_datasets import MultiCategoryGenerator, RunJournal
+from squab.models.metering import UsageMeter, get_active_meters
+from squab.profiling import PipelineProfiler, get_active_profiler
 from utils import read_db_tbl_ambrosia_ambig, read_db_tbl_beaver, read_db_tbl_amrbosia_unans
 
 load_dotenv(override=True)
 
+# the generator of each test category, imported only when the category is generated (see `get_generator_class`)
 GENERATORS = {
-    'attachment': AttachmentGenerator,
-    'scope': ScopeGenerator,
-    'column_ambiguity': ColumnAmbiguityGenerator,
-    'column_unanswerable': ColumnUnanswerableGenerator,
-    'calculation_unanswerable': CalculationUnanswerableGenerator,
-    'out_of_scope': OutOfScopeGenerator
+    'attachment': 'squab.generate_datasets.generators.ambiguity_generators.AttachmentGenerator',
+    'scope': 'squab.generate_datasets.generators.ambiguity_generators.ScopeGenerator',
+    'column_ambiguity': 'squab.generate_datasets.generators.ambiguity_generators.ColumnAmbiguityGenerator',
+    'column_unanswerable': 'squab.generate_datasets.generators.unanswerable_generators.ColumnUnanswerableGenerator',
+    'calculation_unanswerable':
+        'squab.generate_datasets.generators.unanswerable_generators.CalculationUnanswerableGenerator',
+    'out_of_scope': 'squab.generate_datasets.generators.unanswerable_generators.OutOfScopeGenerator'
 }
 
 
+def get_generator_class(test_category: str) -> type:
+    """Imports and returns the generator class of `test_category`, a key of `GENERATORS`."""
+    module_name, class_name = GENERATORS[test_category].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
 def read_db_tbl(db_path, ambig_type):
     if 'ambrosia' in db_path.lower():
         if ambig_type in ['attachment', 'scope', 'column_ambiguity']:
@@ -45,48 +54,307 @@ def read_db_tbl(db_path, ambig_type):
         raise ValueError("the db_path must contain either 'ambrosia' or 'beaver'")
 
 
-def generate(dataset_path, test_category_to_generate,
+def read_db_tbl_categories(db_path, test_categories_to_generate: list[str]) -> dict[str, dict[str, list[str]]]:
+    """
+    Collects the tables to analyze for each category, grouped by database.
+
+    Args:
+        db_path (str): The dataset path where to fetch the databases.
+        test_categories_to_generate (list[str]): The categories to generate, keys of `GENERATORS`.
+
+    Returns:
+        dict[str, dict[str, list[str]]]: For each database path, the tables to analyze for each category.
+            Databases keep the order in which they are first found.
+    """
+    db_path2category2tbls = {}
+    for category in test_categories_to_generate:
+        for db, tbls in read_db_tbl(db_path, category):
+            db_path2category2tbls.setdefault(db, {})[category] = list(tbls)
+    return db_path2category2tbls
+
+
+def generate(dataset_path, test_categories_to_generate: str | list[str],
              max_patterns_for_tbl,
              max_num_metadata_for_pattern,
-             max_questions_for_metadata):
-    db_paths2list_tbl_names = read_db_tbl(dataset_path, test_category_to_generate)
-    dfs = []
-    generator = GENERATORS[test_category_to_generate]()
-    for db_path, tbls in tqdm(db_paths2list_tbl_names):
-        fun_input = DatasetInput(
+             max_questions_for_metadata,
+             max_concurrency=1,
+             workers=1,
+             sink: JsonlSink | None = None,
+             journal_path: str | None = None,
+             max_cost: float | None = None,
+             max_tokens: int | None = None,
+             max_time: float | None = None,
+             prompt_schema_kwargs: dict | None = None):
+    if isinstance(test_categories_to_generate, str):
+        test_categories_to_generate = [test_categories_to_generate]
+    db_inputs = create_db_inputs(dataset_path, test_categories_to_generate, max_patterns_for_tbl,
+                                 max_num_metadata_for_pattern, max_questions_for_metadata, max_concurrency,
+                                 prompt_schema_kwargs)
+    # the budget of the whole run, shared among the databases
+    budget = RunBudget.from_limits(max_cost, max_tokens, max_time)
+    if workers > 1:
+        dfs = generate_in_process_pool(test_categories_to_generate, db_inputs, workers,
+                                       sink=sink, journal_path=journal_path, budget=budget)
+    else:
+        generator = create_multi_category_generator(test_categories_to_generate)
+        journal = RunJournal(journal_path) if journal_path else None
+        dfs = []
+        for i, (fun_input, category2tbls) in enumerate(tqdm(db_inputs)):
+            if budget.exhausted:
+                logging.warning(f'Budget exhausted, {len(db_inputs) - i} databases not processed')
+                break
+            try:
+                dfs.append(generate_db(generator, fun_input, category2tbls, sink=sink, journal=journal,
+                                       budget=budget.allocate(len(db_inputs) - i)))
+            except Exception as e:
+                # as in `generate_in_process_pool`, the database is skipped without stopping the run
+                logging.warning(f'{fun_input.relative_sqlite_db_path}: error generating the tests\n{e}')
+    if sink is not None:
+        # the tests are already in the sink
+        return None
+    dfs = [df for df in dfs if df is not None]
+
+    return pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
+
+
+def create_db_inputs(dataset_path, test_categories_to_generate: list[str],
+                     max_patterns_for_tbl,
+                     max_num_metadata_for_pattern,
+                     max_questions_for_metadata,
+                     max_concurrency=1,
+                     prompt_schema_kwargs: dict | None = None) -> list[tuple[DatasetInput, dict[str, list[str]]]]:
+    db_path2category2tbls = read_db_tbl_categories(dataset_path, test_categories_to_generate)
+    return [
+        (DatasetInput(
             relative_sqlite_db_path=db_path,
-            tbl_in_db_to_analyze=list(tbls),
             max_patterns_for_tbl=max_patterns_for_tbl,
             max_num_metadata_for_pattern=max_num_metadata_for_pattern,
             max_questions_for_metadata=max_questions_for_metadata,
-        )
+            max_concurrency=max_concurrency,
+            **(prompt_schema_kwargs or {}),
+        ), category2tbls)
+        for db_path, category2tbls in db_path2category2tbls.items()
+    ]
+
+
+def plan(dataset_path, test_categories_to_generate: list[str],
+         max_patterns_for_tbl,
+         max_num_metadata_for_pattern,
+         max_questions_for_metadata,
+         max_concurrency=1,
+         prompt_schema_kwargs: dict | None = None) -> pd.DataFrame:
+    """
+    Estimates the tests, the LLM calls, the cost and the time of the generation of each table without calling any LLM.
+
+    Returns:
+        pd.DataFrame: The plan of each (database, test category, table), see `DatasetGenerator.plan_dataset`.
+    """
+    db_inputs = create_db_inputs(dataset_path, test_categories_to_generate, max_patterns_for_tbl,
+                                 max_num_metadata_for_pattern, max_questions_for_metadata, max_concurrency,
+                                 prompt_schema_kwargs)
+    generator = create_multi_category_generator(test_categories_to_generate)
+    dfs = []
+    for fun_input, category2tbls in tqdm(db_inputs):
         try:
-            df = generator.generate_dataset(fun_input)
+            df = generator.generate_dataset(fun_input, category2tbls, dry_run=True)
         except sqlalchemy.exc.NoSuchTableError as e:
-            # this error arises with AMBROSIA databases
-            logging.warning(f'{db_path}\n{e}')
+            logging.warning(f'{fun_input.relative_sqlite_db_path}\n{e}')
             continue
+        df.insert(0, 'db_path', fun_input.relative_sqlite_db_path)
         dfs.append(df)
-
     return pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
 
 
+def create_multi_category_generator(test_categories_to_generate: list[str]) -> MultiCategoryGenerator:
+    return MultiCategoryGenerator({category: get_generator_class(category)() for category in test_categories_to_generate})
+
+
+def generate_db(generator: MultiCategoryGenerator,
+                fun_input: DatasetInput,
+                category2tbls: dict[str, list[str]],
+                sink: JsonlSink | None = None,
+                journal: RunJournal | None = None,
+                budget: RunBudget | None = None) -> pd.DataFrame | None:
+    try:
+        return generator.generate_dataset(fun_input, category2tbls,
+                                          sink=sink, return_dataframe=sink is None, journal=journal, budget=budget)
+    except sqlalchemy.exc.NoSuchTableError as e:
+        # this error arises with AMBROSIA databases
+        logging.warning(f'{fun_input.relative_sqlite_db_path}\n{e}')
+        return None
+
+
+# generator and journal of the current worker process, built once by `_init_worker`
+_worker_generator = None
+_worker_journal = None
+_worker_profile = False
+
+
+def _init_worker(test_categories_to_generate, journal_path=None, profile=False):
+    global _worker_generator, _worker_journal, _worker_profile
+    _worker_generator = create_multi_category_generator(test_categories_to_generate)
+    _worker_journal = RunJournal(journal_path) if journal_path else None
+    _worker_profile = profile
+
+
+def _generate_db_in_worker(fun_input: DatasetInput,
+                           category2tbls: dict[str, list[str]],
+                           budget_limits: tuple) -> tuple[pd.DataFrame | None, tuple[list[dict], list[dict]] | None]:
+    budget = RunBudget(*budget_limits)
+    if not _worker_profile:
+        return generate_db(_worker_generator, fun_input, category2tbls, journal=_worker_journal, budget=budget), None
+    # the statistics and the LLM usage of each database are sent back to the parent process
+    with PipelineProfiler().activate() as profiler, UsageMeter().activate() as meter:
+        df = generate_db(_worker_generator, fun_input, category2tbls, journal=_worker_journal, budget=budget)
+    return df, (profiler.to_records(), meter.to_records())
+
+
+def generate_in_process_pool(test_categories_to_generate: list[str],
+                             db_inputs: list[tuple[DatasetInput, dict[str, list[str]]]],
+                             workers: int,
+                             sink: JsonlSink | None = None,
+                             journal_path: str | None = None,
+                             budget: RunBudget | None = None) -> list[pd.DataFrame | None]:
+    """
+    Generates the tests of each database in a pool of `workers` processes.
+
+    Each worker process builds its own generators. The results are returned in the same order of
+    `db_inputs`, independently of which database completes first. A database raising an error is
+    logged and skipped (its result is None) without stopping the generation of the others.
+
+    Args:
+        test_categories_to_generate (list[str]): The keys in `GENERATORS` of the test categories to generate.
+        db_inputs (list[tuple[DatasetInput, dict[str, list[str]]]]): The generation input of each database,
+            with the tables to analyze for each category.
+        workers (int): The number of worker processes.
+        sink (JsonlSink | None): Optional streaming sink. The tests of each database are written as soon as
+            the database and all the ones before it in `db_inputs` are completed, so the file order is
+            deterministic. Written results are not kept in memory.
+        journal_path (str | None): Optional path of the `RunJournal` shared by the worker processes.
+        budget (RunBudget | None): Optional budget of the run. The processes cannot share the budget left,
+            so each database receives an equal part of the cost and tokens, and the deadline of the run.
+
+    If a `PipelineProfiler` is active, the workers profile their databases and the statistics are merged into it,
+    and the LLM calls of the workers are merged into the active `UsageMeter`s.
+
+    Returns:
+        list[pd.DataFrame | None]: The generated tests for each database in `db_inputs`.
+    """
+    dfs = [None] * len(db_inputs)
+    completed = [False] * len(db_inputs)
+    next_to_write = 0
+    profiler = get_active_profiler()
+    budget = budget or RunBudget()
+    budget_limits = (budget.max_cost / len(db_inputs) if budget.max_cost is not None else None,
+                     budget.max_tokens // len(db_inputs) if budget.max_tokens is not None else None,
+                     budget.deadline)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(test_categories_to_generate, journal_path, profiler is not None)) as executor:
+        future2index = {executor.submit(_generate_db_in_worker, fun_input, category2tbls, budget_limits): i
+                        for i, (fun_input, category2tbls) in enumerate(db_inputs)}
+        for future in tqdm(as_completed(future2index), total=len(future2index)):
+            index = future2index[future]
+            try:
+                dfs[index], records = future.result()
+                if records:
+                    profile_records, usage_records = records
+                    profiler.merge(profile_records)
+                    for meter in get_active_meters():
+                        meter.merge(usage_records)
+            except Exception as e:
+                logging.warning(f'{db_inputs[index][0].relative_sqlite_db_path}: error generating the tests\n{e}')
+            completed[index] = True
+
+            if sink is None:
+                continue
+            # release the completed prefix in order
+            while next_to_write < len(db_inputs) and completed[next_to_write]:
+                if dfs[next_to_write] is not None:
+                    sink.write(dfs[next_to_write])
+                    dfs[next_to_write] = None
+                next_to_write += 1
+    return dfs
+
+
 def main():
     args = parse_args()
-    df = generate(args.dataset_path,
-                  args.test_category_to_generate,
-                  args.max_patterns_for_tbl,
-                  args.max_num_metadata_for_pattern,
-                  args.max_questions_for_metadata)
+    if args.llm_cache_path:
+        # the wrappers, also in the worker processes, open the response cache configured in the environment
+        os.environ['SQUAB_LLM_CACHE_PATH'] = args.llm_cache_path
+        os.environ['SQUAB_LLM_CACHE_MODE'] = args.llm_cache_mode
+        if args.llm_cache_max_size_mb is not None:
+            os.environ['SQUAB_LLM_CACHE_MAX_SIZE_MB'] = str(args.llm_cache_max_size_mb)
+    if args.embedding_cache_dir:
+        os.environ['SQUAB_EMBEDDING_CACHE_DIR'] = args.embedding_cache_dir
+    if args.column_similarity is not None:
+        os.environ['SQUAB_COLUMN_SIMILARITY'] = args.column_similarity
+    if args.rate_limits:
+        # the limits are enforced in each process, the worker processes share them equally
+        limits = {key: {name: value / max(args.workers, 1) for name, value in key_limits.items()}
+                  for key, key_limits in json.loads(args.rate_limits).items()}
+        os.environ['SQUAB_RATE_LIMITS'] = json.dumps(limits)
+    if args.llm_max_retries is not None:
+        os.environ['SQUAB_LLM_MAX_RETRIES'] = str(args.llm_max_retries)
+    if args.offline_llm:
+        os.environ['SQUAB_LLM_BACKEND'] = 'offline'
+        os.environ['SQUAB_OFFLINE_LATENCY'] = str(args.offline_llm_latency)
+    if args.llm_streaming is not None:
+        os.environ['SQUAB_LLM_STREAMING'] = args.llm_streaming
     dataset = 'beaver' if 'beaver' in args.dataset_path.lower() else 'ambrosia'
-    df.to_json(f'generated_dataset_{dataset}_{args.test_category_to_generate}.json', orient='records', indent=2)
+    categories_name = '-'.join(args.test_category_to_generate)
+    output_path = f'generated_dataset_{dataset}_{categories_name}.{args.output_format}'
+    generate_args = (args.dataset_path,
+                     args.test_category_to_generate,
+                     args.max_patterns_for_tbl,
+                     args.max_num_metadata_for_pattern,
+                     args.max_questions_for_metadata,
+                     args.max_concurrency,
+                     args.workers)
+    prompt_schema_kwargs = dict(prompt_schema_scope=args.prompt_schema_scope,
+                                prompt_schema_fk_neighbours=args.prompt_schema_fk_neighbours,
+                                prompt_schema_sample_values=args.prompt_schema_sample_values,
+                                prompt_schema_max_tokens=args.prompt_schema_max_tokens)
+    if args.dry_run:
+        df = plan(*generate_args[:-1], prompt_schema_kwargs=prompt_schema_kwargs)
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None):
+            print(df)
+        if len(df) > 0:
+            print(f'\nTotal: {df.num_tests.sum()} tests, {df.num_llm_calls.sum()} LLM calls, '
+                  f'{df.prompt_tokens.sum() + df.completion_tokens.sum()} tokens, '
+                  f'${df.estimated_cost.sum():.2f}, {df.estimated_time.sum() / max(args.workers, 1):.0f}s')
+        return
+
+    budget_kwargs = dict(max_cost=args.max_cost, max_tokens=args.max_tokens, max_time=args.max_time,
+                         prompt_schema_kwargs=prompt_schema_kwargs)
+    profiler = PipelineProfiler()
+    meter = UsageMeter()
+    with (profiler.activate() if args.profile else nullcontext(),
+          meter.activate() if args.profile else nullcontext()):
+        if args.output_format == 'json':
+            df = generate(*generate_args, journal_path=args.journal_path, **budget_kwargs)
+            df.to_json(output_path, orient='records', indent=2)
+        else:
+            with JsonlSink(output_path) as sink:
+                generate(*generate_args, sink=sink, journal_path=args.journal_path, **budget_kwargs)
+    if args.profile:
+        profiler.dump(f'generated_dataset_{dataset}_{categories_name}_profile.json')
+        meter.dump(f'generated_dataset_{dataset}_{categories_name}_usage.json')
+        totals = meter.report()['totals']
+        print(f'LLM usage: {totals["calls"]} calls ({totals["cached_calls"]} cached), '
+              f'{totals["prompt_tokens"] + totals["completion_tokens"]} tokens, ${totals["cost"]:.2f}, '
+              f'latency p50 {totals["latency_p50"]:.1f}s p90 {totals["latency_p90"]:.1f}s p99 {totals["latency_p99"]:.1f}s')
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Generate dataset and save as JSON file")
     parser.add_argument('--test_category_to_generate',
                         type=str,
-                        help=f'the test_category to generate: one in {list(GENERATORS.keys())}')
+                        nargs='+',
+                        choices=list(GENERATORS.keys()),
+                        metavar='CATEGORY',
+                        help=f'the test categories to generate in a single pass over each database: '
+                             f'one or more in {list(GENERATORS.keys())}')
 
     parser.add_argument('--dataset_path',
                         type=str,
@@ -106,6 +374,118 @@ def parse_args():
                         type=int,
                         default=1,
                         help='the maximum number of questions to generate for each metadata')
+    parser.add_argument('--max_concurrency',
+                        type=int,
+                        default=1,
+                        help='the maximum number of LLM calls running at the same time for each table')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='the number of processes generating the tests of different databases in parallel')
+    parser.add_argument('--prompt_schema_scope',
+                        type=str,
+                        default='table',
+                        choices=['table', 'database'],
+                        help='the schema included in the question generation prompts: '
+                             'only the table of the test or all the tables of the database')
+    parser.add_argument('--prompt_schema_fk_neighbours',
+                        action='store_true',
+                        help='also include in the prompt schema the tables connected to the table by a foreign key')
+    parser.add_argument('--prompt_schema_sample_values',
+                        type=int,
+                        default=0,
+                        help='the number of distinct values of each column included in the prompt schema')
+    parser.add_argument('--prompt_schema_max_tokens',
+                        type=int,
+                        default=None,
+                        help='the maximum number of tokens of the prompt schema, '
+                             'the schema of the table is always included')
+    parser.add_argument('--output_format',
+                        type=str,
+                        default='json',
+                        choices=['json', 'jsonl', 'jsonl.gz'],
+                        help='`json` writes the whole dataset at the end of the run, '
+                             '`jsonl` and `jsonl.gz` stream each test to the file as soon as its table is completed')
+    parser.add_argument('--journal_path',
+                        type=str,
+                        default=None,
+                        help='SQLite file recording the completed generation units. '
+                             'Re-running with the same file resumes an interrupted run without repeating LLM calls')
+    parser.add_argument('--max_cost',
+                        type=float,
+                        default=None,
+                        help='the maximum cost in dollars of the LLM calls of the run')
+    parser.add_argument('--max_tokens',
+                        type=int,
+                        default=None,
+                        help='the maximum number of LLM tokens of the run')
+    parser.add_argument('--max_time',
+                        type=float,
+                        default=None,
+                        help='the maximum wall-clock time of the run in seconds. When a budget runs out, '
+                             'the generation stops cleanly and the tests generated so far are saved')
+    parser.add_argument('--llm_cache_path',
+                        type=str,
+                        default=None,
+                        help='SQLite file caching the LLM responses. Identical prompts sent again to the same model '
+                             'are read from the cache instead of calling the provider')
+    parser.add_argument('--llm_cache_mode',
+                        type=str,
+                        default='read_write',
+                        choices=['read_write', 'read_only', 'replay'],
+                        help='`read_only` never writes new responses, '
+                             '`replay` also fails on prompts not in the cache instead of calling the provider')
+    parser.add_argument('--llm_cache_max_size_mb',
+                        type=float,
+                        default=None,
+                        help='the maximum size of the LLM cache, the least recently used responses are evicted')
+    parser.add_argument('--embedding_cache_dir',
+                        type=str,
+                        default=None,
+                        help='directory caching the embeddings of the columns. The columns already embedded by '
+                             'a previous run, or by another process, are read from the cache instead of the API')
+    parser.add_argument('--column_similarity',
+                        type=str,
+                        default=None,
+                        choices=['embeddings', 'local'],
+                        help='how column_ambiguity finds the similar columns: `embeddings` (default) with the OpenAI '
+                             'embeddings, `local` with the TF-IDF of the words and character n-grams of the column '
+                             'names, without network access or cost')
+    parser.add_argument('--rate_limits',
+                        type=str,
+                        default=None,
+                        help='JSON with the requests and tokens per minute of each provider or provider/model, e.g., '
+                             '\'{"openai": {"requests_per_minute": 500, "tokens_per_minute": 200000}}\'. '
+                             'The limits are shared among the worker processes')
+    parser.add_argument('--llm_max_retries',
+                        type=int,
+                        default=None,
+                        help='the maximum number of retries of an LLM call failing with a rate limit, timeout or '
+                             'server error (5 by default)')
+    parser.add_argument('--llm_streaming',
+                        type=str,
+                        choices=['off', 'stop'],
+                        default=None,
+                        help='stream the LLM responses and stop the generation as soon as the JSON answer is complete '
+                             '(`off` by default)')
+    parser.add_argument('--offline_llm',
+                        action='store_true',
+                        help='replace the LLMs and the embedding model with local stand-ins returning valid responses, '
+                             'to benchmark the pipeline without network access and without any cost')
+    parser.add_argument('--offline_llm_latency',
+                        type=float,
+                        default=0.0,
+                        help='the synthetic latency in seconds of each call to the offline LLMs')
+    parser.add_argument('--dry_run',
+                        action='store_true',
+                        help='print the patterns, metadata, tests, LLM calls, tokens, cost and time estimated '
+                             'for each table without calling any LLM and without writing the dataset')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='write the wall time, number of calls and LLM tokens of each pipeline stage, '
+                             'for each test category and table, to `generated_dataset_*_profile.json`, and the '
+                             'tokens, cost and latency percentiles of the LLM calls by model, prompt and stage '
+                             'to `generated_dataset_*_usage.json`')
 
     return parser.parse_args()
 
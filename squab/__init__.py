@@ -1,2 +1,21 @@
-from .evaluate_datasets import BaseEvaluator
-from .generate_datasets import DatasetInput, DatasetGenerator
\ No newline at end of file
+from typing import TYPE_CHECKING
+
+from .lazy_imports import lazy_getattr
+
+# the names are imported on first access, `import squab` does not import LangChain, QATCH or pandas
+_name2module = {
+    'BaseEvaluator': '.evaluate_datasets',
+    'DatasetInput': '.generate_datasets',
+    'DatasetGenerator': '.generate_datasets',
+    'JsonlSink': '.generate_datasets',
+    'PipelineProfiler': '.profiling',
+    'RunBudget': '.budget',
+}
+__all__ = list(_name2module)
+__getattr__, __dir__ = lazy_getattr(__name__, _name2module)
+
+if TYPE_CHECKING:
+    from .evaluate_datasets import BaseEvaluator
+    from .generate_datasets import DatasetInput, DatasetGenerator, JsonlSink
+    from .profiling import PipelineProfiler
+    from .budget import RunBudget
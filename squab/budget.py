@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, TypeVar
+
+T = TypeVar('T')
+
+_active_budget: ContextVar['RunBudget | None'] = ContextVar('squab_active_budget', default=None)
+# parsed `SQUAB_LLM_PRICES`, for each value of the variable
+_prices2parsed: dict[str, dict[str, dict[str, float]]] = {}
+
+
+class RunBudget:
+    """
+    Spending and wall-clock budget of a generation run.
+
+    The budget limits the dollar cost and the tokens of the LLM calls and sets a wall-clock deadline.
+    While a budget is active (see `activate`), every LLM call of the wrappers is charged to it.
+    The pipeline checks `exhausted` before starting a new unit of work and stops cleanly, keeping the
+    tests generated so far.
+
+    Budgets are shared fairly with `allocate`: a child budget receives an equal part of what is left
+    of its parent, and its charges are also counted by the parent. Allocating each table (or category)
+    when it starts, with the number of tables still to process, lets the budget left unused by cheap
+    tables flow to the following ones.
+
+    Attributes:
+        max_cost (float | None): The maximum cost in dollars. None for no limit.
+        max_tokens (int | None): The maximum number of prompt and completion tokens. None for no limit.
+        deadline (float | None): The `time.time()` after which the budget is exhausted. None for no limit.
+        cost (float): The cost charged so far.
+        tokens (int): The tokens charged so far.
+    """
+
+    def __init__(self,
+                 max_cost: float | None = None,
+                 max_tokens: int | None = None,
+                 deadline: float | None = None,
+                 parent: 'RunBudget | None' = None):
+        """
+        Args:
+            max_cost (float | None): The maximum cost in dollars. None for no limit.
+            max_tokens (int | None): The maximum number of tokens. None for no limit.
+            deadline (float | None): The wall-clock deadline as a `time.time()` timestamp. None for no limit.
+            parent (RunBudget | None): The budget also charged for every call charged to this one.
+        """
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+        self.deadline = deadline
+        self.parent = parent
+        self.cost = 0.0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_limits(cls,
+                    max_cost: float | None = None,
+                    max_tokens: int | None = None,
+                    max_time: float | None = None) -> 'RunBudget':
+        """
+        Creates a budget starting now.
+
+        Args:
+            max_cost (float | None): The maximum cost in dollars.
+            max_tokens (int | None): The maximum number of tokens.
+            max_time (float | None): The maximum wall-clock time in seconds.
+        """
+        return cls(max_cost=max_cost,
+                   max_tokens=max_tokens,
+                   deadline=time.time() + max_time if max_time is not None else None)
+
+    @property
+    def remaining_cost(self) -> float | None:
+        return max(self.max_cost - self.cost, 0.0) if self.max_cost is not None else None
+
+    @property
+    def remaining_tokens(self) -> int | None:
+        return max(self.max_tokens - self.tokens, 0) if self.max_tokens is not None else None
+
+    @property
+    def remaining_time(self) -> float | None:
+        return max(self.deadline - time.time(), 0.0) if self.deadline is not None else None
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether this budget, or one of its parents, has no cost, tokens or time left."""
+        if self.max_cost is not None and self.cost >= self.max_cost:
+            return True
+        if self.max_tokens is not None and self.tokens >= self.max_tokens:
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        return self.parent is not None and self.parent.exhausted
+
+    def allocate(self, num_parts: int) -> 'RunBudget':
+        """
+        Returns a child budget with `1 / num_parts` of the cost, tokens and time left in this budget.
+
+        Args:
+            num_parts (int): The number of parts (e.g., the tables still to process) sharing what is left.
+
+        Returns:
+            RunBudget: The child budget. Its charges are also counted by this budget.
+        """
+        num_parts = max(num_parts, 1)
+        remaining_cost, remaining_tokens, remaining_time = self.remaining_cost, self.remaining_tokens, self.remaining_time
+        return RunBudget(
+            max_cost=remaining_cost / num_parts if remaining_cost is not None else None,
+            max_tokens=remaining_tokens // num_parts if remaining_tokens is not None else None,
+            deadline=time.time() + remaining_time / num_parts if remaining_time is not None else None,
+            parent=self,
+        )
+
+    def charge(self, cost: float = 0.0, tokens: int = 0):
+        """Adds the cost and the tokens of a call to this budget and to its parents."""
+        budget = self
+        while budget is not None:
+            with budget._lock:
+                budget.cost += cost
+                budget.tokens += tokens
+            budget = budget.parent
+
+    def take(self, iterable: Iterable[T], n: int | None) -> tuple[list[T], bool]:
+        """
+        Collects up to `n` items of `iterable`, stopping before the next item when the budget is exhausted.
+
+        Args:
+            iterable (Iterable[T]): The items to collect, e.g., a generator calling the LLMs.
+            n (int | None): The maximum number of items. None for all the items.
+
+        Returns:
+            tuple[list[T], bool]: The collected items, and False if the collection was stopped by the budget.
+        """
+        items = []
+        if n is not None and n <= 0:
+            return items, True
+        iterator = iter(iterable)
+        while not self.exhausted:
+            try:
+                items.append(next(iterator))
+            except StopIteration:
+                return items, True
+            if n is not None and len(items) >= n:
+                return items, True
+        return items, False
+
+    @contextmanager
+    def activate(self):
+        """Charges the LLM calls made inside the block (also from worker threads copying the context)."""
+        token = _active_budget.set(self)
+        try:
+            yield self
+        finally:
+            _active_budget.reset(token)
+
+
+def get_active_budget() -> RunBudget | None:
+    return _active_budget.get()
+
+
+def charge_llm_call(model_name: str, prompt_tokens: int = 0, completion_tokens: int = 0, cost: float | None = None):
+    """
+    Charges a language model call to the active budget, if any.
+
+    The cost is computed with `estimate_llm_cost`. Calls to models without a known price only count for the
+    token limit.
+
+    Args:
+        model_name (str): The name of the model.
+        prompt_tokens (int): The prompt tokens of the call.
+        completion_tokens (int): The completion tokens of the call.
+        cost (float | None): The cost of the call, if already computed.
+    """
+    budget = _active_budget.get()
+    if budget is None:
+        return
+    budget.charge(cost=cost if cost is not None else estimate_llm_cost(model_name, prompt_tokens, completion_tokens),
+                  tokens=prompt_tokens + completion_tokens)
+
+
+def get_custom_llm_prices() -> dict[str, dict[str, float]]:
+    """
+    Returns the prices set with `SQUAB_LLM_PRICES`, in dollars per million tokens, e.g.,
+    `{"meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo": {"prompt": 3.5, "completion": 3.5}}`.
+    """
+    prices = os.getenv('SQUAB_LLM_PRICES', '')
+    if prices not in _prices2parsed:
+        _prices2parsed[prices] = json.loads(prices) if prices else {}
+    return _prices2parsed[prices]
+
+
+def estimate_llm_cost(model_name: str, prompt_tokens: int = 0, completion_tokens: int = 0) -> float:
+    """
+    Returns the dollar cost of a language model call, 0 for models without a known price.
+
+    The prices set with `SQUAB_LLM_PRICES` (see `get_custom_llm_prices`) take precedence over the OpenAI price
+    list, so that the models of the other providers (e.g., Together or Gemini) can be priced too.
+
+    Args:
+        model_name (str): The name of the model.
+        prompt_tokens (int): The prompt tokens of the call.
+        completion_tokens (int): The completion tokens of the call.
+    """
+    custom_prices = get_custom_llm_prices().get(model_name)
+    if custom_prices is not None:
+        return (prompt_tokens * custom_prices.get('prompt', 0.0)
+                + completion_tokens * custom_prices.get('completion', 0.0)) / 1e6
+    # imported here, langchain_community is slow to import and not needed without LLM calls
+    from langchain_community.callbacks.openai_info import TokenType, get_openai_token_cost_for_model
+    try:
+        return (get_openai_token_cost_for_model(model_name, prompt_tokens, token_type=TokenType.PROMPT)
+                + get_openai_token_cost_for_model(model_name, completion_tokens, token_type=TokenType.COMPLETION))
+    except ValueError:
+        logging.debug(f'Unknown price for {model_name}, its cost is not counted')
+        return 0.0
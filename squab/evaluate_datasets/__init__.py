@@ -1 +1,10 @@
-from .evaluate import BaseEvaluator
\ No newline at end of file
+from typing import TYPE_CHECKING
+
+from ..lazy_imports import lazy_getattr
+
+_name2module = {'BaseEvaluator': '.evaluate'}
+__all__ = list(_name2module)
+__getattr__, __dir__ = lazy_getattr(__name__, _name2module)
+
+if TYPE_CHECKING:
+    from .evaluate import BaseEvaluator
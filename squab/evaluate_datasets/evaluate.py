@@ -3,7 +3,6 @@ import logging
 import sqlalchemy
 from func_timeout import func_timeout, FunctionTimedOut
 from qatch.connectors import SqliteConnector
-from qatch.evaluate_dataset import OrchestratorEvaluator as QatchEvaluator
 from typing_extensions import Literal
 
 
@@ -18,6 +17,9 @@ class BaseEvaluator:
         - Initializes a connector placeholder and database path attribute.
         """
 
+        # imported here, the QATCH evaluators import LangGraph
+        from qatch.evaluate_dataset import OrchestratorEvaluator as QatchEvaluator
+
         self.qatch_evaluator = QatchEvaluator(evaluator_names=['execution_accuracy'])
         self._connector: SqliteConnector | None = None
         self.db_path = None
@@ -1 +1,20 @@
-from .dataset_generator import DatasetGenerator, DatasetInput
\ No newline at end of file
+from typing import TYPE_CHECKING
+
+from ..lazy_imports import lazy_getattr
+
+_name2module = {
+    'DatasetGenerator': '.dataset_generator',
+    'DatasetInput': '.dataset_generator',
+    'RunJournal': '.journal',
+    'MultiCategoryGenerator': '.multi_category_generator',
+    'JsonlSink': '.sinks',
+    'read_jsonl': '.sinks',
+}
+__all__ = list(_name2module)
+__getattr__, __dir__ = lazy_getattr(__name__, _name2module)
+
+if TYPE_CHECKING:
+    from .dataset_generator import DatasetGenerator, DatasetInput
+    from .journal import RunJournal
+    from .multi_category_generator import MultiCategoryGenerator
+    from .sinks import JsonlSink, read_jsonl
@@ -1,15 +1,25 @@
+import json
+import logging
 import random
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from itertools import islice
 from typing import Generator, Literal
 from typing import Optional, Union
 
 import pandas as pd
-from langchain_community.callbacks import get_openai_callback
 from pydantic import BaseModel, Field
 from qatch.connectors import ConnectorTable, SqliteConnector
 
-from .utils import utils_find_closest_matches
+from .journal import RunJournal
+from ..budget import RunBudget, estimate_llm_cost
+from ..models.metering import UsageMeter
+from ..profiling import get_active_profiler, profile_scope, profile_stage
+from .sinks import JsonlSink
+from .utils import (utils_find_closest_matches, utils_get_db_dump_no_insert, utils_get_relevant_schema,
+                    utils_is_key_column_name, utils_map_concurrently, utils_without_costs)
 
 
 class DatasetInput(BaseModel):
@@ -50,6 +60,63 @@ class DatasetInput(BaseModel):
         description="Maximum number of questions to generate per metadata entry.",
         ge=1,  # Ensure the value is greater than or equal to 1.
     )
+    max_concurrency: Optional[int] = Field(
+        1,
+        description="Maximum number of metadata/test generations (LLM calls) running at the same time. "
+                    "With 1 the pipeline runs serially.",
+        ge=1,  # Ensure the value is greater than or equal to 1.
+    )
+    max_cost: Optional[float] = Field(
+        None,
+        description="Maximum cost in dollars of the LLM calls. The generation stops cleanly when it is reached.",
+        gt=0,
+    )
+    max_tokens: Optional[int] = Field(
+        None,
+        description="Maximum number of prompt and completion tokens of the LLM calls.",
+        gt=0,
+    )
+    max_time: Optional[float] = Field(
+        None,
+        description="Maximum wall-clock time of the generation, in seconds.",
+        gt=0,
+    )
+    prompt_schema_scope: Literal['table', 'database'] = Field(
+        'table',
+        description="Schema included in the prompts: only the table of the test ('table') "
+                    "or all the tables of the database ('database').",
+    )
+    prompt_schema_fk_neighbours: bool = Field(
+        False,
+        description="Whether the prompt schema also includes the tables connected to the table by a foreign key.",
+    )
+    prompt_schema_sample_values: int = Field(
+        0,
+        description="Number of distinct values of each column included in the prompt schema.",
+        ge=0,
+    )
+    prompt_schema_max_tokens: Optional[int] = Field(
+        None,
+        description="Maximum number of tokens of the prompt schema. The schema of the table is always included.",
+        gt=0,
+    )
+
+
+def create_sqlite_connector(function_input: DatasetInput) -> SqliteConnector:
+    """
+    Creates the `SqliteConnector` of the database described by `function_input`.
+
+    Args:
+        function_input (DatasetInput): The generation input with the database path, name and optional tables.
+
+    Returns:
+        SqliteConnector: The connector to the database.
+    """
+    db_name = function_input.db_name or function_input.relative_sqlite_db_path.split('/')[-1].replace('.sqlite', '')
+    return SqliteConnector(relative_db_path=function_input.relative_sqlite_db_path,
+                           db_name=db_name,
+                           tables=function_input.tables,
+                           table2primary_key=function_input.table2primary_key)
 
 
 class DatasetGenerator[PatternType, MetadataType, TestType](ABC):
@@ -64,11 +131,12 @@ class DatasetGenerator[PatternType, MetadataType, TestType](ABC):
     tables and filtering columns are provided to assist in dataset creation.
 
     Attributes:
-        seed (int): Random seed for ensuring reproducibility when generating datasets.
+        seed (int): Random seed for ensuring reproducibility when generating datasets. Each work item
+            (the patterns of a table, the metadata of a pattern, the tests of a metadata) draws from its own
+            random generator derived from the seed, see `get_rng`.
     """
 
     def __init__(self, seed):
-        random.seed(seed)
         self.seed = seed
 
     @property
@@ -101,7 +169,15 @@ class DatasetGenerator[PatternType, MetadataType, TestType](ABC):
         """
         raise NotImplementedError
 
-    def generate_dataset(self, function_input: DatasetInput) -> pd.DataFrame:
+    def generate_dataset(self,
+                         function_input: DatasetInput,
+                         sink: JsonlSink | None = None,
+                         return_dataframe: bool = True,
+                         journal: RunJournal | None = None,
+                         sqlite_connector: SqliteConnector | None = None,
+                         tbl_name2tbls: dict[str, ConnectorTable] | None = None,
+                         budget: RunBudget | None = None,
+                         dry_run: bool = False) -> pd.DataFrame | None:
         """
         Generates a dataset of test questions and related metadata by processing
         database tables through multiple nested iterative stages.
@@ -119,66 +195,331 @@ class DatasetGenerator[PatternType, MetadataType, TestType](ABC):
                 configuration settings required for dataset generation. It includes
                 details about database connection, tables, constraints, and
                 generation parameters.
+            sink (JsonlSink | None): Optional streaming sink. When provided, the tests of
+                each table are written and flushed to the sink as soon as the table is completed.
+            return_dataframe (bool): Whether to accumulate and return the generated tests.
+                Set it to False together with a `sink` to keep the memory constant during the run.
+            journal (RunJournal | None): Optional run journal. Units already completed in the journal
+                (the metadata of a pattern, the tests of a metadata) are read from it instead of calling
+                the LLMs again, and every new unit is recorded, so an interrupted run can be resumed.
+            sqlite_connector (SqliteConnector | None): Optional connector already opened on the database of
+                `function_input`. If None, a new connector is created.
+            tbl_name2tbls (dict[str, ConnectorTable] | None): Optional tables already loaded with
+                `sqlite_connector.load_tables_from_database()`. If None, the tables are loaded from the database.
+            budget (RunBudget | None): Optional budget to respect. If None, a budget is created from the
+                `max_cost`, `max_tokens` and `max_time` of `function_input`. The budget left is shared equally
+                among the tables still to process; when it runs out, the generation stops before the next
+                unit of work and the tests generated so far are returned (and written to the sink).
+            dry_run (bool): If True, no test is generated and the plan returned by `plan_dataset` is returned instead.
 
         Returns:
-            pd.DataFrame: A Pandas DataFrame containing generated dataset with the
+            pd.DataFrame | None: A Pandas DataFrame containing generated dataset with the
             following columns:
                 - test questions and metadata corresponding to the processed tables.
                 - table name and schema for reference.
                 - average test generation costs.
                 - dataset seed and associated test category.
+            None if `return_dataframe` is False.
         """
+        if dry_run:
+            return self.plan_dataset(function_input, sqlite_connector=sqlite_connector, tbl_name2tbls=tbl_name2tbls)
+
         # for loop over the table
         tests = []
 
-        db_name = function_input.db_name or function_input.relative_sqlite_db_path.split('/')[-1].replace('.sqlite', '')
-        sqlite_connector = SqliteConnector(relative_db_path=function_input.relative_sqlite_db_path,
-                                           db_name=db_name,
-                                           tables=function_input.tables,
-                                           table2primary_key=function_input.table2primary_key)
+        sqlite_connector = sqlite_connector or create_sqlite_connector(function_input)
+        profiler = get_active_profiler()
+        if profiler is not None:
+            profiler.watch_engine(sqlite_connector.engine)
+
         # Apply max_num constraints to each nested loop using `islice`
-        for tbl in islice(
-                self.read_table_generator(sqlite_connector, **function_input.model_dump()),
+        with profile_scope(self.test_category, None):
+            tables = list(islice(
+                self.read_table_generator(sqlite_connector, tbl_name2tbls=tbl_name2tbls, **function_input.model_dump()),
                 function_input.max_num_tbls
-        ):
-            with get_openai_callback() as cb:
-                tbl_tests = []
-                for pattern in islice(
-                        self.pattern_identification(tbl,
-                                                    sqlite_connector=sqlite_connector),
-                        function_input.max_patterns_for_tbl
-                ):
-                    # TODO pass as argument the max_num_metadata_for_pattern to improve generation
-                    for metadata in islice(
-                            self.metadata_generator(pattern,
-                                                    table=tbl,
-                                                    sqlite_connector=sqlite_connector),
-                            function_input.max_num_metadata_for_pattern
-                    ):
-                        for test in islice(
-                                self.tests_generator(metadata,
-                                                     pattern=pattern,
-                                                     table=tbl,
-                                                     sqlite_connector=sqlite_connector),
-                                function_input.max_questions_for_metadata
-                        ):
-                            tbl_tests.append(test)
+            ))
+            self.prepare_tables(tables, sqlite_connector=sqlite_connector, function_input=function_input)
+        budget = budget or RunBudget.from_limits(function_input.max_cost,
+                                                 function_input.max_tokens,
+                                                 function_input.max_time)
+        for i, tbl in enumerate(tables):
+            if budget.exhausted:
+                logging.warning(f'{self.test_category}: budget exhausted, '
+                                f'{len(tables) - i} tables of {sqlite_connector.db_name} not processed')
+                break
+            tbl_budget = budget.allocate(len(tables) - i)
+            with (profile_scope(self.test_category, tbl.tbl_name), profile_stage('table'),
+                  tbl_budget.activate(), UsageMeter().activate() as usage):
+                tbl_tests = self._generate_tbl_tests(tbl, sqlite_connector, function_input,
+                                                     journal=journal, budget=tbl_budget)
 
             if len(tbl_tests) > 0:
-                average_test_cost = cb.total_cost / len(tbl_tests)
+                average_test_cost = usage.total_cost / len(tbl_tests)
                 tbl_df = pd.DataFrame(tbl_tests)
                 tbl_df['table_name'] = tbl.tbl_name
-                tbl_df['tbl_schema'] = [list(tbl.tbl_col2metadata.keys())]
+                tbl_df['tbl_schema'] = [list(tbl.tbl_col2metadata.keys())] * len(tbl_df)
                 tbl_df['average_test_cost'] = average_test_cost
-
-                tests.append(tbl_df)
+                tbl_df['test_category'] = self.test_category
+                tbl_df['test_type'] = self.test_type
+                tbl_df['dataset_seed'] = self.seed
+
+                if sink is not None:
+                    sink.write(tbl_df)
+                if return_dataframe:
+                    tests.append(tbl_df)
+        if not return_dataframe:
+            return None
         if len(tests) == 0:
             return pd.DataFrame()
-        df = pd.concat(tests, ignore_index=True)
-        df['test_category'] = self.test_category
-        df['test_type'] = self.test_type
-        df['dataset_seed'] = self.seed
-        return df
+        return pd.concat(tests, ignore_index=True)
+
+    def _generate_tbl_tests(self,
+                            tbl: ConnectorTable,
+                            sqlite_connector: SqliteConnector,
+                            function_input: DatasetInput,
+                            journal: RunJournal | None = None,
+                            budget: RunBudget | None = None) -> list[TestType]:
+        """
+        Runs the pattern -> metadata -> test pipeline for a single table.
+
+        Patterns are identified first (this step is mostly SQL), then the metadata of every pattern is
+        generated, and finally the tests of every (pattern, metadata) pair. With `max_concurrency` greater
+        than 1, the independent `metadata_generator` and `tests_generator` calls run at the same time.
+        The `max_*` caps of `function_input` are applied to each generator and the tests are returned in
+        the same order regardless of which LLM call completes first.
+
+        `tests_generator` also receives `max_questions` and `max_concurrency` in its kwargs, so that the
+        generators sending their LLM calls in batch do not request more tests than needed.
+
+        Each generator is stopped before its next item once the `budget` is exhausted. Units stopped
+        by the budget are not recorded in the journal, so a resumed run generates them again.
+
+        Args:
+            tbl (ConnectorTable): The table to generate the tests for.
+            sqlite_connector (SqliteConnector): The connector of the database containing the table.
+            function_input (DatasetInput): The generation settings with the `max_*` caps and `max_concurrency`.
+            journal (RunJournal | None): Optional journal where completed units are read from and recorded to.
+            budget (RunBudget | None): Optional budget of the table. If None, the generation is not limited.
+
+        Returns:
+            list[TestType]: The generated tests, in deterministic order.
+        """
+        budget = budget or RunBudget()
+        db_name = sqlite_connector.db_name
+
+        def read_or_generate(stage, pattern, metadata, generate):
+            if journal is None:
+                return generate()[0]
+            # the costs are not part of the key, they are 0 for the calls read from the response cache
+            journal_key = (sqlite_connector.db_path, tbl.tbl_name, self.test_category, self.seed, stage,
+                           utils_without_costs(pattern))
+            output = journal.get(*journal_key, metadata=utils_without_costs(metadata))
+            if output is None:
+                output, completed = generate()
+                if completed:
+                    journal.put(*journal_key, metadata=utils_without_costs(metadata), output=output)
+            return output
+
+        def generate_metadata(pattern):
+            def generate():
+                with profile_stage('metadata_generator'):
+                    return budget.take(
+                        self.metadata_generator(pattern, table=tbl, sqlite_connector=sqlite_connector,
+                                                rng=self.get_rng(db_name, tbl.tbl_name, pattern),
+                                                function_input=function_input),
+                        function_input.max_num_metadata_for_pattern
+                    )
+
+            return read_or_generate('metadata', pattern, None, generate)
+
+        def generate_tests(pattern_metadata):
+            pattern, metadata = pattern_metadata
+
+            def generate():
+                with profile_stage('tests_generator'):
+                    return budget.take(
+                        self.tests_generator(metadata, pattern=pattern, table=tbl, sqlite_connector=sqlite_connector,
+                                             rng=self.get_rng(db_name, tbl.tbl_name, pattern, metadata),
+                                             function_input=function_input,
+                                             max_questions=function_input.max_questions_for_metadata,
+                                             max_concurrency=function_input.max_concurrency),
+                        function_input.max_questions_for_metadata
+                    )
+
+            return read_or_generate('tests', pattern, metadata, generate)
+
+        with profile_stage('pattern_identification'):
+            patterns, _ = budget.take(
+                self.pattern_identification(tbl, sqlite_connector=sqlite_connector,
+                                            rng=self.get_rng(db_name, tbl.tbl_name),
+                                            function_input=function_input),
+                function_input.max_patterns_for_tbl
+            )
+        with ThreadPoolExecutor(max_workers=function_input.max_concurrency) as executor:
+            if function_input.max_concurrency > 1:
+                map_fn = partial(utils_map_concurrently, executor=executor)
+            else:
+                map_fn = lambda fn, items: [fn(item) for item in items]
+
+            pattern2metadata = map_fn(generate_metadata, patterns)
+            pattern_metadata_pairs = [(pattern, metadata)
+                                      for pattern, list_metadata in zip(patterns, pattern2metadata)
+                                      for metadata in list_metadata]
+            pair2tests = map_fn(generate_tests, pattern_metadata_pairs)
+        return [test for tests in pair2tests for test in tests]
+
+    def get_rng(self, *keys) -> random.Random:
+        """
+        Returns the random generator of a work item, seeded with the generator seed, the test category and `keys`.
+
+        The same work item always gets the same random sequence, independently of the other items, of the
+        execution order and of the process running it. The generators receive it in `kwargs['rng']`.
+        The costs of the patterns and metadata in `keys` are ignored (see `utils_without_costs`).
+
+        Args:
+            *keys: The JSON-serializable identifiers of the work item, e.g., database name, table name and pattern.
+
+        Returns:
+            random.Random: The random generator of the work item.
+        """
+        keys = [utils_without_costs(key) if isinstance(key, dict) else key for key in keys]
+        return random.Random(json.dumps([self.seed, self.test_category, *keys], sort_keys=True, default=str))
+
+    def get_prompt_database(self,
+                            sqlite_connector: SqliteConnector,
+                            table: ConnectorTable,
+                            function_input: DatasetInput | None = None,
+                            **kwargs) -> str:
+        """
+        Returns the database schema to include in the `database` field of the prompts of a table.
+
+        By default only the schema of `table` is included, see `utils_get_relevant_schema`. The `prompt_schema_*`
+        fields of `function_input`, received by the generators in `kwargs['function_input']`, select the foreign
+        key neighbours, the sample values, the token limit, or the schema of the whole database.
+
+        Args:
+            sqlite_connector (SqliteConnector): The connector of the database.
+            table (ConnectorTable): The table of the tests.
+            function_input (DatasetInput | None): The generation settings. If None, the default settings.
+            **kwargs: The other kwargs of the generator, ignored.
+
+        Returns:
+            str: The 'CREATE TABLE' statements to include in the prompt.
+        """
+        function_input = function_input or DatasetInput(relative_sqlite_db_path=sqlite_connector.db_path)
+        if function_input.prompt_schema_scope == 'database':
+            return utils_get_db_dump_no_insert(sqlite_connector.db_path)
+        return utils_get_relevant_schema(sqlite_connector.db_path, table.tbl_name,
+                                         include_fk_neighbours=function_input.prompt_schema_fk_neighbours,
+                                         num_sample_values=function_input.prompt_schema_sample_values,
+                                         max_tokens=function_input.prompt_schema_max_tokens)
+
+    def plan_dataset(self,
+                     function_input: DatasetInput,
+                     sqlite_connector: SqliteConnector | None = None,
+                     tbl_name2tbls: dict[str, ConnectorTable] | None = None,
+                     completion_tokens_per_call: int = 300,
+                     seconds_per_llm_call: float = 5.0) -> pd.DataFrame:
+        """
+        Estimates the work and the cost of `generate_dataset` for `function_input` without calling any LLM.
+
+        Only the SQL parts of the pipeline run: the patterns are identified on the database (see `plan_patterns`)
+        and, for the generators based on QATCH, the queries of each test are enumerated. The prompt of every LLM
+        call that `generate_dataset` would make (see `plan_llm_calls`) is rendered with its real template from
+        `PROMPTS` to count the prompt tokens. The completion tokens and the duration of the calls are not known
+        in advance and are estimated with `completion_tokens_per_call` and `seconds_per_llm_call`.
+
+        The numbers of metadata and tests are upper bounds: during the generation, the LLM answers that
+        cannot be parsed or validated are discarded.
+
+        Args:
+            function_input (DatasetInput): The generation input to plan.
+            sqlite_connector (SqliteConnector | None): Optional connector already opened on the database.
+            tbl_name2tbls (dict[str, ConnectorTable] | None): Optional tables already loaded from the database.
+            completion_tokens_per_call (int): The estimated completion tokens of each LLM call.
+            seconds_per_llm_call (float): The estimated duration of each LLM call, in seconds.
+
+        Returns:
+            pd.DataFrame: One row per table with the columns `test_category`, `table_name`, `num_patterns`,
+            `num_metadata`, `num_tests`, `num_llm_calls`, `prompt_tokens`, `completion_tokens`,
+            `estimated_cost` (dollars) and `estimated_time` (seconds, with `max_concurrency` calls at the same time).
+        """
+        sqlite_connector = sqlite_connector or create_sqlite_connector(function_input)
+        tables = list(islice(
+            self.read_table_generator(sqlite_connector, tbl_name2tbls=tbl_name2tbls, **function_input.model_dump()),
+            function_input.max_num_tbls
+        ))
+        rows = []
+        for tbl in tables:
+            start = time.perf_counter()
+            row = {'test_category': self.test_category, 'table_name': tbl.tbl_name,
+                   'num_patterns': 0, 'num_metadata': 0, 'num_tests': 0,
+                   'num_llm_calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'estimated_cost': 0.0}
+
+            db_name = sqlite_connector.db_name
+            patterns = list(islice(self.plan_patterns(tbl, sqlite_connector=sqlite_connector,
+                                                      rng=self.get_rng(db_name, tbl.tbl_name),
+                                                      function_input=function_input),
+                                   function_input.max_patterns_for_tbl))
+            for pattern in patterns:
+                plan = self.plan_llm_calls(pattern, table=tbl, sqlite_connector=sqlite_connector,
+                                           rng=self.get_rng(db_name, tbl.tbl_name, pattern),
+                                           function_input=function_input)
+                num_metadata = min(plan['num_metadata'], function_input.max_num_metadata_for_pattern)
+                tests_calls = plan['tests_calls'][:function_input.max_questions_for_metadata]
+                # the metadata calls run once for the pattern, the tests calls once for each metadata
+                calls = [(call, 1) for call in plan['metadata_calls']] + [(call, num_metadata) for call in tests_calls]
+                for (model, doc_input), repetitions in calls:
+                    prompt_tokens = model.get_num_prompt_tokens(doc_input)
+                    row['num_llm_calls'] += repetitions
+                    row['prompt_tokens'] += prompt_tokens * repetitions
+                    row['completion_tokens'] += completion_tokens_per_call * repetitions
+                    row['estimated_cost'] += estimate_llm_cost(model.model_name,
+                                                               prompt_tokens,
+                                                               completion_tokens_per_call) * repetitions
+                row['num_metadata'] += num_metadata
+                row['num_tests'] += num_metadata * len(tests_calls)
+
+            row['num_patterns'] = len(patterns)
+            llm_time = row['num_llm_calls'] * seconds_per_llm_call / function_input.max_concurrency
+            row['estimated_time'] = time.perf_counter() - start + llm_time
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def prepare_tables(self, tables: list[ConnectorTable], *args, **kwargs):
+        """
+        Called by `generate_dataset` with all the tables to generate, before generating the first one.
+        By default, it does nothing. Generators override it to batch the work of all the tables of the database
+        (e.g., the embeddings of their columns).
+        """
+
+    def plan_patterns(self, table: ConnectorTable, *args, **kwargs) -> Generator[PatternType, None, None]:
+        """
+        Yields the patterns used by `plan_dataset`. By default, the patterns of `pattern_identification`.
+        Generators whose pattern identification calls a model override it with an estimate.
+        """
+        return self.pattern_identification(table, *args, **kwargs)
+
+    def plan_llm_calls(self, pattern: PatternType, *args, **kwargs) -> dict:
+        """
+        Describes the LLM calls made by the generator for `pattern`, used by `plan_dataset`.
+
+        Args:
+            pattern (PatternType): The pattern to plan.
+            *args: Optional positional arguments.
+            **kwargs: Optional keyword arguments, with the `table` and the `sqlite_connector`.
+
+        Returns:
+            dict: A dictionary with the following keys:
+                - `metadata_calls`: the (model, prompt input) of the calls of `metadata_generator` for the pattern.
+                - `num_metadata`: the maximum number of metadata yielded for the pattern.
+                - `tests_calls`: the (model, prompt input) of the calls of `tests_generator` for one
+                  metadata, one for each test.
+
+        Raises:
+            NotImplementedError: If the generator does not support the dry run.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support the dry run')
 
     @abstractmethod
     def pattern_identification(self, table: ConnectorTable, *args, **kwargs) -> Generator[PatternType, None, None]:
@@ -248,6 +589,7 @@ class DatasetGenerator[PatternType, MetadataType, TestType](ABC):
     def read_table_generator(self,
                              sqlite_connector: SqliteConnector,
                              tbl_in_db_to_analyze: list[str] | str | None = None,
+                             tbl_name2tbls: dict[str, ConnectorTable] | None = None,
                              *args, **kwargs) -> Generator[ConnectorTable, None, None]:
         """
         Yields tables from the database that match the given table names provided or the closest matching ones.
@@ -257,6 +599,8 @@ class DatasetGenerator[PatternType, MetadataType, TestType](ABC):
                 the SQLite database.
             tbl_in_db_to_analyze (list[str] | str | None): Table names to find and read data from. If not provided
                 or None, matches the closest names available in the database.
+            tbl_name2tbls (dict[str, ConnectorTable] | None): Tables already loaded from the database. If None,
+                the tables are loaded with `sqlite_connector.load_tables_from_database()`.
             *args: Additional positional arguments for extensibility and future compatibility.
             **kwargs: Additional keyword arguments for extensibility and future compatibility.
 
@@ -264,7 +608,9 @@ class DatasetGenerator[PatternType, MetadataType, TestType](ABC):
             ConnectorTable: A table object fetched from the database matching the specified or closest table
                 names.
         """
-        tbl_name2tbls = sqlite_connector.load_tables_from_database()
+        if tbl_name2tbls is None:
+            with profile_stage('load_tables'):
+                tbl_name2tbls = sqlite_connector.load_tables_from_database()
         tbl_in_db_to_analyze = utils_find_closest_matches(tbl_in_db_to_analyze, list(tbl_name2tbls.keys()))
         for tbl_name in tbl_in_db_to_analyze:
             yield tbl_name2tbls[tbl_name]
@@ -295,7 +641,5 @@ class DatasetGenerator[PatternType, MetadataType, TestType](ABC):
         primary_keys_name += [fk['parent_column'] for fk in table.foreign_keys] if table.foreign_keys else []
         column_names = [val for val in column_names if
                         val not in primary_keys_name and
-                        'id' not in val.lower() and
-                        'code' not in val.lower() and
-                        'key' not in val.lower()]
+                        not utils_is_key_column_name(val)]
         return column_names
@@ -1,3 +1,17 @@
-from .attachment_generator import AttachmentGenerator
-from .column_ambiguity_generator import ColumnAmbiguityGenerator
-from .scope_generator import ScopeGenerator
+from typing import TYPE_CHECKING
+
+from ....lazy_imports import lazy_getattr
+
+# each generator is imported on first access, e.g., scikit-learn is only imported with ColumnAmbiguityGenerator
+_name2module = {
+    'AttachmentGenerator': '.attachment_generator',
+    'ColumnAmbiguityGenerator': '.column_ambiguity_generator',
+    'ScopeGenerator': '.scope_generator',
+}
+__all__ = list(_name2module)
+__getattr__, __dir__ = lazy_getattr(__name__, _name2module)
+
+if TYPE_CHECKING:
+    from .attachment_generator import AttachmentGenerator
+    from .column_ambiguity_generator import ColumnAmbiguityGenerator
+    from .scope_generator import ScopeGenerator
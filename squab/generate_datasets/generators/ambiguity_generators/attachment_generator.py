@@ -2,23 +2,20 @@ import random
 from collections import defaultdict
 from typing import TypeAlias, Generator, Literal
 
-from langchain_community.callbacks import get_openai_callback
 from qatch.connectors import ConnectorTable, SqliteConnector
 
-from ...utils import utils_get_db_dump_no_insert
 from .... import DatasetGenerator
-from ....models import create_default_gpt4o
-from ....models.langchain_wrapper import getter_json_output_from_resoning
+from ....models import create_default_gpt4o, UsageMeter
 
 PatternType: TypeAlias = dict[str, list[str] | float]
 MetadataType: TypeAlias = dict[str, list[str] | float]
 TestType: TypeAlias = dict[str, str | float]
 
 
-def get_random_name_column(categorical_columns):
+def get_random_name_column(categorical_columns, rng: random.Random | None = None):
     filtered_columns = [col for col in categorical_columns
                         if 'name' in col.lower() and 'unnamed' not in col.lower()]
-    return random.choice(filtered_columns) if filtered_columns else None
+    return (rng or random).choice(filtered_columns) if filtered_columns else None
 
 
 def _find_overlapping_column_values(
@@ -121,6 +118,7 @@ class AttachmentGenerator(DatasetGenerator[PatternType, MetadataType, TestType])
             """
 
     def pattern_identification(self, table: ConnectorTable, *args, **kwargs) -> Generator[PatternType, None, None]:
+        rng = kwargs.get('rng', random)
         # Get all non-PK and non-FK columns
         columns = self.get_columns_no_pk_fk(table)
         if len(columns) < 3:
@@ -128,7 +126,7 @@ class AttachmentGenerator(DatasetGenerator[PatternType, MetadataType, TestType])
 
         # Get categorical columns and choose a column to project
         categorical_columns = list(table.cat_col2metadata.keys())
-        column_to_project = get_random_name_column(categorical_columns)
+        column_to_project = get_random_name_column(categorical_columns, rng)
         if not column_to_project:
             return
         # Filter columns not related to the projected column
@@ -147,7 +145,7 @@ class AttachmentGenerator(DatasetGenerator[PatternType, MetadataType, TestType])
                     table.tbl_name, entity_column, component_column, kwargs['sqlite_connector']
                 )
                 # sample only two overlapping groups in column_1 to avoid explosion
-                sampled_entity_values = random.sample(
+                sampled_entity_values = rng.sample(
                     list(col1_val1_val2_to_values_col2.keys()),
                     min(2, len(col1_val1_val2_to_values_col2))
                 )
@@ -159,13 +157,29 @@ class AttachmentGenerator(DatasetGenerator[PatternType, MetadataType, TestType])
                         'component': component_column,
                         'column_to_project': column_to_project,
                         'entity_values': list(entity_value),
-                        'component_value': random.choice(col1_val1_val2_to_values_col2[entity_value]),
+                        'component_value': rng.choice(col1_val1_val2_to_values_col2[entity_value]),
                     }
 
     def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
         # the metadata is extracted with an Heuristics during pattern identification
         yield pattern
 
+    def plan_llm_calls(self, pattern: PatternType, *args, **kwargs) -> dict:
+        return {
+            'metadata_calls': [],
+            'num_metadata': 1,
+            'tests_calls': [(self.model_generation, self._get_generation_input(pattern, *args, **kwargs))],
+        }
+
+    def _get_generation_input(self, metadata: MetadataType, *args, **kwargs) -> dict:
+        return {
+            'ambig_definition': self.ambiguity_definition,
+            'ambig_example': self.ambiguity_examples,
+            'queries': self._build_sql_interpretations(metadata, kwargs['table'].tbl_name),
+            'metadata': metadata,
+            'database': self.get_prompt_database(**kwargs)
+        }
+
     def _build_sql_interpretations(self, metadata, tbl_name):
         component = metadata['component']
         entity = metadata['entity']
@@ -186,19 +200,12 @@ class AttachmentGenerator(DatasetGenerator[PatternType, MetadataType, TestType])
         return queries
 
     def tests_generator(self, metadata: MetadataType, *args, **kwargs) -> Generator[TestType, None, None]:
-        sql_interpretations = self._build_sql_interpretations(metadata, kwargs['table'].tbl_name)
+        generation_input = self._get_generation_input(metadata, *args, **kwargs)
 
-        with get_openai_callback() as cb:
+        with UsageMeter().activate() as usage:
             # step 1: Generate question
-            generation = self.model_generation.predict({
-                'ambig_definition': self.ambiguity_definition,
-                'ambig_example': self.ambiguity_examples,
-                'queries': sql_interpretations,
-                'metadata': metadata,
-                'database': utils_get_db_dump_no_insert(kwargs['sqlite_connector'].db_path)
-            })
-            generation = getter_json_output_from_resoning(generation)
+            generation = self.model_generation.predict_json(generation_input, required_keys=['question'])
 
         yield {'question': generation['question'],
-               'answer': sql_interpretations,
-               'question_cost': cb.total_cost}
+               'answer': generation_input['queries'],
+               'question_cost': usage.total_cost}
@@ -1,22 +1,27 @@
 import os
 import random
+from functools import cached_property
 from typing import Generator, TypeAlias, Literal
 
-from langchain_community.callbacks import get_openai_callback
-from langchain_openai.embeddings import OpenAIEmbeddings
-from qatch.connectors import ConnectorTable
+from qatch.connectors import ConnectorTable, ConnectorTableColumn
 
 from .utils import utils_combine_clusters, utils_get_top_k_index_similar_matrix
-from ...utils import utils_run_qatch, utils_get_db_dump_no_insert
+from ...utils import utils_predict_batch_until, utils_run_qatch, utils_without_costs
 from .... import DatasetGenerator
-from ....models import create_default_gpt4o
-from ....models.langchain_wrapper import getter_json_output_from_resoning
+from ....models import (create_default_gpt4o, create_default_encoder, CachedEmbeddings, IdentifierTfidfEmbeddings,
+                        UsageMeter)
+from ....profiling import profile_scope, profile_stage
 
 # Define reusable type aliases at the top
 PatternType: TypeAlias = dict[str, list[str] | float]
 MetadataType: TypeAlias = dict[str, str | float]
 TestType: TypeAlias = dict[str, str | float]
 
+ColumnSimilarityType: TypeAlias = Literal['embeddings', 'local']
+
+# minimum similarity of two columns to be ambiguous, the lexical similarity of the local backend is lower
+_COLUMN_SIMILARITY2THRESHOLD = {'embeddings': 0.60, 'local': 0.30}
+
 
 class ColumnAmbiguityGenerator(DatasetGenerator[PatternType, MetadataType, TestType]):
     """
@@ -32,7 +37,10 @@ class ColumnAmbiguityGenerator(DatasetGenerator[PatternType, MetadataType, TestT
     Attributes:
         model_generation (Any): The language model used for question generation
             to resolve query ambiguities.
-        encoder (OpenAIEmbeddings): The embedding generator for comparing
+        column_similarity (ColumnSimilarityType): How the columns are compared: `embeddings` embeds their
+            metadata with `text-embedding-3-large`, `local` compares their names with `IdentifierTfidfEmbeddings`,
+            without network access or cost.
+        encoder (Embeddings): The embedding generator for comparing
             semantics of table columns.
         metadata_generator (Any): The model used for generating labels to
             synthesize metadata for ambiguous columns.
@@ -44,16 +52,29 @@ class ColumnAmbiguityGenerator(DatasetGenerator[PatternType, MetadataType, TestT
             queries, associated metadata, and rephrased ambiguous questions.
     """
 
-    def __init__(self, seed=2023):
+    def __init__(self, seed=2023, column_similarity: ColumnSimilarityType | None = None):
+        """
+        Args:
+            seed (int): The random seed of the generator.
+            column_similarity (ColumnSimilarityType | None): How the columns are compared. If None, the value of
+                the `SQUAB_COLUMN_SIMILARITY` environment variable, `embeddings` by default.
+        """
         super().__init__(seed)
+        self.column_similarity = column_similarity or os.getenv('SQUAB_COLUMN_SIMILARITY', 'embeddings')
+        if self.column_similarity not in _COLUMN_SIMILARITY2THRESHOLD:
+            raise ValueError(f'column_similarity must be one of {list(_COLUMN_SIMILARITY2THRESHOLD)}, '
+                             f'got {self.column_similarity}')
         self.model_generation = create_default_gpt4o(hub_prompt='question_variability',
                                                      model_kwargs={'temperature': 0.5})
-        self.encoder = OpenAIEmbeddings(
-            model="text-embedding-3-large",
-            api_key=os.getenv('OPENAI_API_KEY')
-        )
         self.model_metadata = create_default_gpt4o(hub_prompt='label_columns_selector')
 
+    @cached_property
+    def encoder(self):
+        if self.column_similarity == 'local':
+            return IdentifierTfidfEmbeddings()
+        # created on first use, so that planning a dry run creates no client
+        return create_default_encoder(model="text-embedding-3-large")
+
     @property
     def test_type(self) -> Literal['ambig', 'unans']:
         return 'ambig'
@@ -116,22 +137,21 @@ class ColumnAmbiguityGenerator(DatasetGenerator[PatternType, MetadataType, TestT
             """
 
     def pattern_identification(self, table: ConnectorTable, *args, **kwargs) -> Generator[PatternType, None, None]:
-        columns = self.get_columns_no_pk_fk(table)
-        columns = [table.tbl_col2metadata[val] for val in columns]
+        columns = self._get_columns_to_compare(table)
 
         # you need at least two columns to find a pattern
         if len(columns) < 2:
             return
 
-        with get_openai_callback() as cb:
+        with UsageMeter().activate() as usage:
             similar_columns = self._get_similar_values(
                 columns,
-                threshold_similar_values=0.60
+                threshold_similar_values=_COLUMN_SIMILARITY2THRESHOLD[self.column_similarity]
             )
 
         for column_pairs in similar_columns:
             if len(column_pairs) > 1:
-                yield {'similar_cols': column_pairs, 'pattern_cost': cb.total_cost}
+                yield {'similar_cols': column_pairs, 'pattern_cost': usage.total_cost}
 
     def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
         table: ConnectorTable = kwargs['table']
@@ -139,47 +159,115 @@ class ColumnAmbiguityGenerator(DatasetGenerator[PatternType, MetadataType, TestT
 
         similar_cols = pattern['similar_cols']
 
-        with get_openai_callback() as cb:
-            label = self.model_metadata.predict({
+        with UsageMeter().activate() as usage:
+            label = self.model_metadata.predict_json({
                 'tbl_schema': tbl_schema,
                 'cols': similar_cols
-            })
-            label = getter_json_output_from_resoning(label)
+            }, required_keys=['label'])
 
             if 'label' not in label or any(label['label'].lower() == col.lower() for col in tbl_schema):
                 return
 
-        yield {'hypernym': label['label'], 'metadata_cost': cb.total_cost}
+        yield {'hypernym': label['label'], 'metadata_cost': usage.total_cost}
 
     def tests_generator(self, metadata: MetadataType, *args, **kwargs) -> Generator[TestType, None, None]:
         similar_cols = kwargs['pattern']['similar_cols']
         # randomly select one col in similar cols
-        selected_col = random.choice(similar_cols)
+        rng = kwargs.get('rng', random)
+        selected_col = rng.choice(similar_cols)
 
         list_queries_with_selected_col = utils_run_qatch(sqlite_connector=kwargs['sqlite_connector'],
                                                          selected_col=selected_col,
-                                                         tbl_name=kwargs['table'].tbl_name)
-
-        for test_category_query_question_dict in list_queries_with_selected_col:
-            sql_interpretations = self._build_sql_interpretations(test_category_query_question_dict['query'],
-                                                                  similar_cols,
-                                                                  selected_col)
-            with get_openai_callback() as cb:
-                generation = self.model_generation.predict({
-                    'ambig_definition': self.ambiguity_definition,
-                    'ambig_example': self.ambiguity_examples,
-                    'queries': sql_interpretations,
-                    'metadata': metadata,
-                    'database': utils_get_db_dump_no_insert(kwargs['sqlite_connector'].db_path),
-                })
-                generation = getter_json_output_from_resoning(generation)
+                                                         table=kwargs['table'],
+                                                         rng=kwargs.get('rng'))
+
+        # one question for each QATCH query, the questions are generated in batches until `max_questions` succeed
+        query_dicts_interpretations = [
+            (test_category_query_question_dict,
+             self._build_sql_interpretations(test_category_query_question_dict['query'], similar_cols, selected_col))
+            for test_category_query_question_dict in list_queries_with_selected_col
+        ]
+        generations, question_cost = utils_predict_batch_until(
+            self.model_generation,
+            query_dicts_interpretations,
+            lambda item: self._get_generation_input(item[1], metadata, *args, **kwargs),
+            max_outputs=kwargs.get('max_questions'),
+            required_keys=['question'],
+            max_concurrency=kwargs.get('max_concurrency'),
+            output_name='COLUMN AMBIGUITY question'
+        )
 
+        for (test_category_query_question_dict, sql_interpretations), generation in generations:
             yield {'question': generation['question'],
                    'question_template': test_category_query_question_dict['question'].replace(selected_col,
                                                                                               metadata['hypernym']),
                    'answer': sql_interpretations,
                    'sql_tag': test_category_query_question_dict['test_category'],
-                   'question_cost': cb.total_cost}
+                   'question_cost': question_cost}
+
+    def _get_generation_input(self, sql_interpretations: list[str], metadata: MetadataType, *args, **kwargs) -> dict:
+        return {
+            'ambig_definition': self.ambiguity_definition,
+            'ambig_example': self.ambiguity_examples,
+            'queries': sql_interpretations,
+            'metadata': utils_without_costs(metadata),
+            'database': self.get_prompt_database(**kwargs),
+        }
+
+    def plan_patterns(self, table: ConnectorTable, *args, **kwargs) -> Generator[PatternType, None, None]:
+        # the similar columns are found with the embeddings, the plan pairs the candidate columns in order
+        columns = self.get_columns_no_pk_fk(table)
+        for i in range(0, len(columns) - 1, 2):
+            yield {'similar_cols': columns[i:i + 2]}
+
+    def plan_llm_calls(self, pattern: PatternType, *args, **kwargs) -> dict:
+        table: ConnectorTable = kwargs['table']
+        similar_cols = pattern['similar_cols']
+        selected_col = similar_cols[0]
+        list_queries_with_selected_col = utils_run_qatch(sqlite_connector=kwargs['sqlite_connector'],
+                                                         selected_col=selected_col,
+                                                         table=table,
+                                                         rng=kwargs.get('rng'))
+        return {
+            'metadata_calls': [(self.model_metadata, {'tbl_schema': list(table.tbl_col2metadata.keys()),
+                                                      'cols': similar_cols})],
+            'num_metadata': 1,
+            'tests_calls': [(self.model_generation, self._get_generation_input(
+                self._build_sql_interpretations(query_dict['query'], similar_cols, selected_col),
+                {'hypernym': selected_col},
+                *args, **kwargs
+            )) for query_dict in list_queries_with_selected_col],
+        }
+
+    def prepare_tables(self, tables: list[ConnectorTable], *args, **kwargs):
+        """
+        Embeds in large batches the columns compared by `pattern_identification` in all the `tables`, before
+        their generation.
+
+        The distinct columns of the tables of the database are sent to the embedding model together, in batches
+        of the maximum size of a request, instead of one small request for each table. The embeddings are stored
+        in the persistent cache of the encoder (see `CachedEmbeddings`), where `pattern_identification` reads them.
+        Nothing is done if the encoder has no cache (e.g., without `SQUAB_EMBEDDING_CACHE_DIR`, with the offline
+        backend or the `local` column similarity).
+        """
+        if not isinstance(self.encoder, CachedEmbeddings):
+            return
+        texts = []
+        for table in tables:
+            columns = self._get_columns_to_compare(table)
+            if len(columns) >= 2:
+                texts += self._get_embedding_texts(columns)
+        with profile_stage('embeddings'):
+            self.encoder.prefetch(texts)
+
+    def _get_columns_to_compare(self, table: ConnectorTable) -> list[ConnectorTableColumn]:
+        return [table.tbl_col2metadata[val] for val in self.get_columns_no_pk_fk(table)]
+
+    def _get_embedding_texts(self, columns: list[ConnectorTableColumn]) -> list[str]:
+        if self.column_similarity == 'local':
+            return [col.column_name for col in columns]
+        # the metadata of the column (name, type and sample data) is embedded, not only its name
+        return [f'{col}' for col in columns]
 
     def _get_similar_values(self,
                             values: list[str],
@@ -187,7 +275,7 @@ class ColumnAmbiguityGenerator(DatasetGenerator[PatternType, MetadataType, TestT
                             ) -> list[list[str]]:
         at_most_k = int(len(values) / 2)
         at_most_k = 2 if at_most_k < 2 else at_most_k
-        parsed_columns = [f'{col}' for col in values]
+        parsed_columns = self._get_embedding_texts(values)
 
         vals_embeddings = self.encoder.embed_documents(parsed_columns)
 
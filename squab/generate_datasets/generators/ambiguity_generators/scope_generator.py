@@ -2,13 +2,11 @@ import logging
 from typing import Generator, TypeAlias, Literal
 
 import pandas as pd
-from langchain_community.callbacks import get_openai_callback
 from qatch.connectors import ConnectorTable
 
-from ...utils import utils_syntactic_match, utils_get_db_dump_no_insert
+from ...utils import utils_syntactic_match
 from .... import DatasetGenerator
-from ....models import create_default_gpt4o
-from ....models.langchain_wrapper import getter_json_output_from_resoning
+from ....models import create_default_gpt4o, UsageMeter
 
 PatternType: TypeAlias = dict[str, list[str] | float]
 MetadataType: TypeAlias = dict[str, str | float]
@@ -88,8 +86,8 @@ class ScopeGenerator(DatasetGenerator):
 
     def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
         many_to_many_columns = pattern['columns_in_many_2_many']
-        entity_component_json = self.model_metadata.predict({'names': ','.join(many_to_many_columns)})
-        entity_component_json = getter_json_output_from_resoning(entity_component_json)
+        entity_component_json = self.model_metadata.predict_json({'names': ','.join(many_to_many_columns)},
+                                                                 required_keys=['entity', 'component'])
         if 'entity' not in entity_component_json or 'component' not in entity_component_json:
             return
         elif entity_component_json['entity'] is None and entity_component_json['component'] is None:
@@ -110,6 +108,25 @@ class ScopeGenerator(DatasetGenerator):
             many_to_many_columns[0],
         }
 
+    def plan_llm_calls(self, pattern: PatternType, *args, **kwargs) -> dict:
+        # the entity and the component are chosen by the LLM, any order of the columns has the same prompt size
+        entity, component = pattern['columns_in_many_2_many']
+        return {
+            'metadata_calls': [(self.model_metadata, {'names': ','.join(pattern['columns_in_many_2_many'])})],
+            'num_metadata': 1,
+            'tests_calls': [(self.model_generation,
+                             self._get_generation_input({'entity': entity, 'component': component}, *args, **kwargs))],
+        }
+
+    def _get_generation_input(self, metadata: MetadataType, *args, **kwargs) -> dict:
+        return {
+            'ambig_definition': self.ambiguity_definition,
+            'ambig_example': self.ambiguity_examples,
+            'queries': self._build_sql_interpretations(metadata, kwargs['table'].tbl_name),
+            'metadata': metadata,
+            'database': self.get_prompt_database(**kwargs)
+        }
+
     def _build_sql_interpretations(self, metadata, tbl_name):
         component = metadata['component']
         entity = metadata['entity']
@@ -128,18 +145,11 @@ class ScopeGenerator(DatasetGenerator):
         return [query_1, query_2]
 
     def tests_generator(self, metadata: MetadataType, *args, **kwargs) -> Generator[TestType, None, None]:
-        sql_interpretations = self._build_sql_interpretations(metadata, kwargs['table'].tbl_name)
+        generation_input = self._get_generation_input(metadata, *args, **kwargs)
 
-        with get_openai_callback() as cb:
+        with UsageMeter().activate() as usage:
             # step 1: Generate question
-            generation = self.model_generation.predict({
-                'ambig_definition': self.ambiguity_definition,
-                'ambig_example': self.ambiguity_examples,
-                'queries': sql_interpretations,
-                'metadata': metadata,
-                'database': utils_get_db_dump_no_insert(kwargs['sqlite_connector'].db_path)
-            })
-            generation = getter_json_output_from_resoning(generation)
+            generation = self.model_generation.predict_json(generation_input, required_keys=['question'])
         yield {'question': generation['question'],
-               'answer': sql_interpretations,
-               'question_cost': cb.total_cost}
+               'answer': generation_input['queries'],
+               'question_cost': usage.total_cost}
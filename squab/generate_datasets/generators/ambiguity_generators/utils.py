@@ -1,6 +1,5 @@
 import numpy as np
 from qatch.connectors import ConnectorTableColumn
-from sklearn.metrics import pairwise_distances
 
 
 def utils_combine_clusters(clusters: dict[str, list]) -> dict[str, list[ConnectorTableColumn]]:
@@ -29,6 +28,14 @@ def utils_combine_clusters(clusters: dict[str, list]) -> dict[str, list[Connecto
 
 
 def utils_get_pairwise_similarity_metric(values: list[list[float]], metric='cosine'):
+    if metric == 'cosine':
+        # same values of scikit-learn, without its overhead on the few columns of a table
+        vectors = np.asarray(values, dtype=np.float64)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        return np.clip(vectors @ vectors.T, -1, 1)
+    # imported here, scikit-learn takes longer to import than most of the runs need it for
+    from sklearn.metrics import pairwise_distances
     pairwise_distance_matrix = pairwise_distances(values, values, metric=metric)
     return 1 - pairwise_distance_matrix
 
@@ -1,3 +1,17 @@
-from .calculation_unanswerable import CalculationUnanswerableGenerator
-from .column_unanswerable import ColumnUnanswerableGenerator
-from .out_of_scope import OutOfScopeGenerator
+from typing import TYPE_CHECKING
+
+from ....lazy_imports import lazy_getattr
+
+# each generator is imported on first access
+_name2module = {
+    'CalculationUnanswerableGenerator': '.calculation_unanswerable',
+    'ColumnUnanswerableGenerator': '.column_unanswerable',
+    'OutOfScopeGenerator': '.out_of_scope',
+}
+__all__ = list(_name2module)
+__getattr__, __dir__ = lazy_getattr(__name__, _name2module)
+
+if TYPE_CHECKING:
+    from .calculation_unanswerable import CalculationUnanswerableGenerator
+    from .column_unanswerable import ColumnUnanswerableGenerator
+    from .out_of_scope import OutOfScopeGenerator
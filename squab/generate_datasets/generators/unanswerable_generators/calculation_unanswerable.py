@@ -3,13 +3,12 @@ import re
 from typing import Generator, TypeAlias, Literal
 
 import sqlalchemy
-from langchain_community.callbacks import get_openai_callback
 from qatch.connectors import ConnectorTable, SqliteConnector
 from sqlalchemy import text
 
-from ...utils import utils_run_qatch, utils_get_db_dump_no_insert
+from ...utils import utils_run_qatch, utils_without_costs
 from .... import DatasetGenerator
-from ....models import create_default_gpt4o
+from ....models import create_default_gpt4o, UsageMeter
 from ....models.langchain_wrapper import getter_json_output_from_resoning
 
 PatternType: TypeAlias = dict[str, list[str] | float]
@@ -97,69 +96,98 @@ class CalculationUnanswerableGenerator(DatasetGenerator):
         return 'calculation_unanswerable'
 
     def pattern_identification(self, table: ConnectorTable, *args, **kwargs) -> Generator[PatternType, None, None]:
+        rng = kwargs.get('rng', random)
         yield {
             'tbl_schema': list(table.tbl_col2metadata.keys()),
-            'cat_col': random.choice(list(table.cat_col2metadata.keys())) if table.cat_col2metadata else None,
-            'num_col': random.choice(list(table.num_col2metadata.keys())) if table.num_col2metadata else None,
+            'cat_col': rng.choice(list(table.cat_col2metadata.keys())) if table.cat_col2metadata else None,
+            'num_col': rng.choice(list(table.num_col2metadata.keys())) if table.num_col2metadata else None,
         }
 
-    def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
-        cat_col = pattern.pop('cat_col')
-        num_col = pattern.pop('num_col')
-        tbl_schema = pattern['tbl_schema']
-
-        if cat_col is None:
+    def _get_metadata_input(self, pattern: PatternType, *args, **kwargs) -> dict:
+        if pattern['cat_col'] is None:
             num_to_generate = f'2 UDFs with "udf_output_type" numerical'
 
-        elif num_col is None:
+        elif pattern['num_col'] is None:
             num_to_generate = f'2 UDFs with "udf_output_type" categorical'
 
         else:
             # TODO make it programmable
             num_to_generate = f'2 UDFs with "udf_output_type" mixed (categorical and numerical)'
+        return {
+            'tbl_schema': pattern['tbl_schema'],
+            'num_to_generate': num_to_generate
+        }
 
-        with get_openai_callback() as cb:
-            llm_udf = self.model_unans_udf_generator.predict({
-                'tbl_schema': tbl_schema,
-                'num_to_generate': num_to_generate
-            })
-            udfs = llm_udf.split("# New UDF")
-            for udf in udfs:
-                # extract UDF
-                udf_json = getter_json_output_from_resoning(udf)
-                if 'udf_name' not in udf_json['generated_udf'] or 'udf_output_type' not in udf_json['generated_udf']:
-                    continue
-                # Extract Code
-                python_matches = re.findall(r'```python.*?```', udf, re.DOTALL)
-                if len(python_matches) == 0:
-                    continue
-                code = python_matches[-1].replace('```', '').replace('python', '')
-                selected_col = cat_col if udf_json['udf_output_type'] == 'categorical' else num_col
+    def _get_question_input(self, unans_query: str, metadata: MetadataType, *args, **kwargs) -> dict:
+        return {
+            'examples': '',  # TODO add examples
+            'queries': unans_query,
+            'metadata': utils_without_costs(metadata),
+            'database': self.get_prompt_database(**kwargs),
+        }
 
-                yield {'udf_name': udf_json['generated_udf']['udf_name'],
-                       'udf_python_code': code,
-                       'udf_output_type': udf_json['generated_udf']['udf_output_type'],
-                       'udf_generation_cost': cb.total_cost / len(udfs),
-                       'col_to_use_for_generation': selected_col}
+    def plan_llm_calls(self, pattern: PatternType, *args, **kwargs) -> dict:
+        # the QATCH queries are built on the categorical column when available, otherwise on the numerical one
+        selected_col = pattern['cat_col'] or pattern['num_col']
+        list_queries_with_selected_col = utils_run_qatch(sqlite_connector=kwargs['sqlite_connector'],
+                                                         selected_col=selected_col,
+                                                         table=kwargs['table'],
+                                                         rng=kwargs.get('rng')) if selected_col else []
+        metadata = {'udf_name': f'udf({selected_col})',
+                    'udf_output_type': 'categorical' if pattern['cat_col'] else 'numerical',
+                    'col_to_use_for_generation': selected_col}
+        return {
+            'metadata_calls': [(self.model_unans_udf_generator, self._get_metadata_input(pattern, *args, **kwargs))],
+            'num_metadata': 2,
+            'tests_calls': [(self.model_question_generator,
+                             self._get_question_input(query_dict['query'], metadata, *args, **kwargs))
+                            for query_dict in list_queries_with_selected_col],
+        }
+
+    def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
+        cat_col = pattern['cat_col']
+        num_col = pattern['num_col']
+
+        with UsageMeter().activate() as usage:
+            llm_udf = self.model_unans_udf_generator.predict(self._get_metadata_input(pattern, *args, **kwargs))
+
+        udfs = llm_udf.split("# New UDF")
+        for udf in udfs:
+            # extract UDF
+            udf_json = getter_json_output_from_resoning(udf)
+            # the UDF can be nested in `generated_udf` or returned as in the example of the prompt
+            udf_json = udf_json.get('generated_udf', udf_json)
+            if 'udf_name' not in udf_json or 'udf_output_type' not in udf_json:
+                continue
+            # Extract Code
+            python_matches = re.findall(r'```python.*?```', udf, re.DOTALL)
+            if len(python_matches) == 0:
+                continue
+            code = python_matches[-1].replace('```', '').replace('python', '')
+            selected_col = cat_col if udf_json['udf_output_type'] == 'categorical' else num_col
+
+            yield {'udf_name': udf_json['udf_name'],
+                   'udf_python_code': code,
+                   'udf_output_type': udf_json['udf_output_type'],
+                   'udf_generation_cost': usage.total_cost / len(udfs),
+                   'col_to_use_for_generation': selected_col}
 
     def tests_generator(self, metadata: MetadataType, *args, **kwargs) -> Generator[TestType, None, None]:
         col_to_use_for_generation = metadata['col_to_use_for_generation']
         list_queries_with_selected_col = utils_run_qatch(sqlite_connector=kwargs['sqlite_connector'],
                                                          selected_col=col_to_use_for_generation,
-                                                         tbl_name=kwargs['table'].tbl_name)
+                                                         table=kwargs['table'],
+                                                         rng=kwargs.get('rng'))
 
         for test_category_query_question_dict in list_queries_with_selected_col:
             unans_query = test_category_query_question_dict['query'].replace(f'`{col_to_use_for_generation}`',
                                                                              f"{metadata['udf_name']}")
-            if check_unanswerability_query(unans_query, metadata['udf_python_code'], kwargs['sqlite_connector']):
-                with get_openai_callback() as cb:
-                    generated_question = self.model_question_generator.predict({
-                        'examples': '',  # TODO add examples
-                        'queries': unans_query,
-                        'metadata': metadata,
-                        'database': utils_get_db_dump_no_insert(kwargs['sqlite_connector'].db_path),
-                    })
-                generated_question = getter_json_output_from_resoning(generated_question)
+            if check_unanswerability_query(unans_query, metadata['udf_python_code'], metadata['udf_name'],
+                                           kwargs['sqlite_connector']):
+                with UsageMeter().activate() as usage:
+                    generated_question = self.model_question_generator.predict_json(
+                        self._get_question_input(unans_query, metadata, *args, **kwargs), required_keys=['question']
+                    )
                 if 'question' not in generated_question:
                     continue
                 udf_name = metadata['udf_name'].split('(')[0]
@@ -170,4 +198,4 @@ class CalculationUnanswerableGenerator(DatasetGenerator):
                        'answer': 'UNANSWERABLE',
                        'query': unans_query,
                        'sql_tag': test_category_query_question_dict['test_category'],
-                       'question_cost': cb.total_cost}
+                       'question_cost': usage.total_cost}
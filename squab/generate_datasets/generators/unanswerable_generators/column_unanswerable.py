@@ -2,13 +2,11 @@ import random
 from typing import TypeAlias, Generator, Literal
 
 import sqlalchemy
-from langchain_community.callbacks import get_openai_callback
 from qatch.connectors import ConnectorTable, SqliteConnector
 
-from ...utils import utils_run_qatch, utils_get_db_dump_no_insert
+from ...utils import utils_predict_batch_until, utils_run_qatch
 from .... import DatasetGenerator
 from ....models import create_default_gpt4o
-from ....models.langchain_wrapper import getter_json_output_from_resoning
 
 PatternType: TypeAlias = dict[str, list[str] | float]
 MetadataType: TypeAlias = dict[str, str | float]
@@ -42,33 +40,62 @@ class ColumnUnanswerableGenerator(DatasetGenerator):
         return 'column_unanswerable'
 
     def pattern_identification(self, table: ConnectorTable, *args, **kwargs) -> Generator[PatternType, None, None]:
+        rng = kwargs.get('rng', random)
         yield {
             'tbl_schema': list(table.tbl_col2metadata.keys()),
-            'cat_col': random.choice(list(table.cat_col2metadata.keys())) if table.cat_col2metadata else None,
-            'num_col': random.choice(list(table.num_col2metadata.keys())) if table.num_col2metadata else None,
+            'cat_col': rng.choice(list(table.cat_col2metadata.keys())) if table.cat_col2metadata else None,
+            'num_col': rng.choice(list(table.num_col2metadata.keys())) if table.num_col2metadata else None,
         }
 
-    def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
-        cat_col = pattern.pop('cat_col')
-        num_col = pattern.pop('num_col')
-
-        if cat_col is None:
+    def _get_metadata_input(self, pattern: PatternType, *args, **kwargs) -> dict:
+        if pattern['cat_col'] is None:
             num_to_generate = f'5 numerical data type'
-        elif num_col is None:
+        elif pattern['num_col'] is None:
             num_to_generate = f'5 categorical data type'
         else:
             # TODO make it programmable
             num_to_generate = f'5'
+        return {
+            'num_to_generate': num_to_generate,
+            'db_name': kwargs['sqlite_connector'].db_name,
+            'tbl_name': kwargs['table'].tbl_name,
+            'tbl_schema': pattern['tbl_schema']
+        }
+
+    def _get_question_input(self, unans_query: str, metadata: MetadataType, *args, **kwargs) -> dict:
+        return {
+            'examples': '',  # TODO add examples
+            'queries': unans_query,
+            'metadata': metadata,
+            'database': self.get_prompt_database(**kwargs),
+        }
+
+    def plan_llm_calls(self, pattern: PatternType, *args, **kwargs) -> dict:
+        # the QATCH queries are built on the categorical column when available, otherwise on the numerical one
+        selected_col = pattern['cat_col'] or pattern['num_col']
+        list_queries_with_selected_col = utils_run_qatch(sqlite_connector=kwargs['sqlite_connector'],
+                                                         selected_col=selected_col,
+                                                         table=kwargs['table'],
+                                                         rng=kwargs.get('rng')) if selected_col else []
+        metadata = {'new_column_name': selected_col,
+                    'new_column_type': 'categorical' if pattern['cat_col'] else 'numerical',
+                    'col_to_use_for_generation': selected_col}
+        return {
+            'metadata_calls': [(self.model_unans_col_generator, self._get_metadata_input(pattern, *args, **kwargs))],
+            'num_metadata': 5,
+            'tests_calls': [(self.model_question_generator,
+                             self._get_question_input(query_dict['query'], metadata, *args, **kwargs))
+                            for query_dict in list_queries_with_selected_col],
+        }
+
+    def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
+        cat_col = pattern['cat_col']
+        num_col = pattern['num_col']
 
-        with get_openai_callback() as cb:
-            llm_new_cols = self.model_unans_col_generator.predict({
-                'num_to_generate': num_to_generate,
-                'db_name': kwargs['sqlite_connector'].db_name,
-                'tbl_name': kwargs['table'].tbl_name,
-                'tbl_schema': pattern['tbl_schema']
-            })
+        llm_new_cols = self.model_unans_col_generator.predict_json(
+            self._get_metadata_input(pattern, *args, **kwargs), required_keys=['suggested_columns']
+        )
 
-        llm_new_cols = getter_json_output_from_resoning(llm_new_cols)
         if 'suggested_columns' not in llm_new_cols:
             return
 
@@ -90,27 +117,33 @@ class ColumnUnanswerableGenerator(DatasetGenerator):
         col_to_use_for_generation = metadata['col_to_use_for_generation']
         list_queries_with_selected_col = utils_run_qatch(sqlite_connector=kwargs['sqlite_connector'],
                                                          selected_col=col_to_use_for_generation,
-                                                         tbl_name=kwargs['table'].tbl_name)
+                                                         table=kwargs['table'],
+                                                         rng=kwargs.get('rng'))
+        # the unanswerable queries are checked on the database, then their questions are generated in batches
+        # until `max_questions` succeed
+        query_dicts_unans_queries = []
         for test_category_query_question_dict in list_queries_with_selected_col:
             unans_query = test_category_query_question_dict['query'].replace(f'`{col_to_use_for_generation}`',
                                                                              f"`{metadata['new_column_name']}`")
             if check_unanswerability_query(unans_query, kwargs['sqlite_connector']):
-                with get_openai_callback() as cb:
-                    generated_question = self.model_question_generator.predict({
-                        'examples': '',  # TODO add examples
-                        'queries': unans_query,
-                        'metadata': metadata,
-                        'database': utils_get_db_dump_no_insert(kwargs['sqlite_connector'].db_path),
-                    })
-                generated_question = getter_json_output_from_resoning(generated_question)
-                if 'question' not in generated_question:
-                    continue
-
-                question_template = test_category_query_question_dict['question'].replace(col_to_use_for_generation,
-                                                                                          metadata['new_column_name'])
-                yield {'question': generated_question['question'],
-                       'question_template': question_template,
-                       'query': unans_query,
-                       'answer': 'UNANSWERABLE',
-                       'sql_tag': test_category_query_question_dict['test_category'],
-                       'question_cost': cb.total_cost}
+                query_dicts_unans_queries.append((test_category_query_question_dict, unans_query))
+
+        generated_questions, question_cost = utils_predict_batch_until(
+            self.model_question_generator,
+            query_dicts_unans_queries,
+            lambda item: self._get_question_input(item[1], metadata, *args, **kwargs),
+            max_outputs=kwargs.get('max_questions'),
+            required_keys=['question'],
+            max_concurrency=kwargs.get('max_concurrency'),
+            output_name='COLUMN UNANSWERABLE question'
+        )
+
+        for (test_category_query_question_dict, unans_query), generated_question in generated_questions:
+            question_template = test_category_query_question_dict['question'].replace(col_to_use_for_generation,
+                                                                                      metadata['new_column_name'])
+            yield {'question': generated_question['question'],
+                   'question_template': question_template,
+                   'query': unans_query,
+                   'answer': 'UNANSWERABLE',
+                   'sql_tag': test_category_query_question_dict['test_category'],
+                   'question_cost': question_cost}
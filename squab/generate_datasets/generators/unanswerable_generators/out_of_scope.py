@@ -2,13 +2,11 @@ import random
 from typing import Generator, TypeAlias, Literal
 
 import sqlalchemy
-from langchain_community.callbacks import get_openai_callback
 from qatch.connectors import ConnectorTable, SqliteConnector
 
-from ...utils import utils_run_qatch, utils_get_db_dump_no_insert
+from ...utils import utils_run_qatch, utils_without_costs
 from .... import DatasetGenerator
-from ....models import create_default_gpt4o
-from ....models.langchain_wrapper import getter_json_output_from_resoning
+from ....models import create_default_gpt4o, UsageMeter
 
 PatternType: TypeAlias = dict[str, list[str] | float]
 MetadataType: TypeAlias = dict[str, str | float]
@@ -43,70 +41,96 @@ class OutOfScopeGenerator(DatasetGenerator):
         return 'UDF_unans_oos'
 
     def pattern_identification(self, table: ConnectorTable, *args, **kwargs) -> Generator[PatternType, None, None]:
+        rng = kwargs.get('rng', random)
         yield {
             'tbl_schema': list(table.tbl_col2metadata.keys()),
-            'cat_col': random.choice(list(table.cat_col2metadata.keys())) if table.cat_col2metadata else None,
-            'num_col': random.choice(list(table.num_col2metadata.keys())) if table.num_col2metadata else None,
+            'cat_col': rng.choice(list(table.cat_col2metadata.keys())) if table.cat_col2metadata else None,
+            'num_col': rng.choice(list(table.num_col2metadata.keys())) if table.num_col2metadata else None,
         }
 
-    def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
-        cat_col = pattern.pop('cat_col')
-        num_col = pattern.pop('num_col')
-        tbl_schema = pattern['tbl_schema']
-
-        if cat_col is None:
+    def _get_metadata_input(self, pattern: PatternType, *args, **kwargs) -> dict:
+        if pattern['cat_col'] is None:
             num_to_generate = f'2 UDFs with "udf_output_type" numerical'
 
-        elif num_col is None:
+        elif pattern['num_col'] is None:
             num_to_generate = f'2 UDFs with "udf_output_type" categorical'
 
         else:
             # TODO make it programmable
             num_to_generate = f'2 UDFs with "udf_output_type" mixed (categorical and numerical)'
+        return {
+            'tbl_schema': pattern['tbl_schema'],
+            'num_to_generate': num_to_generate
+        }
 
-        with get_openai_callback() as cb:
-            llm_udf = self.model_unans_udf_generator.predict({
-                'tbl_schema': tbl_schema,
-                'num_to_generate': num_to_generate
-            })
+    def _get_question_input(self, unans_query: str, metadata: MetadataType, *args, **kwargs) -> dict:
+        return {
+            'examples': '',  # TODO add examples
+            'queries': unans_query,
+            'metadata': utils_without_costs(metadata),
+            'database': self.get_prompt_database(**kwargs),
+        }
 
-            if 'suggested_udfs' not in llm_udf and not isinstance(llm_udf['suggested_udfs'], list):
-                return
+    def plan_llm_calls(self, pattern: PatternType, *args, **kwargs) -> dict:
+        # the QATCH queries are built on the categorical column when available, otherwise on the numerical one
+        selected_col = pattern['cat_col'] or pattern['num_col']
+        list_queries_with_selected_col = utils_run_qatch(sqlite_connector=kwargs['sqlite_connector'],
+                                                         selected_col=selected_col,
+                                                         table=kwargs['table'],
+                                                         rng=kwargs.get('rng')) if selected_col else []
+        metadata = {'udf_name': f'udf({selected_col})',
+                    'udf_output_type': 'categorical' if pattern['cat_col'] else 'numerical',
+                    'col_to_use_for_generation': selected_col}
+        return {
+            'metadata_calls': [(self.model_unans_udf_generator, self._get_metadata_input(pattern, *args, **kwargs))],
+            'num_metadata': 2,
+            'tests_calls': [(self.model_question_generator,
+                             self._get_question_input(query_dict['query'], metadata, *args, **kwargs))
+                            for query_dict in list_queries_with_selected_col],
+        }
 
-            cost = cb.total_cost / len(llm_udf['suggested_udfs'])
-            for udf in llm_udf['suggested_udfs']:
-                if 'udf_name' not in udf or 'udf_output_type' not in udf:
-                    continue
-                if udf['udf_output_type'] == 'categorical' and cat_col is None:
-                    continue
-                if udf['udf_output_type'] == 'numerical' and num_col is None:
-                    continue
+    def metadata_generator(self, pattern: PatternType, *args, **kwargs) -> Generator[MetadataType, None, None]:
+        cat_col = pattern['cat_col']
+        num_col = pattern['num_col']
+
+        with UsageMeter().activate() as usage:
+            llm_udf = self.model_unans_udf_generator.predict_json(self._get_metadata_input(pattern, *args, **kwargs),
+                                                                  required_keys=['suggested_udfs'])
+
+        if not isinstance(llm_udf.get('suggested_udfs'), list) or len(llm_udf['suggested_udfs']) == 0:
+            return
+
+        cost = usage.total_cost / len(llm_udf['suggested_udfs'])
+        for udf in llm_udf['suggested_udfs']:
+            if 'udf_name' not in udf or 'udf_output_type' not in udf:
+                continue
+            if udf['udf_output_type'] == 'categorical' and cat_col is None:
+                continue
+            if udf['udf_output_type'] == 'numerical' and num_col is None:
+                continue
 
-                selected_col = cat_col if udf['udf_output_type'] == 'categorical' else num_col
+            selected_col = cat_col if udf['udf_output_type'] == 'categorical' else num_col
 
-                yield {'udf_name': udf['udf_name'],
-                       'udf_output_type': udf['udf_output_type'],
-                       'udf_generation_cost': cost,
-                       'col_to_use_for_generation': selected_col}
+            yield {'udf_name': udf['udf_name'],
+                   'udf_output_type': udf['udf_output_type'],
+                   'udf_generation_cost': cost,
+                   'col_to_use_for_generation': selected_col}
 
     def tests_generator(self, metadata: MetadataType, *args, **kwargs) -> Generator[TestType, None, None]:
         col_to_use_for_generation = metadata['col_to_use_for_generation']
         list_queries_with_selected_col = utils_run_qatch(sqlite_connector=kwargs['sqlite_connector'],
                                                          selected_col=col_to_use_for_generation,
-                                                         tbl_name=kwargs['table'].tbl_name)
+                                                         table=kwargs['table'],
+                                                         rng=kwargs.get('rng'))
 
         for test_category_query_question_dict in list_queries_with_selected_col:
             unans_query = test_category_query_question_dict['query'].replace(f'`{col_to_use_for_generation}`',
                                                                              f"{metadata['udf_name']}")
             if check_unanswerability_query(unans_query, kwargs['sqlite_connector']):
-                with get_openai_callback() as cb:
-                    generated_question = self.model_question_generator.predict({
-                        'examples': '',  # TODO add examples
-                        'queries': unans_query,
-                        'metadata': metadata,
-                        'database': utils_get_db_dump_no_insert(kwargs['sqlite_connector'].db_path),
-                    })
-                generated_question = getter_json_output_from_resoning(generated_question)
+                with UsageMeter().activate() as usage:
+                    generated_question = self.model_question_generator.predict_json(
+                        self._get_question_input(unans_query, metadata, *args, **kwargs), required_keys=['question']
+                    )
                 if 'question' not in generated_question:
                     continue
 
@@ -118,4 +142,4 @@ class OutOfScopeGenerator(DatasetGenerator):
                        'answer': 'UNANSWERABLE',
                        'query': unans_query,
                        'sql_tag': test_category_query_question_dict['test_category'],
-                       'question_cost': cb.total_cost}
+                       'question_cost': usage.total_cost}
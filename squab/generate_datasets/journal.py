@@ -0,0 +1,126 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Literal
+
+
+class RunJournal:
+    """
+    Persistent journal of the completed generation units, stored in a local SQLite file.
+
+    A generation run is split in units: the metadata generated for a pattern, and the tests generated
+    for a (pattern, metadata) pair. Each unit is keyed by the database path, the table name, the test
+    category, the seed, the pattern and the metadata. When a run is restarted with the same journal,
+    the completed units are read from the journal instead of calling the LLMs again, and the generation
+    continues from the first missing unit.
+
+    The journal can be shared by multiple threads and by multiple processes writing the same file.
+
+    Attributes:
+        path (str): The path of the SQLite file of the journal.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The path of the SQLite file. It is created if it does not exist.
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS units ('
+            'db_path TEXT NOT NULL, '
+            'tbl_name TEXT NOT NULL, '
+            'test_category TEXT NOT NULL, '
+            'seed TEXT NOT NULL, '
+            'stage TEXT NOT NULL, '
+            'pattern TEXT NOT NULL, '
+            'metadata TEXT NOT NULL, '
+            'output TEXT NOT NULL, '
+            'PRIMARY KEY (db_path, tbl_name, test_category, seed, stage, pattern, metadata))'
+        )
+
+    def get(self,
+            db_path: str,
+            tbl_name: str,
+            test_category: str,
+            seed,
+            stage: Literal['metadata', 'tests'],
+            pattern: dict,
+            metadata: dict | None = None) -> list | None:
+        """
+        Returns the output of a completed unit, or None if the unit is not in the journal.
+
+        Args:
+            db_path (str): The path of the database.
+            tbl_name (str): The name of the table.
+            test_category (str): The test category of the generator.
+            seed: The seed of the generator.
+            stage (Literal['metadata', 'tests']): The stage of the unit.
+            pattern (dict): The pattern of the unit.
+            metadata (dict | None): The metadata of the unit. None for the `metadata` stage.
+
+        Returns:
+            list | None: The list of generated metadata or tests, None if the unit was never completed.
+        """
+        key = self._key(db_path, tbl_name, test_category, seed, stage, pattern, metadata)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT output FROM units WHERE db_path = ? AND tbl_name = ? AND test_category = ? AND seed = ? '
+                'AND stage = ? AND pattern = ? AND metadata = ?',
+                key
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self,
+            db_path: str,
+            tbl_name: str,
+            test_category: str,
+            seed,
+            stage: Literal['metadata', 'tests'],
+            pattern: dict,
+            metadata: dict | None,
+            output: list):
+        """
+        Records the output of a completed unit.
+
+        Args:
+            db_path (str): The path of the database.
+            tbl_name (str): The name of the table.
+            test_category (str): The test category of the generator.
+            seed: The seed of the generator.
+            stage (Literal['metadata', 'tests']): The stage of the unit.
+            pattern (dict): The pattern of the unit.
+            metadata (dict | None): The metadata of the unit. None for the `metadata` stage.
+            output (list): The list of generated metadata or tests.
+        """
+        key = self._key(db_path, tbl_name, test_category, seed, stage, pattern, metadata)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (*key, json.dumps(output, default=str)))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def _key(db_path, tbl_name, test_category, seed, stage, pattern, metadata) -> tuple:
+        return (db_path,
+                tbl_name,
+                test_category,
+                str(seed),
+                stage,
+                json.dumps(pattern, sort_keys=True, default=str),
+                json.dumps(metadata, sort_keys=True, default=str) if metadata is not None else '')
@@ -0,0 +1,100 @@
+import logging
+
+import pandas as pd
+
+from .dataset_generator import DatasetGenerator, DatasetInput, create_sqlite_connector
+from .journal import RunJournal
+from ..budget import RunBudget
+from ..profiling import profile_scope, profile_stage
+from .sinks import JsonlSink
+
+
+class MultiCategoryGenerator:
+    """
+    Generates several test categories in a single pass over a database.
+
+    The database is opened and its tables (`ConnectorTable` with the sampled metadata of each column)
+    are loaded once, then every generator runs over this shared state. The tests of all the categories
+    are returned (or written to the sink) together.
+
+    Attributes:
+        category2generator (dict[str, DatasetGenerator]): The generator to run for each category name.
+    """
+
+    def __init__(self, category2generator: dict[str, DatasetGenerator]):
+        """
+        Args:
+            category2generator (dict[str, DatasetGenerator]): The generator to run for each category name.
+                The generators run in the order of the dictionary.
+        """
+        self.category2generator = category2generator
+
+    def generate_dataset(self,
+                         function_input: DatasetInput,
+                         category2tbls: dict[str, list[str] | str | None] | None = None,
+                         sink: JsonlSink | None = None,
+                         return_dataframe: bool = True,
+                         journal: RunJournal | None = None,
+                         budget: RunBudget | None = None,
+                         dry_run: bool = False) -> pd.DataFrame | None:
+        """
+        Generates the tests of every category for the database of `function_input`.
+
+        Args:
+            function_input (DatasetInput): The generation input shared by all the categories.
+            category2tbls (dict[str, list[str] | str | None] | None): Optional tables to analyze for each category.
+                Categories in the dictionary override `function_input.tbl_in_db_to_analyze`, categories
+                missing from it are skipped. If None, every category analyzes `function_input.tbl_in_db_to_analyze`.
+            sink (JsonlSink | None): Optional streaming sink shared by all the categories.
+            return_dataframe (bool): Whether to accumulate and return the generated tests.
+            journal (RunJournal | None): Optional run journal shared by all the categories.
+            budget (RunBudget | None): Optional budget of the database. If None, it is created from the limits of
+                `function_input`. The budget left is shared equally among the categories still to generate.
+            dry_run (bool): If True, no test is generated and the plans of all the categories
+                (see `DatasetGenerator.plan_dataset`) are returned instead.
+
+        Returns:
+            pd.DataFrame | None: The tests of all the categories, with the `test_category` column
+            identifying the generator. None if `return_dataframe` is False.
+        """
+        sqlite_connector = create_sqlite_connector(function_input)
+        with profile_scope('', None), profile_stage('load_tables'):
+            tbl_name2tbls = sqlite_connector.load_tables_from_database()
+
+        category2input = {}
+        for category in self.category2generator:
+            if category2tbls is None:
+                category2input[category] = function_input
+            elif category in category2tbls:
+                category2input[category] = function_input.model_copy(
+                    update={'tbl_in_db_to_analyze': category2tbls[category]}
+                )
+
+        budget = budget or RunBudget.from_limits(function_input.max_cost,
+                                                 function_input.max_tokens,
+                                                 function_input.max_time)
+        if dry_run:
+            dfs = [self.category2generator[category].plan_dataset(category_input,
+                                                                  sqlite_connector=sqlite_connector,
+                                                                  tbl_name2tbls=tbl_name2tbls)
+                   for category, category_input in category2input.items()]
+            return pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
+
+        dfs = []
+        for i, (category, category_input) in enumerate(category2input.items()):
+            if budget.exhausted:
+                logging.warning(f'Budget exhausted, categories {list(category2input)[i:]} not generated')
+                break
+            df = self.category2generator[category].generate_dataset(category_input,
+                                                                     sink=sink,
+                                                                     return_dataframe=return_dataframe,
+                                                                     journal=journal,
+                                                                     sqlite_connector=sqlite_connector,
+                                                                     tbl_name2tbls=tbl_name2tbls,
+                                                                     budget=budget.allocate(len(category2input) - i))
+            if df is not None and len(df) > 0:
+                dfs.append(df)
+
+        if not return_dataframe:
+            return None
+        return pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
@@ -0,0 +1,78 @@
+import gzip
+import os
+import threading
+
+import pandas as pd
+
+
+class JsonlSink:
+    """
+    Streaming output sink that appends generated tests to a JSON Lines file as soon as they are produced.
+
+    Each call to `write` serializes the rows of a DataFrame as one JSON record per line, with the same
+    encoding used by `pd.DataFrame.to_json(orient='records')`, and flushes them to disk. In this way the
+    memory does not grow with the run and a crash only loses the table being generated.
+    The file is gzip-compressed when `compress` is True or when the path ends with `.gz`.
+
+    Attributes:
+        path (str): The path of the output file.
+        compress (bool): Whether the output is gzip-compressed.
+        num_records (int): The number of records written so far.
+    """
+
+    def __init__(self, path: str, compress: bool | None = None, append: bool = False):
+        """
+        Args:
+            path (str): The path of the JSONL file to write.
+            compress (bool | None): Whether to gzip the output. If None, it is inferred from the `.gz` extension.
+            append (bool): If True, the records are appended to an existing file instead of overwriting it.
+        """
+        self.path = path
+        self.compress = path.endswith('.gz') if compress is None else compress
+        self.num_records = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        mode = 'at' if append else 'wt'
+        self._file = gzip.open(path, mode, encoding='utf-8') if self.compress else open(path, mode, encoding='utf-8')
+
+    def write(self, df: pd.DataFrame):
+        """
+        Appends the rows of `df` to the file and flushes them to disk.
+
+        Args:
+            df (pd.DataFrame): The generated tests to write, one record per row.
+        """
+        if len(df) == 0:
+            return
+        lines = df.to_json(orient='records', lines=True)
+        with self._lock:
+            self._file.write(lines if lines.endswith('\n') else f'{lines}\n')
+            self._file.flush()
+            self.num_records += len(df)
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_jsonl(path: str) -> pd.DataFrame:
+    """
+    Reads a (optionally gzip-compressed) JSONL file written by `JsonlSink` into a DataFrame.
+
+    Args:
+        path (str): The path of the JSONL file.
+
+    Returns:
+        pd.DataFrame: The records of the file, one per row.
+    """
+    return pd.read_json(path, orient='records', lines=True, compression='infer')
@@ -1,49 +1,191 @@
+import contextvars
 import difflib
+import logging
+import os
+import random
+import re
 import sqlite3
+import threading
+import weakref
+from concurrent.futures import Executor
+from typing import Callable, Iterable, TypeVar
 
-from qatch.connectors import SqliteConnector
-from qatch.generate_dataset import OrchestratorGenerator as QatchOrchestrator
+import sqlalchemy.exc
+from qatch.connectors import ConnectorTable, SqliteConnector
 
+from ..models import UsageMeter
+from ..profiling import profiled
 
-def utils_run_qatch(sqlite_connector: SqliteConnector, selected_col: str, tbl_name: str
-                    ) -> list[dict]:
+T = TypeVar('T')
+R = TypeVar('R')
+
+# schema dumps already computed, keyed by (absolute path, modification time, size) of the database file
+_db_path2dump: dict[tuple[str, int, int], str] = {}
+# relevant schemas already computed, keyed by the key of the dump and the options of the schema
+_schema_key2schema: dict[tuple, str] = {}
+_db_dump_lock = threading.Lock()
+
+_QATCH_GENERATOR_NAMES = ['project', 'distinct', 'select', 'simple', 'orderby', 'groupby', 'having']
+_QATCH_EXCLUDED_SQL_TAGS = re.compile('join|many-to-many|project-random-col|orderby-single', re.IGNORECASE)
+# QATCH generators draw from the global `random` module, only one at a time can generate its templates
+_qatch_lock = threading.Lock()
+# query catalogs of the tables, keyed by the id of the `ConnectorTable` and evicted when the table is collected
+_tbl_id2qatch_catalog: dict[int, 'QatchQueryCatalog'] = {}
+_qatch_catalog_lock = threading.Lock()
+
+
+class QatchQueryCatalog:
+    """
+    Catalog of the QATCH queries of a table, indexed by the column they are generated for.
+
+    The queries of a column are generated once, with the QATCH generators of `_QATCH_GENERATOR_NAMES` forced to
+    include the column, and filtered once: only the queries referencing the column are kept, without the
+    unneeded SQL tags, and then only those returning rows. The later lookups of the column are a dictionary hit.
+    Each column is generated with its own seed, so its queries do not depend on the order of the lookups of the
+    concurrent work items.
+
+    Only the templates are generated under the global `_qatch_lock`; the queries are run outside it, and each
+    column has its own lock, so the other columns and tables are not blocked by the queries of a column.
+
+    Use `utils_get_qatch_catalog` to share the catalog of a table among the generators and the work items.
+
+    Attributes:
+        tbl_name (str): The name of the table.
+    """
+
+    def __init__(self, tbl_name: str):
+        self.tbl_name = tbl_name
+        self._col2queries: dict[str, list[dict]] = {}
+        self._col2lock: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get_queries(self, sqlite_connector: SqliteConnector, table: ConnectorTable, selected_col: str) -> list[dict]:
+        """
+        Returns the QATCH queries of `selected_col`, generating them on the first lookup of the column.
+
+        Args:
+            sqlite_connector (SqliteConnector): The connector of the database of the table, used to run the
+                generated queries on the first lookup.
+            table (ConnectorTable): The table of the catalog.
+            selected_col (str): The name of the column to include in the queries.
+
+        Returns:
+            list[dict]: The queries, each with 'test_category', 'query', 'question'.
+        """
+        with self._lock:
+            col_lock = self._col2lock.setdefault(selected_col, threading.Lock())
+        with col_lock:
+            if selected_col not in self._col2queries:
+                self._col2queries[selected_col] = self._generate_queries(sqlite_connector, table, selected_col)
+            return self._col2queries[selected_col]
+
+    def _generate_queries(self, sqlite_connector: SqliteConnector, table: ConnectorTable,
+                          selected_col: str) -> list[dict]:
+        # imported here, the QATCH generators import LangGraph
+        from qatch.generate_dataset.orchestrator_generator import name2generator as qatch_name2generator
+
+        if len(sqlite_connector.run_query(f'SELECT * FROM `{self.tbl_name}` LIMIT 1')) == 0:
+            # QATCH does not generate queries for an empty table
+            return []
+        templates = []
+        with _qatch_lock:
+            global_random_state = random.getstate()
+            try:
+                for name in _QATCH_GENERATOR_NAMES:
+                    generator = qatch_name2generator[name]()
+                    # the state set by `graph_call`, which would also run every query under the lock
+                    generator.connector = sqlite_connector
+                    generator.column_to_include = selected_col
+                    random.seed(f'{self.tbl_name}|{selected_col}|{name}')
+                    templates += [{**template, 'test_category': generator.test_name}
+                                  for template in generator.template_generator(table)]
+            finally:
+                random.setstate(global_random_state)
+
+        quoted_col = f'`{selected_col.lower()}`'
+        queries = []
+        for template in templates:
+            # remove unnecessary test-categories
+            if quoted_col not in template['query'].lower() or _QATCH_EXCLUDED_SQL_TAGS.search(template['sql_tag']):
+                continue
+            # remove the queries without results, as QATCH does
+            try:
+                if len(sqlite_connector.run_query(template['query'])) == 0:
+                    continue
+            except sqlalchemy.exc.OperationalError:
+                continue
+            queries.append({'test_category': template['test_category'],
+                            'query': template['query'],
+                            'question': template['question']})
+        return queries
+
+
+def utils_get_qatch_catalog(table: ConnectorTable) -> QatchQueryCatalog:
+    """
+    Returns the `QatchQueryCatalog` of `table`, shared by all the calls on the same `ConnectorTable`.
+
+    The catalog lives as long as the table: it is dropped when the table is garbage collected, e.g., at the end
+    of the generation of its database, so the catalogs of the processed databases are not kept in memory.
+    """
+    tbl_id = id(table)
+    with _qatch_catalog_lock:
+        if tbl_id not in _tbl_id2qatch_catalog:
+            _tbl_id2qatch_catalog[tbl_id] = QatchQueryCatalog(table.tbl_name)
+            # without the lock: the finalizer may run during a garbage collection triggered while it is held
+            weakref.finalize(table, _tbl_id2qatch_catalog.pop, tbl_id, None)
+        return _tbl_id2qatch_catalog[tbl_id]
+
+
+@profiled('qatch')
+def utils_run_qatch(sqlite_connector: SqliteConnector, selected_col: str, table: ConnectorTable,
+                    rng: random.Random | None = None) -> list[dict]:
     """
     Executes query generation to produce a list of unique test case configurations
     based on the provided table name and selected column.
 
+    The queries of the column are generated once per table and column (see `QatchQueryCatalog`), then up to
+    two queries are sampled for each test category, seeded from `rng`, so the output only depends on `rng`
+    and not on the scheduling of concurrent calls. The state of the global `random` module is not changed.
+
     Args:
         sqlite_connector (SqliteConnector): The database connector to interact
             with SQLite database.
         selected_col (str): The name of the column to include in generated queries.
-        tbl_name (str): The name of the table to use in query generation.
+        table (ConnectorTable): The table to use in query generation.
+        rng (random.Random | None): The random generator of the work item. If None, QATCH default seed is used.
 
     Returns:
         list[dict]: A list of dictionaries representing unique test configurations,
             each including 'test_category', 'query', 'question'.
     """
-    qatch_generator = QatchOrchestrator(
-        generator_names=['project', 'distinct', 'select', 'simple', 'orderby', 'groupby', 'having']
-    )
-    df = qatch_generator.generate_dataset(sqlite_connector, column_to_include=selected_col, tbl_names=[tbl_name])
-    df_masked = df[df.apply(lambda row: f"`{selected_col.lower()}`" in row['query'].lower(), axis=1)]
-    # remove unnecessary test-categories
-    df_masked = df_masked[
-        ~df_masked.sql_tag.str.lower().str.contains('join|many-to-many|project-random-col|orderby-single')
-    ]
+    seed = rng.getrandbits(32) if rng is not None else 2023
+    queries = utils_get_qatch_catalog(table).get_queries(sqlite_connector, table, selected_col)
 
     # TODO undestand if it is better to include in each generator
-    # sample q element for each test-category
-    sample_fun = lambda x: x.sample(2) if len(x) > 2 else x
-    df_masked = df_masked.groupby('test_category').apply(sample_fun).reset_index(drop=True)
-
-    list_tests = df_masked.loc[:, ['test_category', 'query', 'question']].drop_duplicates().to_dict(orient='records')
+    # sample 2 queries for each test-category
+    category2queries = {}
+    for query in queries:
+        category2queries.setdefault(query['test_category'], []).append(query)
+    sample_rng = random.Random(seed)
+    list_tests = []
+    for category in sorted(category2queries):
+        category_queries = category2queries[category]
+        if len(category_queries) > 2:
+            category_queries = sample_rng.sample(category_queries, 2)
+        for query in category_queries:
+            if query not in list_tests:
+                list_tests.append(dict(query))
     return list_tests
 
 
+@profiled('schema_dump')
 def utils_get_db_dump_no_insert(db_path):
     """
     Generates a database dump string containing only 'CREATE TABLE' statements. Excludes INSERT statements or
     other SQL commands, returning a string of the database schema creation statements for a SQLite database.
+    The statements are read from `sqlite_master`, without reading the data, in the same format and order of
+    the 'CREATE TABLE' lines of `iterdump`. The dump is computed once per database file and reused until the
+    file changes.
 
     Args:
         db_path (str): The path to the SQLite database file.
@@ -54,12 +196,141 @@ def utils_get_db_dump_no_insert(db_path):
     Raises:
         sqlite3.Error: If there is an issue connecting to or querying the SQLite database.
     """
+    stat = os.stat(db_path)
+    key = (os.path.abspath(db_path), stat.st_mtime_ns, stat.st_size)
+    with _db_dump_lock:
+        if key in _db_path2dump:
+            return _db_path2dump[key]
+
     with sqlite3.connect(db_path) as conn:
-        # Iterates over the dump generator and join each line into a single string
-        dump_string = "\n".join([line for line in conn.iterdump() if 'create table' in line.lower()])
+        # the tables of `iterdump`, which also dumps every row, skipping the internal and the virtual tables
+        rows = conn.execute("SELECT name, sql FROM sqlite_master "
+                            "WHERE type = 'table' AND sql IS NOT NULL ORDER BY name").fetchall()
+    dump_string = "\n".join(f'{sql};' for name, sql in rows
+                             if not name.startswith('sqlite_') and not sql.startswith('CREATE VIRTUAL TABLE'))
+
+    with _db_dump_lock:
+        _db_path2dump[key] = dump_string
     return dump_string
 
 
+@profiled('schema_dump')
+def utils_get_relevant_schema(db_path: str,
+                              tbl_name: str,
+                              include_fk_neighbours: bool = False,
+                              num_sample_values: int = 0,
+                              max_tokens: int | None = None) -> str:
+    """
+    Generates the compact schema of a table to include in the prompts, instead of the schema of the whole database.
+
+    The schema contains the 'CREATE TABLE' statement of `tbl_name`, in the same format of `utils_get_db_dump_no_insert`,
+    optionally followed by the statements of the tables referencing it or referenced by it with a foreign key.
+    With `num_sample_values`, each table is followed by a few distinct values of each column as SQL comments.
+    The parts are added in this order (target table, its sample values, then each neighbour with its sample values)
+    until the approximate number of tokens (4 characters per token) reaches `max_tokens`; the 'CREATE TABLE' of the
+    target table is always included. The schema is computed once per database file and options.
+
+    Args:
+        db_path (str): The path to the SQLite database file.
+        tbl_name (str): The name of the table targeted by the tests.
+        include_fk_neighbours (bool): Whether to include the tables connected to `tbl_name` by a foreign key.
+        num_sample_values (int): The number of distinct values of each column to include. 0 for none.
+        max_tokens (int | None): The maximum number of tokens of the schema. None for no limit.
+
+    Returns:
+        str: The relevant 'CREATE TABLE' statements. The schema of the whole database if `tbl_name` is not found.
+    """
+    stat = os.stat(db_path)
+    key = (os.path.abspath(db_path), stat.st_mtime_ns, stat.st_size,
+           tbl_name, include_fk_neighbours, num_sample_values, max_tokens)
+    with _db_dump_lock:
+        if key in _schema_key2schema:
+            return _schema_key2schema[key]
+
+    with sqlite3.connect(db_path) as conn:
+        name2sql = dict(conn.execute("SELECT name, sql FROM sqlite_master "
+                                     "WHERE type = 'table' AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"))
+        # SQLite table names are case-insensitive
+        lower_name2name = {name.lower(): name for name in name2sql}
+        if tbl_name.lower() not in lower_name2name:
+            logging.warning(f'Table {tbl_name} not found in {db_path}, the schema of the whole database is used')
+            return utils_get_db_dump_no_insert(db_path)
+        tbl_name = lower_name2name[tbl_name.lower()]
+
+        tbl_names = [tbl_name]
+        if include_fk_neighbours:
+            # first the tables referenced by the target table, then the tables referencing it
+            for name in sorted(_get_referenced_tables(conn, tbl_name)):
+                if name in lower_name2name and lower_name2name[name] not in tbl_names:
+                    tbl_names.append(lower_name2name[name])
+            for name in sorted(name2sql):
+                if name not in tbl_names and tbl_name.lower() in _get_referenced_tables(conn, name):
+                    tbl_names.append(name)
+
+        # the parts in order of priority, the first one is always included
+        parts = [f'{name2sql[tbl_name]};']
+        parts += _get_sample_values(conn, tbl_name, num_sample_values)
+        for name in tbl_names[1:]:
+            parts.append('\n'.join([f'{name2sql[name]};', *_get_sample_values(conn, name, num_sample_values)]))
+
+    schema = parts[0]
+    for part in parts[1:]:
+        if max_tokens is not None and (len(schema) + len(part) + 1) // 4 > max_tokens:
+            break
+        schema = f'{schema}\n{part}'
+
+    with _db_dump_lock:
+        _schema_key2schema[key] = schema
+    return schema
+
+
+def _quote(identifier: str) -> str:
+    return identifier.replace('"', '""')
+
+
+def _get_referenced_tables(conn: sqlite3.Connection, tbl_name: str) -> set[str]:
+    """Returns the lowercase names of the tables referenced by the foreign keys of the table."""
+    return {row[2].lower() for row in conn.execute(f'PRAGMA foreign_key_list("{_quote(tbl_name)}")')}
+
+
+def _get_sample_values(conn: sqlite3.Connection, tbl_name: str, num_sample_values: int) -> list[str]:
+    """
+    Returns a SQL comment with up to `num_sample_values` distinct values for each column of the table, skipping
+    the columns without values (e.g., those of an empty table).
+    """
+    if num_sample_values <= 0:
+        return []
+    lines = []
+    for row in conn.execute(f'PRAGMA table_info("{_quote(tbl_name)}")'):
+        col = row[1]
+        values = conn.execute(f'SELECT DISTINCT "{_quote(col)}" FROM "{_quote(tbl_name)}" '
+                              f'WHERE "{_quote(col)}" IS NOT NULL LIMIT ?', (num_sample_values,)).fetchall()
+        if not values:
+            continue
+        values = [' '.join(str(value[0]).split())[:50] for value in values]
+        lines.append(f'-- {tbl_name}.{col}: {", ".join(values)}')
+    return lines
+
+
+def utils_without_costs(item: dict | None) -> dict | None:
+    """
+    Returns `item` (a pattern or a metadata) without the costs metered by the generators (the `*_cost` keys).
+
+    The costs are 0 for the calls read from the response cache, so they differ between a run and its cached
+    re-run: they must not be rendered into the prompts, nor identify a work item in the random seeds and in the
+    journal, otherwise the re-run would miss the cache and sample different queries.
+    """
+    if item is None:
+        return None
+    return {key: value for key, value in item.items() if not key.endswith('_cost')}
+
+
+def utils_is_key_column_name(column_name: str) -> bool:
+    """Whether the name of a column suggests an identifier or a key (it contains `id`, `code` or `key`)."""
+    column_name = column_name.lower()
+    return 'id' in column_name or 'code' in column_name or 'key' in column_name
+
+
 def utils_find_closest_matches(
         target_words: list[str] | str | None,
         candidate_words: list[str]
@@ -111,3 +382,77 @@ def utils_syntactic_match(str1: str, str2: str) -> float:
         indicates no similarity.
     """
     return difflib.SequenceMatcher(None, str1, str2).ratio()
+
+
+def utils_map_concurrently(fn: Callable[[T], R], items: Iterable[T], executor: Executor) -> list[R]:
+    """
+    Applies `fn` to every item using the given executor and returns the results in the order of the items.
+
+    Each call runs in a copy of the caller's context, so the usage meters, the profiler and the budget
+    active in the caller keep tracking the calls made in the worker threads.
+    If one of the calls fails, the calls not yet started are cancelled and the first error
+    (in item order) is raised.
+
+    Args:
+        fn (Callable[[T], R]): The function to apply to each item.
+        items (Iterable[T]): The items to process.
+        executor (Executor): The executor running the calls.
+
+    Returns:
+        list[R]: The results of `fn`, in the same order of `items`.
+    """
+    futures = [executor.submit(contextvars.copy_context().run, fn, item) for item in items]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def utils_predict_batch_until(model,
+                              items: list[T],
+                              get_input: Callable[[T], dict],
+                              max_outputs: int | None,
+                              required_keys: list[str],
+                              max_concurrency: int | None = None,
+                              output_name: str = 'output') -> tuple[list[tuple[T, dict]], float]:
+    """
+    Predicts the outputs of `items` in batches until `max_outputs` of them succeed or the items run out.
+
+    The first batch contains the first `max_outputs` items; each next batch contains as many of the remaining
+    items as the failed outputs of the previous one, so the failures are replaced without requesting more
+    outputs than needed. An output fails when the model raises an error or it misses one of `required_keys`.
+
+    Args:
+        model (LangchainWrapper): The model predicting the outputs, with `predict_batch`.
+        items (list[T]): The candidate items, in order of preference.
+        get_input (Callable[[T], dict]): Returns the input of the prompt template of an item.
+        max_outputs (int | None): The number of successful outputs to return. If None, all the items are predicted.
+        required_keys (list[str]): The keys of the JSON output of the model.
+        max_concurrency (int | None): The maximum number of requests running at the same time. If None, no limit.
+        output_name (str): The name of the output in the warnings of the errors.
+
+    Returns:
+        tuple[list[tuple[T, dict]], float]: The (item, output) of the successful outputs, in the order of the
+            items, and the cost of the calls of all the batches divided by the number of successful outputs.
+    """
+    results = []
+    next_index = 0
+    with UsageMeter().activate() as usage:
+        while next_index < len(items) and (max_outputs is None or len(results) < max_outputs):
+            batch_size = len(items) if max_outputs is None else max_outputs - len(results)
+            batch = items[next_index:next_index + batch_size]
+            next_index += len(batch)
+            outputs = model.predict_batch([get_input(item) for item in batch],
+                                          max_concurrency=max_concurrency,
+                                          required_keys=required_keys)
+            for item, output in zip(batch, outputs):
+                if isinstance(output, Exception):
+                    logging.warning(f'Error generating the {output_name}: {output}')
+                    continue
+                if any(key not in output for key in required_keys):
+                    continue
+                results.append((item, output))
+    cost_per_output = usage.total_cost / len(results) if results else 0.0
+    return results, cost_per_output
@@ -0,0 +1,33 @@
+import importlib
+from typing import Any, Callable
+
+
+def lazy_getattr(package_name: str, name2module: dict[str, str]) -> tuple[Callable[[str], Any], Callable[[], list[str]]]:
+    """
+    Returns the module `__getattr__` and `__dir__` (PEP 562) of a package re-exporting `name2module` lazily.
+
+    The re-exported names are imported from their module on first access, so importing the package does not
+    import the heavy dependencies (LangChain, QATCH, scikit-learn, ...) of the modules that are never used.
+    Each name is then stored in the package, and later accesses do not go through `__getattr__`.
+
+    Args:
+        package_name (str): The `__name__` of the package.
+        name2module (dict[str, str]): For each re-exported name, the module defining it, relative to the package
+            (e.g., `'.dataset_generator'`).
+
+    Returns:
+        tuple[Callable[[str], Any], Callable[[], list[str]]]: The `__getattr__` and `__dir__` of the package.
+    """
+    package = importlib.import_module(package_name)
+
+    def __getattr__(name: str) -> Any:
+        if name not in name2module:
+            raise AttributeError(f'module {package_name!r} has no attribute {name!r}')
+        value = getattr(importlib.import_module(name2module[name], package_name), name)
+        setattr(package, name, value)
+        return value
+
+    def __dir__() -> list[str]:
+        return sorted(set(vars(package)) | set(name2module))
+
+    return __getattr__, __dir__
@@ -1,4 +1,37 @@
-from .prompts import PROMPTS
-from .langchain_wrapper import (create_default_gemma_2b, create_default_gpt4o, create_default_gpt4o_mini,
-                                create_default_gpt35, create_default_llama31_8b, create_default_llama32_3b,
-                                create_default_llama70, create_default_llama405, create_default_qwen_coder)
+from typing import TYPE_CHECKING
+
+from ..lazy_imports import lazy_getattr
+
+# the clients of the providers (langchain_openai, langchain_together) are imported on first access
+_name2module = {
+    'PROMPTS': '.prompts',
+    'OfflineChatModel': '.offline_backend',
+    'OfflineEmbeddings': '.offline_backend',
+    'CachedEmbeddings': '.embedding_cache',
+    'EmbeddingCache': '.embedding_cache',
+    'IdentifierTfidfEmbeddings': '.local_embeddings',
+    'RateLimiter': '.rate_limiter',
+    'UsageMeter': '.metering',
+    'ResponseCache': '.response_cache',
+    'ResponseCacheMiss': '.response_cache',
+    **{name: '.langchain_wrapper' for name in [
+        'create_default_encoder', 'create_default_gemma_2b', 'create_default_gpt4o', 'create_default_gpt4o_mini',
+        'create_default_gpt35', 'create_default_llama31_8b', 'create_default_llama32_3b', 'create_default_llama70',
+        'create_default_llama405', 'create_default_qwen_coder'
+    ]},
+}
+__all__ = list(_name2module)
+__getattr__, __dir__ = lazy_getattr(__name__, _name2module)
+
+if TYPE_CHECKING:
+    from .prompts import PROMPTS
+    from .offline_backend import OfflineChatModel, OfflineEmbeddings
+    from .embedding_cache import CachedEmbeddings, EmbeddingCache
+    from .local_embeddings import IdentifierTfidfEmbeddings
+    from .rate_limiter import RateLimiter
+    from .metering import UsageMeter
+    from .response_cache import ResponseCache, ResponseCacheMiss
+    from .langchain_wrapper import (create_default_encoder, create_default_gemma_2b, create_default_gpt4o,
+                                    create_default_gpt4o_mini, create_default_gpt35, create_default_llama31_8b,
+                                    create_default_llama32_3b, create_default_llama70, create_default_llama405,
+                                    create_default_qwen_coder)
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+try:
+    import fcntl
+except ImportError:  # Windows: the cache is still thread-safe, but it must not be shared by processes
+    fcntl = None
+
+_config2cache: dict[tuple, 'EmbeddingCache'] = {}
+_config2cache_lock = threading.Lock()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of the embeddings of a model, keyed by the text embedded.
+
+    The embeddings are stored on disk as raw float32 rows appended to `vectors.f32`, one row for each line of
+    `keys.txt` (the SHA-256 of the text), in a directory of the model. The rows are memory-mapped, so opening a
+    large cache reads only the keys, and the vectors are paged in when used. The cache can be shared by multiple
+    threads and processes: the writes are serialized with a file lock, and the rows appended by the other
+    processes are seen on the next miss.
+
+    Attributes:
+        directory (str): The directory of the embeddings of the model.
+        model_name (str): The name of the embedding model.
+        hits (int): The number of texts read from the cache.
+        misses (int): The number of texts not found in the cache.
+    """
+
+    def __init__(self, directory: str, model_name: str):
+        """
+        Args:
+            directory (str): The root directory of the cache, shared by all the models. It is created if it
+                does not exist.
+            model_name (str): The name of the embedding model.
+        """
+        self.model_name = model_name
+        self.directory = os.path.join(directory, _get_model_dirname(model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self._keys_path = os.path.join(self.directory, 'keys.txt')
+        self._meta_path = os.path.join(self.directory, 'meta.json')
+        self._lock = threading.Lock()
+        self._key2row: dict[str, int] = {}
+        self._num_rows = 0
+        self._keys_size = 0
+        self._dimensions: int | None = None
+        self._vectors: np.ndarray | None = None
+        with self._lock:
+            self._load()
+
+    @property
+    def dimensions(self) -> int | None:
+        """The size of the embeddings, None while the cache is empty."""
+        return self._dimensions
+
+    def __len__(self) -> int:
+        return len(self._key2row)
+
+    def get_many(self, texts: list[str]) -> dict[str, np.ndarray]:
+        """
+        Returns the cached embedding of each text of `texts` in the cache.
+
+        Args:
+            texts (list[str]): The texts to look up.
+
+        Returns:
+            dict[str, np.ndarray]: The float32 embedding of each text found in the cache.
+        """
+        with self._lock:
+            text2key = {text: _get_key(text) for text in texts}
+            if any(key not in self._key2row for key in text2key.values()):
+                # the missing texts may have been embedded by another process in the meantime
+                self._load()
+            text2vector = {text: self._vectors[self._key2row[key]]
+                           for text, key in text2key.items() if key in self._key2row}
+            self.hits += len(text2vector)
+            self.misses += len(text2key) - len(text2vector)
+        return text2vector
+
+    def get_missing(self, texts: list[str]) -> list[str]:
+        """Returns the distinct texts of `texts` not in the cache, in order, without counting them as misses."""
+        with self._lock:
+            self._load()
+            return [text for text in dict.fromkeys(texts) if _get_key(text) not in self._key2row]
+
+    def put_many(self, text2vector: dict[str, list[float]]):
+        """
+        Stores the embeddings of `text2vector`. The texts already in the cache are skipped.
+
+        Raises:
+            ValueError: If the size of an embedding differs from the size of the embeddings in the cache.
+        """
+        if not text2vector:
+            return
+        with self._lock, _file_lock(os.path.join(self.directory, '.lock')):
+            self._load()
+            key2vector = {}
+            for text, vector in text2vector.items():
+                key = _get_key(text)
+                if key not in self._key2row:
+                    key2vector[key] = vector
+            if not key2vector:
+                return
+            vectors = np.asarray(list(key2vector.values()), dtype=np.float32)
+            if self._dimensions is None:
+                self._dimensions = vectors.shape[1]
+                with open(self._meta_path, 'w') as f:
+                    json.dump({'model_name': self.model_name, 'dimensions': self._dimensions}, f)
+            elif vectors.shape[1] != self._dimensions:
+                raise ValueError(f'Embeddings of size {vectors.shape[1]} cannot be stored in the cache of '
+                                 f'{self.model_name}, of size {self._dimensions}')
+            with open(self._vectors_path, 'ab') as f:
+                # drop the rows of a write interrupted before its keys, they would shift the new rows
+                f.truncate(self._num_rows * self._dimensions * 4)
+                f.write(vectors.tobytes())
+            # the keys are written after their rows, so a reader never sees a key without its row
+            with open(self._keys_path, 'a') as f:
+                f.write(''.join(f'{key}\n' for key in key2vector))
+            self._load()
+
+    def _load(self):
+        """Reads the keys appended since the last load and memory-maps their rows. Called with `_lock` held."""
+        if not os.path.exists(self._keys_path):
+            return
+        size = os.path.getsize(self._keys_path)
+        if size == self._keys_size:
+            return
+        with open(self._keys_path, 'rb') as f:
+            f.seek(self._keys_size)
+            data = f.read(size - self._keys_size)
+        # a key being written by another process is read on the next load
+        data = data[:data.rfind(b'\n') + 1]
+        for line in data.decode('utf-8').splitlines():
+            # each line is a row, even in the unlikely case of a key written twice
+            self._key2row.setdefault(line, self._num_rows)
+            self._num_rows += 1
+        self._keys_size += len(data)
+        if self._dimensions is None:
+            with open(self._meta_path) as f:
+                self._dimensions = json.load(f)['dimensions']
+        if self._num_rows:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r',
+                                      shape=(self._num_rows, self._dimensions))
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedding model reading the embeddings of the texts already embedded from an `EmbeddingCache`.
+
+    Only the texts not in the cache are sent to the wrapped model, in a single call, and their embeddings
+    are stored in the cache. The embeddings are returned with the float32 precision of the cache, whether they
+    were read from the cache or not, so a run gives the same similarities with a cold or a warm cache.
+
+    Attributes:
+        embeddings (Embeddings): The wrapped embedding model.
+        cache (EmbeddingCache): The cache of the embeddings of the model.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        text2vector = self.cache.get_many(texts)
+        missing_texts = list(dict.fromkeys(text for text in texts if text not in text2vector))
+        if missing_texts:
+            new_vectors = self.embeddings.embed_documents(missing_texts)
+            self.cache.put_many(dict(zip(missing_texts, new_vectors)))
+            text2vector.update(zip(missing_texts, np.asarray(new_vectors, dtype=np.float32)))
+        return [text2vector[text].tolist() for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def prefetch(self, texts: list[str], batch_size: int | None = None) -> int:
+        """
+        Embeds the texts of `texts` not in the cache yet and stores them in the cache, without returning them.
+
+        The texts are sent in batches of `batch_size`, by default the `chunk_size` of the wrapped model (the number
+        of texts of each request it sends), so embedding many texts takes few requests and the memory is bounded.
+
+        Args:
+            texts (list[str]): The texts to embed, possibly repeated.
+            batch_size (int | None): The number of texts embedded at a time.
+
+        Returns:
+            int: The number of texts embedded.
+        """
+        batch_size = batch_size or getattr(self.embeddings, 'chunk_size', None) or 1000
+        missing_texts = self.cache.get_missing(texts)
+        for i in range(0, len(missing_texts), batch_size):
+            batch = missing_texts[i:i + batch_size]
+            self.cache.put_many(dict(zip(batch, self.embeddings.embed_documents(batch))))
+        return len(missing_texts)
+
+
+def get_default_embedding_cache(model_name: str) -> EmbeddingCache | None:
+    """
+    Returns the embedding cache of `model_name` configured with the environment variables, or None if the cache
+    is disabled.
+
+    The cache is opt-in: it is enabled by setting `SQUAB_EMBEDDING_CACHE_DIR` to the directory of the cache.
+    One cache is opened for each directory, model and process.
+    """
+    directory = os.getenv('SQUAB_EMBEDDING_CACHE_DIR')
+    if not directory:
+        return None
+    config = (os.getpid(), os.path.abspath(directory), model_name)
+    with _config2cache_lock:
+        if config not in _config2cache:
+            _config2cache[config] = EmbeddingCache(directory, model_name)
+        return _config2cache[config]
+
+
+def _get_key(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _get_model_dirname(model_name: str) -> str:
+    # readable, but distinct for the model names differing only in the characters not allowed in a path
+    readable_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+    return f'{readable_name}-{hashlib.sha256(model_name.encode("utf-8")).hexdigest()[:8]}'
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Holds an exclusive lock on `path` across the processes, where the platform supports it."""
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -1,27 +1,127 @@
 import os
+import threading
+import time
 
 import google.generativeai as genai
-from langchain import hub
 from langchain_core.messages import BaseMessage, SystemMessage, AIMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
 
+from squab.models.metering import meter_llm_call
+from squab.models.prompts import PROMPTS
+from squab.models.rate_limiter import RateLimiter, get_default_rate_limiter
+from squab.models.response_cache import ResponseCache, get_default_response_cache
+from squab.profiling import profile_stage
+
+# `genai.configure` sets the client of the whole process, shared by every Gemini model
+_configured_api_key: str | None = None
+_configure_lock = threading.Lock()
+
 
 class GeminiWrapper:
-    def __init__(self, model_name, hub_prompt, api_key=None):
+    """
+    Wrapper of a Gemini model with the prompt template of a generation step.
+
+    The prompt is read from `PROMPTS`, and the model is created on the first call with the Gemini client
+    of the process, so building a wrapper does not access the network.
+    """
+
+    def __init__(self, model_name, hub_prompt, api_key=None, response_cache: ResponseCache | None = None,
+                 rate_limiter: RateLimiter | None = None):
+        self.model_name = model_name
+        self.prompt_key = hub_prompt
+        # if None, the cache configured with the environment variables, if any
+        self.response_cache = response_cache or get_default_response_cache()
+        # if None, the limiter shared by the process
+        self.rate_limiter = rate_limiter or get_default_rate_limiter()
         self.api_key = api_key or os.getenv('GEMINI_API_KEY')
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel(model_name)
-        self.base_prompt: ChatPromptTemplate = hub.pull(hub_prompt)
+        self.base_prompt = ChatPromptTemplate.from_messages(PROMPTS[hub_prompt])
+        self._model = None
+
+    @property
+    def model(self) -> genai.GenerativeModel:
+        """The Gemini model, created on first use."""
+        global _configured_api_key
+        if self._model is None:
+            with _configure_lock:
+                if _configured_api_key != self.api_key:
+                    genai.configure(api_key=self.api_key)
+                    _configured_api_key = self.api_key
+                self._model = genai.GenerativeModel(self.model_name)
+        return self._model
 
     def predict(self, doc_input):
-        messages = self.base_prompt.invoke(doc_input)
-        messages = [convert_langchain_to_gemini_chat(message) for message in messages.messages]
+        messages, cache_key, cached = self._prepare(doc_input)
+        if cached is not None:
+            return cached['text']
+
+        chat = self.model.start_chat(
+            history=messages[:-1]
+        )
+        start = time.perf_counter()
+        response = self.rate_limiter.call('gemini', self.model_name, lambda: chat.send_message(messages[-1]),
+                                          estimated_tokens=_estimate_num_tokens(messages),
+                                          count_tokens=_get_num_tokens)
+        self._record_response(response, time.perf_counter() - start, cache_key)
+        return response.text
+
+    async def apredict(self, doc_input):
+        """Asynchronous version of `predict`, sending the message with the async client of Gemini."""
+        messages, cache_key, cached = self._prepare(doc_input)
+        if cached is not None:
+            return cached['text']
+
         chat = self.model.start_chat(
             history=messages[:-1]
         )
-        response = chat.send_message(messages[-1])
+        start = time.perf_counter()
+        response = await self.rate_limiter.acall('gemini', self.model_name,
+                                                 lambda: chat.send_message_async(messages[-1]),
+                                                 estimated_tokens=_estimate_num_tokens(messages),
+                                                 count_tokens=_get_num_tokens)
+        self._record_response(response, time.perf_counter() - start, cache_key)
         return response.text
 
+    def _prepare(self, doc_input) -> tuple[list[dict], str | None, dict | None]:
+        """
+        Returns the Gemini messages of `doc_input`, their cache key and the cached response, if any,
+        metered as a cached call.
+        """
+        messages = self.base_prompt.invoke(doc_input)
+        messages = [convert_langchain_to_gemini_chat(message) for message in messages.messages]
+        if self.response_cache is None:
+            return messages, None, None
+        cache_key = self.response_cache.get_key(self.model_name, self.prompt_key, messages)
+        start = time.perf_counter()
+        with profile_stage('llm_cache'):
+            cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            meter_llm_call('gemini', self.model_name, self.prompt_key,
+                           prompt_tokens=cached.get('prompt_tokens', 0),
+                           completion_tokens=cached.get('completion_tokens', 0),
+                           latency=time.perf_counter() - start, cached=True)
+        return messages, cache_key, cached
+
+    def _record_response(self, response, wall_time: float, cache_key: str | None):
+        """Meters the usage of a Gemini response and stores it in the response cache."""
+        usage = getattr(response, 'usage_metadata', None)
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        completion_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+        meter_llm_call('gemini', self.model_name, self.prompt_key, prompt_tokens=prompt_tokens,
+                       completion_tokens=completion_tokens, latency=wall_time)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, {'text': response.text,
+                                                'prompt_tokens': prompt_tokens,
+                                                'completion_tokens': completion_tokens})
+
+
+def _estimate_num_tokens(messages: list[dict]) -> int:
+    # fast approximation of the prompt tokens, corrected with the real usage after the call
+    return sum(len(str(message['parts'])) for message in messages) // 4
+
+
+def _get_num_tokens(response) -> int:
+    return getattr(getattr(response, 'usage_metadata', None), 'total_token_count', 0) or 0
+
 
 def create_default_gemini_1_5_pro(hub_prompt):
     return GeminiWrapper(
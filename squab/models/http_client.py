@@ -0,0 +1,40 @@
+import os
+import threading
+
+import httpx
+
+# timeouts of the OpenAI SDK: the completions can be slow, the connections cannot
+_TIMEOUT = httpx.Timeout(timeout=600.0, connect=5.0)
+
+_key2client: dict[tuple[int, str], httpx.Client] = {}
+_key2client_lock = threading.Lock()
+
+
+def get_shared_http_client(provider: str) -> httpx.Client:
+    """
+    Returns the keep-alive HTTP client of `provider` (e.g., `openai`, `together`), shared by every model of the process.
+
+    All the chat and embedding models of a provider send their requests through the same connection pool, so the
+    TCP and TLS connections are reused across wrappers and generators instead of being opened by each client.
+    The pool keeps up to `SQUAB_HTTP_MAX_CONNECTIONS` connections (100 by default), enough for the concurrent calls
+    of `max_concurrency`. The clients are created per process, since a connection cannot be shared after a fork.
+
+    Only the synchronous calls use the shared pool: an asynchronous client is bound to the event loop that opened
+    its connections, so the asynchronous calls keep the client of the provider SDK.
+
+    Args:
+        provider (str): The provider of the models.
+
+    Returns:
+        httpx.Client: The HTTP client of the provider.
+    """
+    key = (os.getpid(), provider)
+    with _key2client_lock:
+        if key not in _key2client:
+            max_connections = int(os.getenv('SQUAB_HTTP_MAX_CONNECTIONS', '100'))
+            _key2client[key] = httpx.Client(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                timeout=_TIMEOUT,
+                follow_redirects=True
+            )
+        return _key2client[key]
@@ -1,75 +1,409 @@
 import logging
 import os
 import re
-
-from langchain_core.messages import MessageLikeRepresentation
+import threading
+import time
+from typing import Iterable, Literal
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import (AIMessage, AIMessageChunk, BaseMessage, MessageLikeRepresentation, message_to_dict,
+                                     messages_from_dict)
 from langchain_core.output_parsers import StrOutputParser, PydanticOutputParser, JsonOutputParser
+from langchain_core.prompt_values import PromptValue
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_together import ChatTogether
+from langchain_core.runnables import Runnable, RunnableLambda
 from pydantic import BaseModel
 
+from squab.models.embedding_cache import CachedEmbeddings, get_default_embedding_cache
+from squab.models.http_client import get_shared_http_client
+from squab.models.metering import meter_llm_call
+from squab.models.offline_backend import create_offline_chat_model, create_offline_embeddings, is_offline_backend
 from squab.models.prompts import PROMPTS
+from squab.models.rate_limiter import RateLimiter, get_default_rate_limiter
+from squab.models.response_cache import ResponseCache, get_default_response_cache
+from squab.profiling import profile_stage
 
 
 class LangchainWrapper:
+    """
+    Wrapper of a LangChain chat model with the prompt template of a generation step.
+
+    The prompt and the output parser are set once, in `__init__` and `set_parser`. The chat model is created
+    on the first call (thread-safely) and sends its requests through the connection pool shared by all the
+    models of the provider (see `get_shared_http_client`), so building many wrappers opens no connection.
+    The prediction methods keep no per-call state in the wrapper, and the extra messages of a call are passed
+    with `append_messages`. After the wrapper is configured, a single instance can therefore be shared by
+    many worker threads calling `predict` and `predict_batch` (and by many coroutines calling `apredict`)
+    at the same time. `set_parser` is not thread-safe: call it before sharing the wrapper.
+    """
+
     def __init__(self,
                  model_name: str,
                  hub_prompt: str,
                  api_key: str | None = None,
                  model_kwargs: dict | None = None,
                  is_together: bool = False,
+                 response_cache: ResponseCache | None = None,
+                 rate_limiter: RateLimiter | None = None,
+                 streaming: Literal['off', 'stop'] | None = None,
                  ):
+        """
+        Args:
+            model_name (str): The name of the model.
+            hub_prompt (str): The key of the prompt template in `PROMPTS`.
+            api_key (str | None): The API key. If None, it is read from the environment.
+            model_kwargs (dict | None): The generation kwargs of the model. Defaults to temperature 0.
+            is_together (bool): Whether the model is served by Together instead of OpenAI.
+            response_cache (ResponseCache | None): Optional cache of the model responses. If None, the cache
+                configured with the environment variables is used (see `get_default_response_cache`), if any.
+            rate_limiter (RateLimiter | None): The rate limiter and retry policy of the calls. If None, the limiter
+                shared by the process and configured with the environment variables (see `get_default_rate_limiter`).
+            streaming (Literal['off', 'stop'] | None): How `predict_json` reads the response. With `off`, the whole
+                response is generated and then parsed. With `stop`, the response is streamed and the generation is
+                stopped as soon as it contains a complete JSON block with the required keys, saving the output
+                tokens; the truncated responses are cached apart from the full ones.
+                If None, the value of `SQUAB_LLM_STREAMING` (`off` by default).
+
+        With `SQUAB_LLM_BACKEND=offline`, the model is replaced by the local `OfflineChatModel` of `hub_prompt`
+        and no provider is called. The offline responses are never stored in the default response cache.
+        """
+        self.model_name = model_name
+        self.prompt_key = hub_prompt
+        self.is_offline = is_offline_backend()
+        self.response_cache = response_cache or (get_default_response_cache() if not self.is_offline else None)
+        self.rate_limiter = rate_limiter or get_default_rate_limiter()
+        self.streaming = streaming or os.getenv('SQUAB_LLM_STREAMING', 'off')
+        if self.streaming not in ('off', 'stop'):
+            raise ValueError(f"streaming must be one of 'off', 'stop', got {self.streaming}")
         self.model_kwargs = model_kwargs or {'temperature': 0.0}
+        self.api_key = api_key
 
+        # the provider is also kept offline, so that its rate limits are simulated
         self.is_together = is_together
-        if self.is_together:
-            api_key_name = 'TOGETHER_API_KEY'
-            self.llm = ChatTogether(
-                model=model_name,
-                api_key=api_key or os.getenv(api_key_name),
-                **self.model_kwargs
-            )
-        else:
-            api_key_name = 'OPENAI_API_KEY'
-            self.llm = ChatOpenAI(
-                model=model_name,
-                api_key=api_key or os.getenv(api_key_name),
-                **self.model_kwargs
-            )
+        self.provider = 'together' if self.is_together else 'openai'
 
         self.base_prompt = ChatPromptTemplate.from_messages(PROMPTS[hub_prompt])
-        self.messages = []
         self.parser = None
+        self._output_parser = StrOutputParser()
+        self._llm = None
+        self._model = None
+        self._llm_lock = threading.Lock()
 
     @property
-    def llm_prompt(self):
-        return self.base_prompt + self.messages if self.messages else self.base_prompt
+    def llm(self) -> BaseChatModel:
+        """The chat model, created on first use."""
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    self._llm = self._create_llm()
+        return self._llm
 
     @property
-    def model(self):
-        if self.parser:
-            return self.llm_prompt | self.llm | self.parser
-        return self.llm_prompt | self.llm | StrOutputParser()
+    def model(self) -> Runnable:
+        """The chain of the prompt, the model and the output parser."""
+        if self._model is None:
+            self._model = self.base_prompt | self.llm | self._output_parser
+        return self._model
 
     def set_parser(self, parser: PydanticOutputParser | JsonOutputParser):
         self.parser = parser()
-
-    def append_llm_prompt(self, messages: list[MessageLikeRepresentation]):
-        self.messages = self.messages + messages
-
-    def reset_messages(self):
-        self.messages = []
+        self._output_parser = self.parser
+        self._model = None
+
+    def get_prompt(self, append_messages: list[MessageLikeRepresentation] | None = None) -> ChatPromptTemplate:
+        """Returns the prompt template of a call, with the `append_messages` of the call after the base prompt."""
+        return self.base_prompt + append_messages if append_messages else self.base_prompt
+
+    def get_num_prompt_tokens(self, doc_input: dict) -> int:
+        """
+        Returns the number of tokens of the prompt rendered with `doc_input`, without calling the model.
+
+        The tokens are counted with the tokenizer of the model. If the tokenizer is not available
+        (e.g., it cannot be downloaded or the model is unknown), they are approximated with 4 characters per token.
+        """
+        messages = self.base_prompt.invoke(doc_input).to_messages()
+        try:
+            return self.llm.get_num_tokens_from_messages(messages)
+        except Exception as e:
+            logging.debug(f'Cannot count the tokens of {self.model_name}, using an approximation: {e}')
+            return sum(len(str(message.content)) for message in messages) // 4
 
     def predict(self,
                 doc_input: dict,
                 append_messages: list[MessageLikeRepresentation] | None = None
                 ) -> str | BaseModel | dict:
-        if append_messages:
-            self.append_llm_prompt(messages=append_messages)
-        output = self.model.invoke(doc_input)
-        self.reset_messages()
-        return output
+        """
+        Predicts the output of `doc_input`.
+
+        Args:
+            doc_input (dict): The input of the prompt template.
+            append_messages (list[MessageLikeRepresentation] | None): Messages appended to the prompt of this call.
+
+        Returns:
+            str | BaseModel | dict: The output of the model, parsed with the parser of the wrapper, if any.
+        """
+        message = self._generate(self.get_prompt(append_messages).invoke(doc_input))
+        return self._output_parser.invoke(message)
+
+    def predict_json(self,
+                     doc_input: dict,
+                     required_keys: Iterable[str] = (),
+                     append_messages: list[MessageLikeRepresentation] | None = None
+                     ) -> dict:
+        """
+        Predicts the output of `doc_input` and returns the JSON enclosed in ```json ``` with all the `required_keys`.
+
+        With streaming enabled (see `streaming` in `__init__`), the response is parsed while it is generated and
+        the generation is stopped as soon as such a JSON block is complete, without the rest of the reasoning.
+
+        Args:
+            doc_input (dict): The input of the prompt template.
+            required_keys (Iterable[str]): The keys that the JSON must contain, e.g., `['question']`.
+            append_messages (list[MessageLikeRepresentation] | None): Messages appended to the prompt of this call.
+
+        Returns:
+            dict: The last JSON block of the response with the `required_keys` (the first one, when streaming),
+                or an empty dictionary if there is none.
+        """
+        required_keys = list(required_keys)
+        message = self._generate(self.get_prompt(append_messages).invoke(doc_input), required_keys=required_keys)
+        return _parse_json_output(message, required_keys)
+
+    async def apredict(self,
+                       doc_input: dict,
+                       append_messages: list[MessageLikeRepresentation] | None = None
+                       ) -> str | BaseModel | dict:
+        """
+        Asynchronous version of `predict`, calling the model with its async client.
+
+        The usage is recorded in the active profiler and budget of the task
+        awaiting the call.
+
+        Args:
+            doc_input (dict): The input of the prompt template.
+            append_messages (list[MessageLikeRepresentation] | None): Messages appended to the prompt of this call.
+
+        Returns:
+            str | BaseModel | dict: The output of the model, parsed with the parser of the wrapper, if any.
+        """
+        message = await self._agenerate(self.get_prompt(append_messages).invoke(doc_input))
+        return await self._output_parser.ainvoke(message)
+
+    def predict_batch(self,
+                      doc_inputs: list[dict],
+                      max_concurrency: int | None = None,
+                      required_keys: Iterable[str] | None = None
+                      ) -> list[str | BaseModel | dict | Exception]:
+        """
+        Predicts the outputs of many inputs with the batch support of the model, running up to
+        `max_concurrency` requests at the same time.
+
+        Errors do not stop the batch: the exception raised by an input (e.g., a provider error or an output
+        that cannot be parsed) is returned in place of its output.
+
+        Args:
+            doc_inputs (list[dict]): The inputs of the prompt template.
+            max_concurrency (int | None): The maximum number of requests running at the same time. If None, no limit.
+            required_keys (Iterable[str] | None): If not None, each output is the JSON with these keys extracted
+                as in `predict_json`, instead of the output of the parser.
+
+        Returns:
+            list[str | BaseModel | dict | Exception]: The output or the exception of each input, in the same order.
+        """
+        required_keys = list(required_keys) if required_keys is not None else None
+        outputs: list = [None] * len(doc_inputs)
+        to_call = []
+        for i, doc_input in enumerate(doc_inputs):
+            try:
+                to_call.append((i, self.base_prompt.invoke(doc_input)))
+            except Exception as e:
+                outputs[i] = e
+
+        if to_call:
+            messages = RunnableLambda(lambda prompt: self._generate(prompt, required_keys=required_keys)).batch(
+                [prompt for _, prompt in to_call],
+                config={'max_concurrency': max_concurrency},
+                return_exceptions=True
+            )
+            for (i, _), message in zip(to_call, messages):
+                outputs[i] = message
+
+        for i, message in enumerate(outputs):
+            if isinstance(message, Exception):
+                continue
+            try:
+                outputs[i] = (_parse_json_output(message, required_keys) if required_keys is not None
+                              else self._output_parser.invoke(message))
+            except Exception as e:
+                outputs[i] = e
+        return outputs
+
+    def _generate(self, prompt: PromptValue, required_keys: list[str] | None = None) -> BaseMessage:
+        """
+        Calls the model on the rendered `prompt`, reading and storing the response in the response cache.
+        With `required_keys` and streaming enabled, the response is streamed until it contains a JSON block
+        with these keys.
+        """
+        is_streamed = required_keys is not None and self.streaming == 'stop'
+        cache_key, message = self._read_cache(prompt, stop_keys=required_keys if is_streamed else None)
+        if message is not None:
+            return message
+        start = time.perf_counter()
+        if not is_streamed:
+            message = self._invoke_llm(prompt)
+        else:
+            message = _to_message(self._stream_llm(prompt, required_keys), prompt)
+        self._record_response(message, time.perf_counter() - start, cache_key)
+        return message
+
+    async def _agenerate(self, prompt: PromptValue) -> BaseMessage:
+        """Asynchronous version of `_generate`."""
+        cache_key, message = self._read_cache(prompt)
+        if message is not None:
+            return message
+        start = time.perf_counter()
+        message = await self.rate_limiter.acall(self.provider, self.model_name, lambda: self.llm.ainvoke(prompt),
+                                                estimated_tokens=_estimate_num_tokens(prompt),
+                                                count_tokens=_get_num_tokens)
+        self._record_response(message, time.perf_counter() - start, cache_key)
+        return message
+
+    def _invoke_llm(self, prompt: PromptValue) -> BaseMessage:
+        """Calls the model within the rate limits of the provider, retrying the transient errors."""
+        return self.rate_limiter.call(self.provider, self.model_name, lambda: self.llm.invoke(prompt),
+                                      estimated_tokens=_estimate_num_tokens(prompt),
+                                      count_tokens=_get_num_tokens)
+
+    def _stream_llm(self,
+                    prompt: PromptValue,
+                    required_keys: list[str]) -> AIMessageChunk | None:
+        """
+        Streams the response of the model until it contains a complete JSON block with the `required_keys`, then
+        closes the stream, stopping the generation. Returns the response read so far.
+        """
+
+        def stream():
+            chunks = self.llm.stream(prompt, stream_usage=True)
+            message = None
+            for chunk in chunks:
+                message = chunk if message is None else message + chunk
+                if '`' in str(chunk.content) and extract_json_output(str(message.content), required_keys) is not None:
+                    chunks.close()
+                    break
+            return message
+
+        return self.rate_limiter.call(self.provider, self.model_name, stream,
+                                      estimated_tokens=_estimate_num_tokens(prompt),
+                                      count_tokens=_get_num_tokens)
+
+    def _create_llm(self) -> BaseChatModel:
+        if self.is_offline:
+            return create_offline_chat_model(self.prompt_key)
+        # the retries are done by the rate limiter, and only the client of the provider in use is imported
+        if self.is_together:
+            from langchain_together import ChatTogether
+            return ChatTogether(
+                model=self.model_name,
+                api_key=self.api_key or os.getenv('TOGETHER_API_KEY'),
+                max_retries=0,
+                http_client=get_shared_http_client(self.provider),
+                **self.model_kwargs
+            )
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(
+            model=self.model_name,
+            api_key=self.api_key or os.getenv('OPENAI_API_KEY'),
+            max_retries=0,
+            http_client=get_shared_http_client(self.provider),
+            **self.model_kwargs
+        )
+
+    def _read_cache(self,
+                    prompt: PromptValue,
+                    stop_keys: list[str] | None = None) -> tuple[str | None, BaseMessage | None]:
+        """
+        Returns the cache key of `prompt` and its cached response, if any, metered as a cached call.
+        With `stop_keys`, the key is the one of the responses streamed in `stop` mode until a JSON block with
+        these keys: they are truncated, so they are cached apart from the full responses.
+        """
+        if self.response_cache is None:
+            return None, None
+        messages = [message_to_dict(message) for message in prompt.to_messages()]
+        model_kwargs = self.model_kwargs
+        if stop_keys is not None:
+            model_kwargs = {**model_kwargs, 'stream_stop_keys': sorted(stop_keys)}
+        cache_key = self.response_cache.get_key(self.model_name, self.prompt_key, messages, model_kwargs)
+        start = time.perf_counter()
+        with profile_stage('llm_cache'):
+            cached = self.response_cache.get(cache_key)
+        if cached is None:
+            return cache_key, None
+        message = messages_from_dict([cached])[0]
+        self._meter(message, time.perf_counter() - start, cached=True)
+        return cache_key, message
+
+    def _record_response(self, message: BaseMessage, wall_time: float, cache_key: str | None):
+        """Meters the usage of a model response and stores it in the response cache."""
+        self._meter(message, wall_time)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, message_to_dict(message))
+
+    def _meter(self, message: BaseMessage, wall_time: float, cached: bool = False):
+        usage = getattr(message, 'usage_metadata', None) or {}
+        meter_llm_call(self.provider, self.model_name, self.prompt_key,
+                       prompt_tokens=usage.get('input_tokens', 0), completion_tokens=usage.get('output_tokens', 0),
+                       latency=wall_time, cached=cached)
+
+
+def _to_message(chunk: AIMessageChunk | None, prompt: PromptValue) -> AIMessage:
+    """Converts a streamed response to a message, estimating its usage if the stream was stopped before it."""
+    content = str(chunk.content) if chunk is not None else ''
+    usage = getattr(chunk, 'usage_metadata', None)
+    if not usage:
+        prompt_tokens, completion_tokens = _estimate_num_tokens(prompt), len(content) // 4
+        usage = {'input_tokens': prompt_tokens, 'output_tokens': completion_tokens,
+                 'total_tokens': prompt_tokens + completion_tokens}
+    return AIMessage(content=content, usage_metadata=usage)
+
+
+def _parse_json_output(message: BaseMessage, required_keys: list[str]) -> dict:
+    output = extract_json_output(str(message.content), required_keys)
+    if output is None:
+        logging.warning(f'No json output with the keys {required_keys} found in model output')
+        return {}
+    return output
+
+
+def extract_json_output(model_output: str, required_keys: Iterable[str] = ()) -> dict | None:
+    """
+    Returns the last JSON enclosed in ```json ``` in `model_output` that contains all the `required_keys`.
+
+    Args:
+        model_output (str): The output of the model, e.g., a reasoning followed by the JSON answer.
+        required_keys (Iterable[str]): The keys that the JSON must contain.
+
+    Returns:
+        dict | None: The parsed JSON, or None if no complete JSON block contains all the keys.
+    """
+    for match in reversed(re.findall(r'```json.*?```', model_output, re.DOTALL)):
+        try:
+            output = JsonOutputParser().invoke(match)
+        except Exception:
+            continue
+        if isinstance(output, dict) and all(key in output for key in required_keys):
+            return output
+    return None
+
+
+def _estimate_num_tokens(prompt: PromptValue) -> int:
+    # fast approximation of the prompt tokens, corrected with the real usage after the call
+    return sum(len(str(message.content)) for message in prompt.to_messages()) // 4
+
+
+def _get_num_tokens(message: BaseMessage) -> int:
+    usage = getattr(message, 'usage_metadata', None) or {}
+    return usage.get('total_tokens', 0)
 
 
 def getter_json_output_from_resoning(model_output: str) -> dict:
@@ -90,6 +424,23 @@ def create_default_gpt4o(hub_prompt, model_kwargs: dict | None = None):
     return model
 
 
+def create_default_encoder(model: str = 'text-embedding-3-large') -> Embeddings:
+    """
+    Returns the embedding model of the generators: the OpenAI `model`, sending its requests through the
+    connection pool shared with the OpenAI chat models, or `OfflineEmbeddings` when the offline backend is
+    enabled (see `is_offline_backend`). When `SQUAB_EMBEDDING_CACHE_DIR` is set, the OpenAI embeddings are read
+    from the persistent cache of `model` (see `CachedEmbeddings`), and only the new texts are sent to the API.
+    """
+    if is_offline_backend():
+        return create_offline_embeddings()
+    from langchain_openai.embeddings import OpenAIEmbeddings
+    # up to 2048 texts in a request, the maximum of the OpenAI embeddings API
+    encoder = OpenAIEmbeddings(model=model, api_key=os.getenv('OPENAI_API_KEY'), chunk_size=2048,
+                               http_client=get_shared_http_client('openai'))
+    cache = get_default_embedding_cache(model)
+    return CachedEmbeddings(encoder, cache) if cache is not None else encoder
+
+
 def create_default_gpt4o_mini(hub_prompt, model_kwargs: dict | None = None):
     model = LangchainWrapper(
         model_name='gpt-4o-mini-2024-07-18',
@@ -0,0 +1,66 @@
+import re
+from collections import Counter
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# the words of an identifier: `customerReview`, `customer_review` and `CUSTOMER REVIEW` all give `customer`, `review`
+_WORD_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+
+
+def tokenize_identifier(identifier: str) -> list[str]:
+    """
+    Splits an identifier (e.g., a column name) in its lowercase words, on the underscores, spaces, digits and the
+    case changes of camel case: `avgLifeExpectancy_2020` gives `avg`, `life`, `expectancy`, `2020`.
+    """
+    return [word.lower() for word in _WORD_PATTERN.findall(identifier)]
+
+
+class IdentifierTfidfEmbeddings(Embeddings):
+    """
+    Local embedding model of identifiers, such as column names, computed without any network access.
+
+    Each identifier is split in words (see `tokenize_identifier`), and it is represented by its words and the
+    character n-grams of each word, so `review` and `reviews` or `manager` and `management` share features.
+    The features are weighted with TF-IDF over the texts of each `embed_documents` call (e.g., the columns of a
+    table): the words repeated in most of the columns, like the name of the table, weigh less than the
+    distinguishing ones. The embeddings are L2-normalized, so their dot product is the cosine similarity.
+
+    The similarity is lexical: `first_name` and `last_name` are similar, while `street_name` and `neighborhood`
+    are not, unlike with the embeddings of a language model.
+
+    Attributes:
+        ngram_size (int): The size of the character n-grams of each word.
+    """
+
+    def __init__(self, ngram_size: int = 4):
+        self.ngram_size = ngram_size
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        text2features = [self._get_features(text) for text in texts]
+        feature2index = {}
+        for features in text2features:
+            for feature in features:
+                feature2index.setdefault(feature, len(feature2index))
+        matrix = np.zeros((len(texts), max(len(feature2index), 1)), dtype=np.float64)
+        for i, features in enumerate(text2features):
+            for feature, count in features.items():
+                matrix[i, feature2index[feature]] = count
+        # smoothed IDF, as in scikit-learn: the features in every text keep a weight of 1
+        document_frequency = np.count_nonzero(matrix, axis=0)
+        matrix *= np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+        return matrix.tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def _get_features(self, text: str) -> Counter:
+        features = Counter()
+        for word in tokenize_identifier(text):
+            features[f'w:{word}'] += 1
+            padded_word = f'<{word}>'
+            for i in range(max(len(padded_word) - self.ngram_size + 1, 1)):
+                features[f'c:{padded_word[i:i + self.ngram_size]}'] += 1
+        return features
@@ -0,0 +1,188 @@
+import json
+import math
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict
+
+from squab.budget import charge_llm_call, estimate_llm_cost
+from squab.profiling import get_current_scope, get_current_stage, record_llm_call
+
+# the meters active in the current context, from the outermost to the innermost
+_active_meters: ContextVar[tuple['UsageMeter', ...]] = ContextVar('squab_active_meters', default=())
+
+_PERCENTILES = (50, 90, 99)
+
+
+@dataclass
+class LLMCallUsage:
+    """
+    Usage of a single language model call.
+
+    Attributes:
+        provider (str): The provider of the model, e.g., `openai`, `together`, `gemini`.
+        model_name (str): The name of the model.
+        prompt_key (str): The key in `PROMPTS` of the prompt of the call.
+        prompt_tokens (int): The prompt tokens of the call.
+        completion_tokens (int): The completion tokens of the call.
+        latency (float): The wall time of the call, in seconds, including the waits for the rate limits and the retries.
+        cost (float): The dollar cost of the call (see `estimate_llm_cost`), 0 for the responses read from the cache.
+        cached (bool): Whether the response was read from the response cache.
+        test_category (str): The test category generating the call, if any.
+        table_name (str): The table generating the call, if any.
+        stage (str): The pipeline stage of the call (e.g., `tests_generator`), if any.
+    """
+    provider: str
+    model_name: str
+    prompt_key: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency: float
+    cost: float
+    cached: bool = False
+    test_category: str = ''
+    table_name: str = ''
+    stage: str = ''
+
+
+class UsageMeter:
+    """
+    Collects the usage of every language model call made while it is active, whatever the provider.
+
+    The model wrappers report each call (see `meter_llm_call`) with its tokens, latency, cost, model, prompt and
+    the test category, table and stage generating it. Meters can be nested: a call is recorded by every active meter,
+    so a meter of a single test and the meter of its table both count it. They are thread-safe and, like the
+    profiler and the budget, they see the calls of the worker threads copying the context.
+
+    `report` aggregates the calls by model, by prompt and by stage, with the latency percentiles of each group.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: list[LLMCallUsage] = []
+
+    @contextmanager
+    def activate(self):
+        """Records in this meter the calls made inside the block, in addition to the meters already active."""
+        token = _active_meters.set(_active_meters.get() + (self,))
+        try:
+            yield self
+        finally:
+            _active_meters.reset(token)
+
+    def record(self, usage: LLMCallUsage):
+        with self._lock:
+            self._calls.append(usage)
+
+    @property
+    def calls(self) -> list[LLMCallUsage]:
+        with self._lock:
+            return list(self._calls)
+
+    @property
+    def total_cost(self) -> float:
+        return sum(usage.cost for usage in self.calls)
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(usage.prompt_tokens + usage.completion_tokens for usage in self.calls)
+
+    def to_records(self) -> list[dict]:
+        """Returns the calls as a list of records, one for each call."""
+        return [asdict(usage) for usage in self.calls]
+
+    def merge(self, records: list[dict]):
+        """Adds the calls of records produced by `to_records` of another meter (e.g., of a worker process)."""
+        with self._lock:
+            self._calls.extend(LLMCallUsage(**record) for record in records)
+
+    def report(self) -> dict:
+        """
+        Returns a machine-readable report of the calls: the totals and the statistics by model (provider and model
+        name), by prompt (model and prompt key) and by stage (test category and stage). Each entry has the number of
+        calls and of cached calls, the prompt and completion tokens, the cost, and the mean and the percentiles
+        (50, 90, 99) of the latency of the calls not read from the cache.
+        """
+        calls = self.calls
+        return {
+            'totals': _aggregate(calls),
+            'by_model': _group_by(calls, ('provider', 'model_name')),
+            'by_prompt': _group_by(calls, ('model_name', 'prompt_key')),
+            'by_stage': _group_by(calls, ('test_category', 'stage')),
+        }
+
+    def dump(self, path: str):
+        """Writes the `report` to `path` as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def get_active_meters() -> tuple[UsageMeter, ...]:
+    return _active_meters.get()
+
+
+def meter_llm_call(provider: str,
+                   model_name: str,
+                   prompt_key: str,
+                   prompt_tokens: int,
+                   completion_tokens: int,
+                   latency: float,
+                   cached: bool = False):
+    """
+    Reports a language model call: records it in the active meters and, unless its response was read from the
+    cache, in the `llm` stage of the active profiler and in the active budget.
+
+    Args:
+        provider (str): The provider of the model.
+        model_name (str): The name of the model.
+        prompt_key (str): The key in `PROMPTS` of the prompt of the call.
+        prompt_tokens (int): The prompt tokens of the call.
+        completion_tokens (int): The completion tokens of the call.
+        latency (float): The wall time of the call, in seconds.
+        cached (bool): Whether the response was read from the response cache, at no cost.
+    """
+    cost = 0.0
+    if not cached:
+        cost = estimate_llm_cost(model_name, prompt_tokens, completion_tokens)
+        record_llm_call(latency, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        charge_llm_call(model_name, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cost=cost)
+    meters = _active_meters.get()
+    if not meters:
+        return
+    test_category, table_name = get_current_scope() or ('', '')
+    usage = LLMCallUsage(provider=provider, model_name=model_name, prompt_key=prompt_key,
+                         prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, latency=latency,
+                         cost=cost, cached=cached, test_category=test_category, table_name=table_name,
+                         stage=get_current_stage() or '')
+    for meter in meters:
+        meter.record(usage)
+
+
+def _group_by(calls: list[LLMCallUsage], keys: tuple[str, ...]) -> list[dict]:
+    key2calls = {}
+    for usage in calls:
+        key2calls.setdefault(tuple(getattr(usage, key) for key in keys), []).append(usage)
+    return [{**dict(zip(keys, key)), **_aggregate(group)} for key, group in key2calls.items()]
+
+
+def _aggregate(calls: list[LLMCallUsage]) -> dict:
+    # the cached calls would skew the latency of the provider
+    latencies = sorted(usage.latency for usage in calls if not usage.cached)
+    return {
+        'calls': len(calls),
+        'cached_calls': sum(usage.cached for usage in calls),
+        'prompt_tokens': sum(usage.prompt_tokens for usage in calls),
+        'completion_tokens': sum(usage.completion_tokens for usage in calls),
+        'cost': sum(usage.cost for usage in calls),
+        'latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+        **{f'latency_p{percentile}': _percentile(latencies, percentile) for percentile in _PERCENTILES},
+    }
+
+
+def _percentile(sorted_values: list[float], percentile: float) -> float:
+    """Returns the `percentile` of `sorted_values`, interpolating linearly between the closest ranks."""
+    if not sorted_values:
+        return 0.0
+    rank = (len(sorted_values) - 1) * percentile / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
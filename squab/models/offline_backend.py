@@ -0,0 +1,248 @@
+import asyncio
+import ast
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import time
+from typing import Any, Callable, Iterator
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# characters of each chunk of a streamed answer
+_STREAM_CHUNK_SIZE = 16
+
+# private generator, the latency must not change the global random state used by the pipeline
+_latency_rng = random.Random()
+
+
+class OfflineChatModel(BaseChatModel):
+    """
+    Local stand-in of a chat model, answering without any network access.
+
+    The answer is built from the rendered prompt of the `PROMPTS` key of the wrapper and follows the output
+    format of that prompt (e.g., the JSON keys parsed by the generators), so the whole pipeline runs end to end
+    with the SQL, QATCH and pandas work of a real run. Each call sleeps for a synthetic latency and reports a
+    usage approximated with 4 characters per token, so the profiler and the budgets see realistic numbers.
+    When streamed, the latency is spread over the chunks and the usage is sent with the last one, as the providers do.
+
+    Attributes:
+        prompt_key (str): The key in `PROMPTS` of the prompt answered by the model.
+        latency (float): The mean latency of a call, in seconds.
+        latency_jitter (float): The latency of a call is drawn uniformly in `latency * (1 ± latency_jitter)`.
+    """
+
+    prompt_key: str
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'squab-offline'
+
+    def _generate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._get_latency())
+        return self._get_result(messages)
+
+    async def _agenerate(self, messages: list[BaseMessage], stop=None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._get_latency())
+        return self._get_result(messages)
+
+    def _stream(self, messages: list[BaseMessage], stop=None, run_manager=None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        message = self._get_result(messages).generations[0].message
+        content = str(message.content)
+        pieces = [content[i:i + _STREAM_CHUNK_SIZE] for i in range(0, len(content), _STREAM_CHUNK_SIZE)]
+        latency = self._get_latency()
+        for piece in pieces:
+            time.sleep(latency / len(pieces))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=message.usage_metadata))
+
+    def _get_latency(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        return max(self.latency * (1 + _latency_rng.uniform(-self.latency_jitter, self.latency_jitter)), 0.0)
+
+    def _get_result(self, messages: list[BaseMessage]) -> ChatResult:
+        human_text = '\n'.join(str(message.content) for message in messages if isinstance(message, HumanMessage))
+        content = _PROMPT_KEY2RESPONSE.get(self.prompt_key, lambda _: '{}')(human_text)
+        prompt_tokens = sum(len(str(message.content)) for message in messages) // 4
+        completion_tokens = len(content) // 4
+        message = AIMessage(content=content,
+                            usage_metadata={'input_tokens': prompt_tokens,
+                                            'output_tokens': completion_tokens,
+                                            'total_tokens': prompt_tokens + completion_tokens})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class OfflineEmbeddings(Embeddings):
+    """
+    Local stand-in of an embedding model, answering without any network access.
+
+    A text is embedded as the normalized histogram of its hashed character trigrams, so texts sharing many
+    trigrams (e.g., `first_name` and `last_name`) have similar embeddings, as with a real model.
+
+    Attributes:
+        dimensions (int): The size of the embeddings.
+        latency (float): The latency of each call, in seconds.
+    """
+
+    def __init__(self, dimensions: int = 256, latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.0] * self.dimensions
+        text = f'  {text.lower()} '
+        for i in range(len(text) - 2):
+            digest = hashlib.md5(text[i:i + 3].encode('utf-8')).digest()
+            vector[int.from_bytes(digest[:4], 'little') % self.dimensions] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+
+def is_offline_backend() -> bool:
+    """Whether the offline backend is enabled with `SQUAB_LLM_BACKEND=offline`."""
+    return os.getenv('SQUAB_LLM_BACKEND', '').lower() == 'offline'
+
+
+def create_offline_chat_model(prompt_key: str) -> OfflineChatModel:
+    """
+    Returns the offline chat model of `prompt_key`, with the latency set by `SQUAB_OFFLINE_LATENCY`
+    (seconds, 0 by default) and `SQUAB_OFFLINE_LATENCY_JITTER` (fraction of the latency, 0 by default).
+    """
+    return OfflineChatModel(prompt_key=prompt_key,
+                            latency=float(os.getenv('SQUAB_OFFLINE_LATENCY', '0')),
+                            latency_jitter=float(os.getenv('SQUAB_OFFLINE_LATENCY_JITTER', '0')))
+
+
+def create_offline_embeddings() -> OfflineEmbeddings:
+    """Returns the offline embedding model, with the latency set by `SQUAB_OFFLINE_LATENCY` (seconds, 0 by default)."""
+    return OfflineEmbeddings(latency=float(os.getenv('SQUAB_OFFLINE_LATENCY', '0')))
+
+
+def _get_section(text: str, header: str) -> str:
+    """Returns the text after `header` up to the next markdown header or the end."""
+    match = re.search(rf'{re.escape(header)}\s*:?\s*(.*?)(?:\n\s*#|\Z)', text, re.DOTALL)
+    return match.group(1).strip() if match else ''
+
+
+def _get_names(text: str) -> list[str]:
+    """Parses a list of names rendered in a prompt, either as a Python list or comma separated."""
+    try:
+        names = ast.literal_eval(text)
+        if isinstance(names, (list, tuple)):
+            return [str(name) for name in names]
+    except (ValueError, SyntaxError):
+        pass
+    return [name.strip(' "\'`[]') for name in text.split(',') if name.strip(' "\'`[]')]
+
+
+def _get_num_to_generate(text: str) -> int:
+    match = re.search(r'Num to generate:?\s*(\d+)', text)
+    return max(int(match.group(1)), 1) if match else 1
+
+
+def _get_output_types(text: str, num: int) -> list[str]:
+    """Returns the categorical/numerical type of each generated item, following the types requested in the prompt."""
+    num_to_generate = _get_section(text, 'Num to generate')
+    if 'mixed' not in num_to_generate:
+        if 'numerical' in num_to_generate:
+            return ['numerical'] * num
+        if 'categorical' in num_to_generate:
+            return ['categorical'] * num
+    return ['numerical' if i % 2 == 0 else 'categorical' for i in range(num)]
+
+
+def _json_block(output) -> str:
+    return f'```json\n{json.dumps(output, indent=2)}\n```'
+
+
+def _get_question(text: str) -> str:
+    queries = _get_section(text, '## queries').splitlines()
+    return f'What is the answer of {queries[0].strip() if queries else "the query"}?'
+
+
+def _get_udfs(text: str) -> str:
+    tbl_schema = _get_names(_get_section(text, 'Table Schema')) or ['value']
+    blocks = []
+    for i, udf_output_type in enumerate(_get_output_types(text, _get_num_to_generate(text))):
+        udf_name = f'offline_udf_{i}'
+        udf = {'udf_name': f'{udf_name}(`{tbl_schema[i % len(tbl_schema)]}`)',
+               'udf_description': 'Stand-in user-defined function of the offline backend.',
+               'udf_output_type': udf_output_type}
+        code = f'def {udf_name}(value):\n    return {0.0 if udf_output_type == "numerical" else repr("category")}\n'
+        blocks.append(f'# New UDF\n{_json_block(udf)}\n```python\n{code}```')
+    return '\n'.join(blocks)
+
+
+def _get_oos_udfs(text: str) -> str:
+    tbl_schema = _get_names(_get_section(text, 'Table Schema')) or ['value']
+    return _json_block({'suggested_udfs': [
+        {'udf_name': f'offline_oos_udf_{i}(`{tbl_schema[i % len(tbl_schema)]}`)',
+         'udf_description': 'Stand-in user-defined function of the offline backend.',
+         'udf_output_type': udf_output_type}
+        for i, udf_output_type in enumerate(_get_output_types(text, _get_num_to_generate(text)))
+    ]})
+
+
+def _get_new_columns(text: str) -> str:
+    return _json_block({'suggested_columns': [
+        {'column_name': f'offline_column_{i}',
+         'column_type': column_type,
+         'description': 'Stand-in column of the offline backend.',
+         'sample_data': ['a', 'b'] if column_type == 'categorical' else [1.0, 2.0]}
+        for i, column_type in enumerate(_get_output_types(text, _get_num_to_generate(text)))
+    ]})
+
+
+def _get_label(text: str) -> str:
+    cols = _get_names(_get_section(text, '## Semantic related columns'))
+    return _json_block({'label': f'{" or ".join(cols) or "column"} (label)'})
+
+
+def _get_entity_component(text: str) -> str:
+    names = _get_names(text.strip())
+    if len(names) < 2:
+        return _json_block({'entity': None, 'component': None})
+    return _json_block({'entity': names[0], 'component': names[1]})
+
+
+def _get_ambiguous_labels(text: str) -> str:
+    cols = _get_names(_get_section(text, 'Columns'))
+    return json.dumps([f'{" or ".join(cols) or "column"} ({i})' for i in range(_get_num_to_generate(text))])
+
+
+def _get_question_answer_pairs(text: str) -> str:
+    return _json_block([{'nl_question': 'What are all the rows of the table?', 'target': ['SELECT 1']}])
+
+
+# the answer of each prompt key, following the output format of the prompt
+_PROMPT_KEY2RESPONSE: dict[str, Callable[[str], str]] = {
+    'all_llm_unans_prompt': _get_question_answer_pairs,
+    'all_llm_ambiguous_prompt': _get_question_answer_pairs,
+    'ambrosia-text2sql': lambda _: 'SELECT 1',
+    'ambrosia-text-2-sql-unanswerable': lambda _: 'NOT ANSWERABLE',
+    'label_columns_selector': _get_label,
+    'sql-to-text': lambda text: _json_block({'question': _get_question(text)}),
+    'scope_pattern_semantic': _get_entity_component,
+    'unanswerable-udf_generation': _get_udfs,
+    'unanswerable-udf_generation_oos': _get_oos_udfs,
+    'question_variability': lambda text: _json_block({'question': _get_question(text)}),
+    'ambiguity-col_generator': _get_ambiguous_labels,
+    'unanswerable-column_generation': _get_new_columns,
+}
@@ -0,0 +1,270 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Awaitable, Callable, TypeVar
+
+from squab.profiling import get_active_profiler
+
+T = TypeVar('T')
+
+# status codes and exception names of the provider errors worth retrying
+_TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+_TRANSIENT_ERROR_NAMES = {
+    'RateLimitError', 'APITimeoutError', 'APIConnectionError', 'InternalServerError',  # OpenAI and Together
+    'ResourceExhausted', 'ServiceUnavailable', 'DeadlineExceeded', 'TooManyRequests',  # Gemini
+}
+
+_config2limiter: dict[tuple[str, str], 'RateLimiter'] = {}
+_config2limiter_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` units per second up to `capacity`.
+
+    `reserve` never blocks: it takes the units immediately, possibly leaving the bucket in debt, and returns
+    the time the caller must wait before using them. Callers are served in reservation order.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` units and returns the seconds to wait before they are available."""
+        with self._lock:
+            now = time.monotonic()
+            self._level = min(self.capacity, self._level + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._level -= amount
+            return max(-self._level / self.rate, 0.0)
+
+    def adjust(self, amount: float):
+        """Takes `amount` more units (or gives them back, if negative) without waiting."""
+        with self._lock:
+            self._level = min(self.capacity, self._level - amount)
+
+
+@dataclass
+class ThrottleStats:
+    requests: int = 0
+    throttled: int = 0
+    throttle_time: float = 0.0
+    retries: int = 0
+    retry_time: float = 0.0
+    failures: int = 0
+
+
+class RateLimiter:
+    """
+    Client-side rate limiter and retry policy shared by the model wrappers.
+
+    The limits are token buckets of requests and tokens per minute, configured for a provider (e.g., `openai`,
+    `together`, `gemini`) and, optionally, for a single model of a provider (e.g., `openai/gpt-4o`).
+    A call waits until both the provider and the model buckets allow it. The tokens of a call are estimated
+    before sending it and corrected with the real usage of the response.
+
+    Transient errors (rate limits, timeouts, connection and server errors) are retried up to `max_retries`
+    times with exponential backoff and full jitter, honoring the `Retry-After` header when the provider sends it.
+    Other errors are raised immediately.
+
+    The time spent waiting for the buckets and for the backoff is recorded in the `rate_limit` and `llm_retry`
+    stages of the active profiler, and the throttling statistics of each provider and model are returned by `stats`.
+    The limits are enforced within a process: processes running in parallel should each receive a share of them.
+
+    Attributes:
+        limits (dict[str, dict[str, float]]): For each `provider` or `provider/model`, the `requests_per_minute`
+            and `tokens_per_minute` (both optional).
+        max_retries (int): The maximum number of retries of a call failing with a transient error.
+        base_delay (float): The backoff of the first retry, in seconds. It doubles at each retry.
+        max_delay (float): The maximum backoff, in seconds.
+    """
+
+    def __init__(self,
+                 limits: dict[str, dict[str, float]] | None = None,
+                 max_retries: int = 5,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+        """
+        Args:
+            limits (dict[str, dict[str, float]] | None): The limits of each `provider` or `provider/model`, e.g.,
+                `{'openai': {'requests_per_minute': 500, 'tokens_per_minute': 200000}}`. None for no limit.
+            max_retries (int): The maximum number of retries of a call failing with a transient error.
+            base_delay (float): The backoff of the first retry, in seconds.
+            max_delay (float): The maximum backoff, in seconds.
+        """
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._buckets: dict[tuple[str, str], TokenBucket] = {}
+        self._stats: dict[tuple[str, str], ThrottleStats] = {}
+
+    def call(self,
+             provider: str,
+             model_name: str,
+             fun: Callable[[], T],
+             estimated_tokens: int = 0,
+             count_tokens: Callable[[T], int] | None = None) -> T:
+        """
+        Calls `fun` within the limits of the provider and the model, retrying its transient errors.
+
+        Args:
+            provider (str): The provider of the model, e.g., `openai`.
+            model_name (str): The name of the model.
+            fun (Callable[[], T]): The call to the model.
+            estimated_tokens (int): The tokens of the call reserved before sending it.
+            count_tokens (Callable[[T], int] | None): Returns the real tokens of the response of `fun`,
+                used to correct the estimate. If None (or it returns 0), the estimate is kept.
+
+        Returns:
+            T: The output of `fun`.
+
+        Raises:
+            Exception: The error of `fun`, if it is not transient or it persists after `max_retries` retries.
+        """
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._acquire(provider, model_name, estimated_tokens))
+            try:
+                output = fun()
+            except Exception as e:
+                time.sleep(self._get_retry_delay(provider, model_name, e, attempt))
+                continue
+            self._settle(provider, model_name, estimated_tokens, output, count_tokens)
+            return output
+
+    async def acall(self,
+                    provider: str,
+                    model_name: str,
+                    fun: Callable[[], Awaitable[T]],
+                    estimated_tokens: int = 0,
+                    count_tokens: Callable[[T], int] | None = None) -> T:
+        """Asynchronous version of `call`, awaiting `fun` and sleeping without blocking the event loop."""
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._acquire(provider, model_name, estimated_tokens))
+            try:
+                output = await fun()
+            except Exception as e:
+                await asyncio.sleep(self._get_retry_delay(provider, model_name, e, attempt))
+                continue
+            self._settle(provider, model_name, estimated_tokens, output, count_tokens)
+            return output
+
+    def stats(self) -> list[dict]:
+        """Returns the throttling statistics of each (provider, model) called so far."""
+        with self._lock:
+            return [{'provider': provider, 'model_name': model_name, **asdict(stats)}
+                    for (provider, model_name), stats in self._stats.items()]
+
+    def _get_buckets(self, provider: str, model_name: str) -> list[tuple[TokenBucket, bool]]:
+        """Returns the buckets limiting the calls to the model, each with whether it counts tokens or requests."""
+        buckets = []
+        with self._lock:
+            for limit_key in (provider, f'{provider}/{model_name}'):
+                for limit_name in ('requests_per_minute', 'tokens_per_minute'):
+                    per_minute = self.limits.get(limit_key, {}).get(limit_name)
+                    if not per_minute:
+                        continue
+                    bucket_key = (limit_key, limit_name)
+                    if bucket_key not in self._buckets:
+                        self._buckets[bucket_key] = TokenBucket(rate=per_minute / 60, capacity=per_minute)
+                    buckets.append((self._buckets[bucket_key], limit_name == 'tokens_per_minute'))
+        return buckets
+
+    def _acquire(self, provider: str, model_name: str, estimated_tokens: int) -> float:
+        """Reserves a request and the estimated tokens, and returns the seconds to wait before sending it."""
+        wait = 0.0
+        for bucket, is_tokens in self._get_buckets(provider, model_name):
+            wait = max(wait, bucket.reserve(estimated_tokens if is_tokens else 1))
+        with self._lock:
+            stats = self._stats.setdefault((provider, model_name), ThrottleStats())
+            stats.requests += 1
+            if wait > 0:
+                stats.throttled += 1
+                stats.throttle_time += wait
+        if wait > 0:
+            profiler = get_active_profiler()
+            if profiler is not None:
+                profiler.record('rate_limit', wait)
+        return wait
+
+    def _settle(self, provider: str, model_name: str, estimated_tokens: int, output, count_tokens):
+        """Corrects the tokens reserved for a call with its real usage."""
+        num_tokens = count_tokens(output) if count_tokens is not None else 0
+        if not num_tokens:
+            return
+        delta = num_tokens - estimated_tokens
+        for bucket, is_tokens in self._get_buckets(provider, model_name):
+            if is_tokens:
+                bucket.adjust(delta)
+
+    def _get_retry_delay(self, provider: str, model_name: str, error: Exception, attempt: int) -> float:
+        """Returns the backoff before retrying a call failed with `error`, or raises `error` if it cannot be retried."""
+        if not is_transient_error(error):
+            raise error
+        with self._lock:
+            stats = self._stats.setdefault((provider, model_name), ThrottleStats())
+            if attempt >= self.max_retries:
+                stats.failures += 1
+        if attempt >= self.max_retries:
+            raise error
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        with self._lock:
+            stats.retries += 1
+            stats.retry_time += delay
+        logging.warning(f'{provider}/{model_name}: {type(error).__name__}, retry {attempt + 1}/{self.max_retries} '
+                        f'in {delay:.1f}s')
+        profiler = get_active_profiler()
+        if profiler is not None:
+            profiler.record('llm_retry', delay)
+        return delay
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether `error` is a provider error worth retrying (rate limit, timeout, connection or server error)."""
+    status_code = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if isinstance(status_code, int) and status_code in _TRANSIENT_STATUS_CODES:
+        return True
+    return type(error).__name__ in _TRANSIENT_ERROR_NAMES
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """Returns the seconds in the `Retry-After` header of the response of `error`, if any."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_default_rate_limiter() -> RateLimiter:
+    """
+    Returns the rate limiter configured with the environment variables, shared by all the wrappers of the process.
+
+    `SQUAB_RATE_LIMITS` sets the limits as JSON, e.g.,
+    `{"openai": {"requests_per_minute": 500, "tokens_per_minute": 200000}, "together/<model>": {...}}`.
+    `SQUAB_LLM_MAX_RETRIES` sets the maximum number of retries (5 by default). Without limits, the calls are
+    only retried.
+    """
+    config = (os.getenv('SQUAB_RATE_LIMITS', ''), os.getenv('SQUAB_LLM_MAX_RETRIES', ''))
+    with _config2limiter_lock:
+        if config not in _config2limiter:
+            limits, max_retries = config
+            _config2limiter[config] = RateLimiter(limits=json.loads(limits) if limits else None,
+                                                  max_retries=int(max_retries) if max_retries else 5)
+        return _config2limiter[config]
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Literal
+
+CacheMode = Literal['read_write', 'read_only', 'replay']
+
+_path2cache: dict[tuple, 'ResponseCache'] = {}
+_path2cache_lock = threading.Lock()
+
+
+class ResponseCacheMiss(KeyError):
+    """Raised in `replay` mode when a prompt is not in the cache."""
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of the model responses, stored in a local SQLite file.
+
+    A response is keyed by the hash of the model name, the prompt key, the rendered messages and the
+    model kwargs, so re-sending an identical prompt to the same model reads the response from disk
+    instead of paying for it again. The cache can be shared by multiple threads and processes.
+
+    The cache works in three modes:
+        - `read_write`: misses call the model and store the response.
+        - `read_only`: misses call the model, but nothing is written to the cache.
+        - `replay`: misses raise `ResponseCacheMiss`, no model is ever called.
+
+    When `max_size_mb` is set, the least recently used responses are evicted to keep the stored
+    responses under the limit.
+
+    Attributes:
+        path (str): The path of the SQLite file of the cache.
+        mode (CacheMode): The cache mode.
+        max_size_mb (float | None): The maximum size of the stored responses in MB. None for no limit.
+        hits (int): The number of responses read from the cache.
+        misses (int): The number of prompts not found in the cache.
+    """
+
+    def __init__(self, path: str, mode: CacheMode = 'read_write', max_size_mb: float | None = None):
+        """
+        Args:
+            path (str): The path of the SQLite file. It is created if it does not exist.
+            mode (CacheMode): The cache mode.
+            max_size_mb (float | None): The maximum size of the stored responses in MB. None for no limit.
+        """
+        if mode not in ('read_write', 'read_only', 'replay'):
+            raise ValueError(f"mode must be one of 'read_write', 'read_only', 'replay', got {mode}")
+        self.path = path
+        self.mode = mode
+        self.max_size_mb = max_size_mb
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, '
+            'response TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'last_access REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+
+    @staticmethod
+    def get_key(model_name: str, prompt_key: str, messages: list, model_kwargs: dict | None = None) -> str:
+        """
+        Returns the content-addressed key of a prompt.
+
+        Args:
+            model_name (str): The name of the model.
+            prompt_key (str): The key of the prompt template in `PROMPTS`.
+            messages (list): The rendered messages sent to the model, JSON-serializable.
+            model_kwargs (dict | None): The generation kwargs of the model (e.g., the temperature).
+
+        Returns:
+            str: The SHA-256 hash of the prompt.
+        """
+        content = json.dumps(
+            {'model_name': model_name, 'prompt_key': prompt_key, 'messages': messages, 'model_kwargs': model_kwargs},
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        """
+        Returns the cached response of `key`, or None if it is not in the cache.
+
+        Raises:
+            ResponseCacheMiss: If `key` is not in the cache and the mode is `replay`.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.mode == 'read_write':
+                self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            if row is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if row is None and self.mode == 'replay':
+            raise ResponseCacheMiss(f'Prompt {key} not found in the response cache {self.path}')
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key: str, response: dict):
+        """
+        Stores the JSON-serializable `response` of `key`. Nothing is stored unless the mode is `read_write`.
+        """
+        if self.mode != 'read_write':
+            return
+        serialized = json.dumps(response, default=str)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                               (key, serialized, len(serialized.encode('utf-8')), time.time()))
+            if self.max_size_mb is not None:
+                self._evict(int(self.max_size_mb * 1024 * 1024))
+
+    def _evict(self, max_size: int):
+        total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= max_size:
+            return
+        to_delete = []
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            if total_size <= max_size:
+                break
+            to_delete.append((key,))
+            total_size -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', to_delete)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_default_response_cache() -> ResponseCache | None:
+    """
+    Returns the response cache configured with the environment variables, or None if the cache is disabled.
+
+    The cache is opt-in: it is enabled by setting `SQUAB_LLM_CACHE_PATH` to the path of the cache file.
+    `SQUAB_LLM_CACHE_MODE` sets the mode (`read_write` by default, `read_only` or `replay`) and
+    `SQUAB_LLM_CACHE_MAX_SIZE_MB` the maximum size. One cache is opened for each configuration and process.
+    """
+    path = os.getenv('SQUAB_LLM_CACHE_PATH')
+    if not path:
+        return None
+    mode = os.getenv('SQUAB_LLM_CACHE_MODE', 'read_write')
+    max_size_mb = os.getenv('SQUAB_LLM_CACHE_MAX_SIZE_MB')
+    # the pid is part of the key: a forked worker must open its own connection, not reuse the one of its parent
+    config = (os.getpid(), os.path.abspath(path), mode, float(max_size_mb) if max_size_mb else None)
+    with _path2cache_lock:
+        if config not in _path2cache:
+            _path2cache[config] = ResponseCache(path, mode=mode, max_size_mb=config[3])
+        return _path2cache[config]
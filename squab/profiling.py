@@ -0,0 +1,220 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict
+from functools import wraps
+
+from sqlalchemy import event
+
+_active_profiler: ContextVar['PipelineProfiler | None'] = ContextVar('squab_active_profiler', default=None)
+_active_scope: ContextVar[tuple[str, str] | None] = ContextVar('squab_profiling_scope', default=None)
+_active_stage: ContextVar[str | None] = ContextVar('squab_profiling_stage', default=None)
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    wall_time: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class PipelineProfiler:
+    """
+    Collects per-stage timing and resource usage of the generation pipeline.
+
+    For every (test category, table, stage) the profiler records the number of calls, the wall time
+    and, for the `llm` stage, the prompt and completion tokens. The stages recorded by the pipeline are:
+        - `load_tables`: loading the tables and their metadata from the database.
+        - `pattern_identification`, `metadata_generator`, `tests_generator`: the generator steps.
+        - `schema_dump`: building the database schema included in the prompts.
+        - `qatch`: the QATCH query generation.
+        - `llm`: the calls to the language models.
+        - `llm_cache`: the lookups in the response cache, when enabled.
+        - `rate_limit`: the waits for the client-side rate limits of the providers.
+        - `llm_retry`: the backoff before retrying an LLM call failed with a transient error.
+        - `sql`: every query executed on the database.
+        - `embeddings`: the embedding of the columns of all the databases before the generation (`column_ambiguity`).
+    Wall times are inclusive: the time of a `tests_generator` call also contains the `llm`,
+    `schema_dump` and `sql` time spent inside it.
+
+    The profiler is enabled with `activate`; while active, the instrumented functions record into it.
+    It is thread-safe and can be shared by the concurrent calls of a run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: dict[tuple[str, str, str], StageStats] = {}
+        # scope of the last table, used by the threads that do not inherit the context (e.g., SQL timeouts)
+        self._last_scope: tuple[str, str] = ('', '')
+        self._engines = []
+
+    @contextmanager
+    def activate(self):
+        """Makes this profiler the active one in the current context."""
+        token = _active_profiler.set(self)
+        try:
+            yield self
+        finally:
+            _active_profiler.reset(token)
+            with self._lock:
+                engines, self._engines = self._engines, []
+            for engine, before, after in engines:
+                event.remove(engine, 'before_cursor_execute', before)
+                event.remove(engine, 'after_cursor_execute', after)
+
+    def record(self, stage: str, wall_time: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+               scope: tuple[str, str] | None = None):
+        """
+        Adds a call of `stage` to the statistics of the current scope.
+
+        Args:
+            stage (str): The name of the stage.
+            wall_time (float): The wall time of the call, in seconds.
+            prompt_tokens (int): The prompt tokens consumed by the call.
+            completion_tokens (int): The completion tokens produced by the call.
+            scope (tuple[str, str] | None): The (test category, table) of the call. If None, the current scope.
+        """
+        scope = scope or _active_scope.get() or self._last_scope
+        with self._lock:
+            stats = self._stats.setdefault((*scope, stage), StageStats())
+            stats.calls += 1
+            stats.wall_time += wall_time
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+
+    def watch_engine(self, engine):
+        """
+        Records the time of every SQL query executed through the SQLAlchemy `engine` in the `sql` stage.
+
+        Args:
+            engine (sqlalchemy.engine.Engine): The engine to watch. It is released when the profiler is deactivated.
+        """
+        with self._lock:
+            if any(watched is engine for watched, _, _ in self._engines):
+                return
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('squab_query_start', []).append(time.perf_counter())
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            starts = conn.info.get('squab_query_start')
+            if starts:
+                self.record('sql', time.perf_counter() - starts.pop())
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        with self._lock:
+            self._engines.append((engine, before_cursor_execute, after_cursor_execute))
+
+    def to_records(self) -> list[dict]:
+        """
+        Returns the collected statistics as a list of records, one for each (test category, table, stage).
+        """
+        with self._lock:
+            return [{'test_category': category, 'table_name': tbl_name, 'stage': stage, **asdict(stats)}
+                    for (category, tbl_name, stage), stats in self._stats.items()]
+
+    def merge(self, records: list[dict]):
+        """
+        Adds the statistics of records produced by `to_records` of another profiler (e.g., of a worker process).
+        """
+        with self._lock:
+            for record in records:
+                stats = self._stats.setdefault((record['test_category'], record['table_name'], record['stage']),
+                                               StageStats())
+                stats.calls += record['calls']
+                stats.wall_time += record['wall_time']
+                stats.prompt_tokens += record['prompt_tokens']
+                stats.completion_tokens += record['completion_tokens']
+
+    def report(self) -> dict:
+        """
+        Returns a machine-readable report with the statistics of each (test category, table, stage)
+        and their totals for each stage.
+        """
+        records = self.to_records()
+        totals = {}
+        for record in records:
+            stats = totals.setdefault(record['stage'], StageStats())
+            stats.calls += record['calls']
+            stats.wall_time += record['wall_time']
+            stats.prompt_tokens += record['prompt_tokens']
+            stats.completion_tokens += record['completion_tokens']
+        return {'stages': records, 'totals': {stage: asdict(stats) for stage, stats in totals.items()}}
+
+    def dump(self, path: str):
+        """Writes the `report` to `path` as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def get_active_profiler() -> PipelineProfiler | None:
+    return _active_profiler.get()
+
+
+def get_current_scope() -> tuple[str, str] | None:
+    """Returns the (test category, table) of the current `profile_scope`, if any."""
+    return _active_scope.get()
+
+
+def get_current_stage() -> str | None:
+    """Returns the innermost `profile_stage` of the current context, if any."""
+    return _active_stage.get()
+
+
+@contextmanager
+def profile_scope(test_category: str, tbl_name: str | None):
+    """
+    Attributes the stages executed inside the block to the given test category and table.
+    The scope is also set without an active profiler, for the usage meters (see `get_current_scope`).
+    """
+    profiler = _active_profiler.get()
+    scope = (test_category, tbl_name or '')
+    if profiler is not None:
+        profiler._last_scope = scope
+    token = _active_scope.set(scope)
+    try:
+        yield
+    finally:
+        _active_scope.reset(token)
+
+
+@contextmanager
+def profile_stage(stage: str):
+    """
+    Records the wall time of the block in `stage` of the active profiler, if any.
+    The stage is also set without an active profiler, for the usage meters (see `get_current_stage`).
+    """
+    profiler = _active_profiler.get()
+    token = _active_stage.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _active_stage.reset(token)
+        if profiler is not None:
+            profiler.record(stage, time.perf_counter() - start)
+
+
+def profiled(stage: str):
+    """Decorator recording each call of the decorated function in `stage` of the active profiler, if any."""
+
+    def decorator(fun):
+        @wraps(fun)
+        def wrapper(*args, **kwargs):
+            with profile_stage(stage):
+                return fun(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_llm_call(wall_time: float, prompt_tokens: int = 0, completion_tokens: int = 0):
+    """Records a language model call in the `llm` stage of the active profiler, if any."""
+    profiler = _active_profiler.get()
+    if profiler is not None:
+        profiler.record('llm', wall_time, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)